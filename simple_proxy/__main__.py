@@ -1,9 +1,24 @@
+import time
+
+# 启动耗时从进程开始加载本模块算起
+_STARTED = time.perf_counter()
+
 import asyncio
 import click
-from .config import ProxyConfig
-from .proxy_server import ProxyServer
-from .web_interface import WebInterface
-from .ssh_forwarder import SSHForwarder
+
+# aiohttp和各子系统在解析完命令行后才加载，--help等不需要启动服务的调用不付出导入开销
+
+
+def _new_event_loop(kind: str):
+    """创建事件循环，返回 (loop, 实际使用的实现)。未安装uvloop时回退到asyncio"""
+    if kind == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            click.echo("未安装uvloop（pip install uvloop），使用asyncio默认事件循环", err=True)
+        else:
+            return uvloop.new_event_loop(), 'uvloop'
+    return asyncio.new_event_loop(), 'asyncio'
 
 @click.command()
 @click.option('--config', default='config.yaml', help='配置文件路径')
@@ -11,53 +26,150 @@ from .ssh_forwarder import SSHForwarder
 @click.option('--proxy-port', default=8080, help='代理服务器端口')
 @click.option('--web-host', default='127.0.0.1', help='Web界面主机')
 @click.option('--web-port', default=8081, help='Web界面端口')
+@click.option('--socks-host', default='127.0.0.1', help='SOCKS5监听主机')
+@click.option('--socks-port', type=int, default=None, help='SOCKS5监听端口，不指定时不启用')
 @click.option('--enable-ssh', is_flag=True, help='启用SSH端口转发')
-def main(config, proxy_host, proxy_port, web_host, web_port, enable_ssh):
+@click.option('--shutdown-timeout', type=float, default=None, help='停止时等待在途连接结束的期限（秒），默认30')
+@click.option('--handoff-socket', default=None, help='热重启交接用的Unix套接字路径')
+@click.option('--takeover', is_flag=True, help='从 --handoff-socket 上运行中的进程接管监听套接字')
+@click.option('--loop', 'loop_kind', type=click.Choice(['asyncio', 'uvloop']), default='asyncio',
+              help='事件循环实现，uvloop未安装时回退到asyncio')
+def main(config, proxy_host, proxy_port, web_host, web_port, socks_host, socks_port, enable_ssh,
+         shutdown_timeout, handoff_socket, takeover, loop_kind):
     """Simple Proxy Server with web configuration interface"""
+    if takeover and not handoff_socket:
+        raise click.UsageError('--takeover 需要同时指定 --handoff-socket')
+    
+    loop, loop_name = _new_event_loop(loop_kind)
+    asyncio.set_event_loop(loop)
+    
+    from .config import ProxyConfig
+    from .proxy_server import ProxyServer
+    from .web_interface import WebInterface
+    from .diagnostics import LoopLagMonitor, StartupReport
+    
     # 加载配置
     config_obj = ProxyConfig(config)
     
-    # 创建组件
+    # 创建组件，SOCKS5监听和SSH转发只在启用时加载
     proxy_server = ProxyServer(config_obj, proxy_host, proxy_port)
-    ssh_forwarder = SSHForwarder(config_obj) if enable_ssh else None
-    web_interface = WebInterface(config_obj, web_host, web_port, ssh_forwarder)
+    if shutdown_timeout is not None:
+        proxy_server.shutdown_timeout = shutdown_timeout
+    socks_server = None
+    if socks_port is not None:
+        from .socks_server import Socks5Server
+        socks_server = Socks5Server(proxy_server, socks_host, socks_port)
+    ssh_forwarder = None
+    if enable_ssh:
+        from .ssh_forwarder import SSHForwarder
+        ssh_forwarder = SSHForwarder(config_obj)
+    loop_monitor = LoopLagMonitor.from_config(config_obj)
+    startup_report = StartupReport(_STARTED, loop_name)
+    web_interface = WebInterface(config_obj, web_host, web_port, ssh_forwarder, proxy_server, loop_monitor,
+                                 startup_report)
+    
+    # 热重启：先从旧进程取得监听套接字，两个进程短暂共享同一监听队列
+    inherited = {}
+    handoff_client = None
+    if handoff_socket:
+        from .handoff import HandoffClient, HandoffServer
+    if takeover:
+        handoff_client = HandoffClient(handoff_socket)
+        try:
+            inherited = handoff_client.receive()
+        except (OSError, ValueError) as e:
+            raise click.ClickException(f"无法从 {handoff_socket} 接管监听套接字: {e}")
     
     # 运行所有服务
-    loop = asyncio.get_event_loop()
+    handoff_server = None
+    shutdown_task = None
+    ssh_start_task = None
+    
+    async def start_ssh_after_handoff():
+        # 旧进程的转发仍占用远端端口，等它排空退出后再启动
+        await handoff_client.wait_for_previous()
+        print("旧进程已退出，启动SSH端口转发")
+        await ssh_forwarder.start_all_forwarding()
+    
+    async def shutdown():
+        if handoff_server:
+            await handoff_server.stop()
+        if socks_server:
+            await socks_server.stop()
+        if ssh_start_task and not ssh_start_task.done():
+            ssh_start_task.cancel()
+        # 代理服务器排空在途连接后才退出，排空期间经SSH转发进入的连接仍需要转发
+        await asyncio.gather(proxy_server.stop(), web_interface.stop())
+        if ssh_forwarder:
+            await ssh_forwarder.stop_all_forwarding()
+        if loop_monitor:
+            await loop_monitor.stop()
+    
+    def request_shutdown():
+        nonlocal shutdown_task
+        if shutdown_task is not None:
+            return
+        print("\n正在关闭服务器，等待在途连接结束...")
+        shutdown_task = asyncio.ensure_future(shutdown())
+        shutdown_task.add_done_callback(lambda _: loop.stop())
+    
     try:
         # 启动服务
         tasks = [
-            proxy_server.start(),
-            web_interface.start()
+            proxy_server.start(inherited.get('proxy')),
+            web_interface.start(inherited.get('web'))
         ]
         
-        if ssh_forwarder:
+        if socks_server:
+            tasks.append(socks_server.start(inherited.get('socks')))
+        
+        if ssh_forwarder and not handoff_client:
             tasks.append(ssh_forwarder.start_all_forwarding())
         
-        loop.run_until_complete(asyncio.gather(*tasks))
+        if loop_monitor:
+            tasks.append(loop_monitor.start())
         
-        print(f"代理服务器运行在 http://{proxy_host}:{proxy_port}")
-        print(f"Web配置界面运行在 http://{web_host}:{web_port}")
+        try:
+            loop.run_until_complete(asyncio.gather(*tasks))
+        except Exception:
+            # 新进程启动失败时旧进程继续服务
+            if handoff_client:
+                handoff_client.abort()
+            raise
         
-        if ssh_forwarder:
+        if handoff_client:
+            handoff_client.ready()
+            if ssh_forwarder:
+                ssh_start_task = loop.create_task(start_ssh_after_handoff())
+        if handoff_socket:
+            handoff_server = HandoffServer(
+                handoff_socket,
+                lambda: {'proxy': proxy_server.sock, 'web': web_interface.sock,
+                         'socks': socks_server.sock if socks_server else None},
+                request_shutdown
+            )
+            loop.run_until_complete(handoff_server.start())
+        
+        print(f"代理服务器运行在 http://{proxy_server.host}:{proxy_server.port}")
+        print(f"Web配置界面运行在 http://{web_interface.host}:{web_interface.port}")
+        if socks_server:
+            print(f"SOCKS5代理运行在 {socks_server.host}:{socks_server.port}")
+        print(startup_report.ready())
+        
+        if ssh_start_task:
+            print("SSH端口转发将在旧进程退出后启动")
+        elif ssh_forwarder:
             ssh_status = ssh_forwarder.get_status()
             if ssh_status:
                 print("SSH端口转发状态:")
                 for name, status in ssh_status.items():
                     print(f"  {name}: {'运行中' if status['running'] else '已停止'} (PID: {status.get('pid', 'N/A')})")
         
-        # 设置信号处理
-        def signal_handler():
-            print("\n正在关闭服务器...")
-            if ssh_forwarder:
-                loop.run_until_complete(ssh_forwarder.stop_all_forwarding())
-            loop.stop()
-        
         # 在Windows上使用不同的信号处理方式
         try:
             import signal
             for sig in [signal.SIGTERM, signal.SIGINT]:
-                loop.add_signal_handler(sig, signal_handler)
+                loop.add_signal_handler(sig, request_shutdown)
         except (ImportError, NotImplementedError):
             # Windows不支持add_signal_handler
             pass
@@ -66,10 +178,9 @@ def main(config, proxy_host, proxy_port, web_host, web_port, enable_ssh):
         
     except KeyboardInterrupt:
         print("\n正在关闭服务器...")
-        if ssh_forwarder:
-            loop.run_until_complete(ssh_forwarder.stop_all_forwarding())
+        loop.run_until_complete(shutdown())
     finally:
         loop.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
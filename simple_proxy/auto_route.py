@@ -0,0 +1,276 @@
+"""
+自动选路模块
+
+规则动作为 auto 时，对没有记录的域名同时发起直连和经上游代理的连接，先建立成功的一方胜出并直接使用，
+另一方在后台完成后记录其耗时再关闭。每个域名两条路径的建连耗时按指数加权平均保存，
+旧样本随时间衰减，任一路径超过两个半衰期未更新时重新测速。同一域名同时只进行一次测速。
+明文HTTP请求经HTTP上游代理转发时不建立隧道，代理一侧测量的是到上游代理本身的建连耗时，
+这类结果与隧道（CONNECT、Upgrade）的结果按域名分开记录，互不影响。
+记录数量有上限（按最近使用淘汰），并定期保存到文件，重启后继续使用。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DIRECT = "direct"
+PROXY = "proxy"
+# 测速结果的类别：经隧道转发的连接，和经HTTP上游代理转发的明文HTTP请求
+TUNNEL = "tunnel"
+FORWARD = "forward"
+# 建连失败按该耗时（毫秒）计入，与连接超时相当
+FAILURE_PENALTY_MS = 10000.0
+# 新样本的权重
+EWMA_ALPHA = 0.3
+
+
+class AutoRouter:
+    def __init__(self, cache_file: Optional[str] = None, capacity: int = 10000,
+                 half_life: float = 3600.0, direct_bias: float = 1.2, save_interval: float = 60.0):
+        """
+        half_life: 旧样本权重减半的时间（秒）
+        direct_bias: 直连耗时不超过代理耗时的该倍数时选择直连，减少经上游代理的连接
+        """
+        self.cache_file = cache_file
+        self.capacity = capacity
+        self.half_life = half_life
+        self.direct_bias = direct_bias
+        self.save_interval = save_interval
+        # (域名, 类别) -> [直连耗时ms, 直连更新时间, 代理耗时ms, 代理更新时间]
+        self._entries: "OrderedDict[tuple, list]" = OrderedDict()
+        self._dirty = False
+        self._task = None
+        self.races = 0
+        # (域名, 类别) -> 正在进行的测速，结果为胜出路径
+        self._racing: Dict[tuple, asyncio.Future] = {}
+        self.load()
+
+    @classmethod
+    def from_config(cls, config) -> "AutoRouter":
+        settings = config.config.get("auto_route") or {}
+        return cls(
+            cache_file=settings.get("cache_file", "auto_route.json"),
+            capacity=settings.get("capacity", 10000),
+            half_life=settings.get("half_life", 3600.0),
+            direct_bias=settings.get("direct_bias", 1.2),
+        )
+
+    def lookup(self, domain: str, kind: str = TUNNEL) -> Optional[str]:
+        """返回域名的优选路径，需要重新测速时返回None，调用方应调用race()"""
+        key = (domain, kind)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        horizon = time.time() - 2 * self.half_life
+        if entry[1] < horizon and entry[3] < horizon:
+            # 两条路径的样本都已过期，删除记录
+            del self._entries[key]
+            self._dirty = True
+            return None
+        return self._choose(entry, horizon)
+
+    def _choose(self, entry: list, horizon: float) -> Optional[str]:
+        """按记录选择路径，不修改记录"""
+        # 任一路径的样本过旧就重新测速，避免一直走某条路径而另一条的结果长期不更新
+        direct = entry[0] if entry[1] >= horizon else None
+        proxy = entry[2] if entry[3] >= horizon else None
+        if direct is None or proxy is None:
+            return None
+        direct_ok = direct < FAILURE_PENALTY_MS
+        proxy_ok = proxy < FAILURE_PENALTY_MS
+        if direct_ok and proxy_ok:
+            return DIRECT if direct <= proxy * self.direct_bias else PROXY
+        if direct_ok:
+            return DIRECT
+        # 代理可用或两条路径都不可用时交给上游代理
+        return PROXY
+
+    def observe(self, domain: str, route: str, latency: Optional[float], kind: str = TUNNEL) -> None:
+        """记录一次建连耗时（秒），latency为None表示建连失败"""
+        now = time.time()
+        sample = FAILURE_PENALTY_MS if latency is None else latency * 1000
+        key = (domain, kind)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [None, 0.0, None, 0.0]
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        index = 0 if route == DIRECT else 2
+        previous = entry[index]
+        if previous is None:
+            entry[index] = sample
+        else:
+            # 距上次更新越久，旧值的权重越低
+            weight = 0.5 ** ((now - entry[index + 1]) / self.half_life)
+            alpha = 1 - (1 - EWMA_ALPHA) * weight
+            entry[index] = previous + alpha * (sample - previous)
+        entry[index + 1] = now
+        self._dirty = True
+
+    def forget(self, domain: Optional[str] = None) -> None:
+        """清除域名各类别的测速结果，domain为None时全部清除"""
+        if domain is None:
+            self._entries.clear()
+        else:
+            for kind in (TUNNEL, FORWARD):
+                self._entries.pop((domain, kind), None)
+        self._dirty = True
+
+    async def race(self, domain: str, open_direct: Callable[[], Awaitable],
+                   open_proxy: Callable[[], Awaitable], kind: str = TUNNEL):
+        """
+        同时建立直连和代理连接，返回 (胜出路径, reader, writer)。
+        两条路径都失败时抛出直连的异常。
+        同一域名同时只进行一次测速，其间的其他调用方等待结果后按胜出路径建立自己的连接，
+        测速两条路径都失败时改走上游代理
+        """
+        key = (domain, kind)
+        while key in self._racing:
+            route = await asyncio.shield(self._racing[key])
+            if route is not None:
+                opener = open_direct if route == DIRECT else open_proxy
+                return (route,) + tuple(await opener())
+            # 进行测速的请求被取消，由等待者之一重新测速
+
+        outcome = asyncio.get_running_loop().create_future()
+        self._racing[key] = outcome
+        try:
+            winner = await self._race(domain, kind, open_direct, open_proxy)
+        except Exception:
+            outcome.set_result(PROXY)
+            raise
+        except BaseException:
+            outcome.set_result(None)
+            raise
+        else:
+            outcome.set_result(winner[0])
+        finally:
+            del self._racing[key]
+        return winner
+
+    async def _race(self, domain: str, kind: str, open_direct: Callable[[], Awaitable],
+                    open_proxy: Callable[[], Awaitable]):
+        self.races += 1
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        routes = {
+            asyncio.ensure_future(open_direct()): DIRECT,
+            asyncio.ensure_future(open_proxy()): PROXY,
+        }
+        pending = set(routes)
+        winner = None
+        errors = {}
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    route = routes[task]
+                    error = task.exception()
+                    self.observe(domain, route, None if error else loop.time() - started, kind)
+                    if error:
+                        errors[route] = error
+                    elif winner is None:
+                        winner = (route,) + tuple(task.result())
+                    else:
+                        task.result()[1].close()
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+
+        # 落败的一方在后台完成以记录其耗时，随后关闭
+        for task in pending:
+            task.add_done_callback(lambda t, r=routes[task]: self._finish_loser(domain, kind, r, started, t))
+        if winner is None:
+            raise errors.get(DIRECT) or errors[PROXY]
+        logger.info(f"Auto route for {domain} ({kind}): {winner[0]}")
+        return winner
+
+    def _finish_loser(self, domain: str, kind: str, route: str, started: float, task: asyncio.Future) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        self.observe(domain, route, None if error else asyncio.get_running_loop().time() - started, kind)
+        if not error:
+            task.result()[1].close()
+
+    def load(self) -> None:
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable auto route cache {self.cache_file}: {e}")
+            return
+        if not isinstance(data, list):
+            # 旧格式的记录没有区分类别，其中混有不可比较的结果，重新测速
+            logger.info(f"Discarding auto route cache {self.cache_file} in the old format")
+            return
+        # 文件按最近使用顺序保存 [域名, 类别, 直连耗时, 直连更新时间, 代理耗时, 代理更新时间]
+        for row in data:
+            if isinstance(row, list) and len(row) == 6 and row[1] in (TUNNEL, FORWARD):
+                self._entries[(row[0], row[1])] = row[2:]
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    async def save(self) -> None:
+        if not self.cache_file or not self._dirty:
+            return
+        self._dirty = False
+        data = json.dumps([[domain, kind] + entry for (domain, kind), entry in self._entries.items()])
+        await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: str) -> None:
+        # 先写临时文件再替换，避免保存中途退出留下损坏的文件
+        temp_path = f"{self.cache_file}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self.cache_file)
+
+    async def start(self) -> None:
+        if self.cache_file:
+            self._task = asyncio.create_task(self._save_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
+
+    async def _save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.save()
+            except OSError as e:
+                logger.error(f"Failed to save auto route cache: {e}")
+
+    def page(self, offset: int = 0, limit: int = 100) -> Dict:
+        """只读快照，过期记录留给lookup()删除"""
+        horizon = time.time() - 2 * self.half_life
+        items = []
+        for (domain, kind), entry in list(self._entries.items())[offset:offset + limit]:
+            direct, direct_updated, proxy, proxy_updated = entry
+            items.append({
+                "domain": domain,
+                "kind": kind,
+                "route": self._choose(entry, horizon),
+                "direct_ms": None if direct is None else round(direct, 3),
+                "direct_updated": direct_updated,
+                "proxy_ms": None if proxy is None else round(proxy, 3),
+                "proxy_updated": proxy_updated,
+            })
+        return {"total": len(self._entries), "races": self.races, "items": items}
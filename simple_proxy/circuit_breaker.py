@@ -0,0 +1,297 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from .upstream import UpstreamUnavailable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """目标或上游处于熔断状态（或命中负缓存），请求应立即失败"""
+
+    def __init__(self, destination: str, upstream: str, rejection: Dict):
+        super().__init__(f"{rejection['reason']}: {rejection['error']}")
+        self.destination = destination
+        self.upstream = upstream
+        self.rejection = rejection
+
+
+class CircuitBreaker:
+    """
+    按失败率熔断：滑动窗口内请求数达到min_requests且失败率达到failure_rate时打开，
+    打开open_seconds后进入半开状态，放行一个探测请求，成功则关闭，失败则重新打开
+    """
+    __slots__ = ("key", "failure_rate", "min_requests", "window", "open_seconds",
+                 "state", "opened_at", "probe_started", "buckets", "trips", "last_error")
+
+    def __init__(self, key: str, failure_rate: float = 0.5, min_requests: int = 5,
+                 window: float = 30.0, open_seconds: float = 30.0):
+        self.key = key
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_started = None
+        # 按秒分桶的 [秒, 成功数, 失败数]，内存占用与请求量无关
+        self.buckets = deque()
+        self.trips = 0
+        self.last_error = None
+
+    def permits(self, now: float) -> bool:
+        """是否会放行请求，不占用半开状态的探测名额"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if now < self.opened_at + self.open_seconds:
+                return False
+            self.state = HALF_OPEN
+            self.probe_started = None
+        # 半开状态只放行一个探测请求；探测请求被取消而没有结果时，超时后再放行一个
+        return self.probe_started is None or now - self.probe_started >= self.open_seconds
+
+    def allow(self, now: float) -> bool:
+        """放行请求，半开状态下占用探测名额"""
+        if not self.permits(now):
+            return False
+        if self.state == HALF_OPEN:
+            self.probe_started = now
+        return True
+
+    def retry_after(self, now: float) -> float:
+        if self.state == OPEN:
+            return max(0.0, self.opened_at + self.open_seconds - now)
+        if self.state == HALF_OPEN and self.probe_started is not None:
+            return max(0.0, self.probe_started + self.open_seconds - now)
+        return 0.0
+
+    def record_success(self, now: float) -> None:
+        if self.state != CLOSED:
+            self._close()
+        self._count(now, success=True)
+
+    def record_failure(self, now: float, error: str) -> None:
+        self.last_error = error
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+        if self.state == OPEN:
+            return
+        self._count(now, success=False)
+        successes, failures = self._totals(now)
+        total = successes + failures
+        if total >= self.min_requests and failures / total >= self.failure_rate:
+            self._open(now)
+
+    def _count(self, now: float, success: bool) -> None:
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            bucket = self.buckets[-1]
+        else:
+            bucket = [second, 0, 0]
+            self.buckets.append(bucket)
+        bucket[1 if success else 2] += 1
+
+    def _totals(self, now: float):
+        horizon = now - self.window
+        while self.buckets and self.buckets[0][0] < horizon:
+            self.buckets.popleft()
+        return sum(b[1] for b in self.buckets), sum(b[2] for b in self.buckets)
+
+    def _open(self, now: float) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_started = None
+        self.trips += 1
+
+    def _close(self) -> None:
+        self.state = CLOSED
+        self.probe_started = None
+        self.buckets.clear()
+
+    def to_dict(self, now: float) -> Dict:
+        successes, failures = self._totals(now)
+        return {
+            "key": self.key,
+            "state": self.state,
+            "successes": successes,
+            "failures": failures,
+            "trips": self.trips,
+            "retry_after": round(self.retry_after(now), 3),
+            "last_error": self.last_error,
+        }
+
+
+class NegativeCache:
+    """记录短时间内无法连接的 host:port，过期前的请求直接失败"""
+
+    def __init__(self, ttl: float = 10.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def add(self, key: str, error: str, now: float) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self.ttl, error)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str, now: float) -> Optional[tuple]:
+        """返回 (过期时间, 错误信息)，不存在或已过期时返回None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def discard(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def snapshot(self, now: float) -> List[Dict]:
+        return [{"key": key, "expires_in": round(expires - now, 3), "error": error}
+                for key, (expires, error) in self._entries.items() if expires > now]
+
+
+class CircuitBreakers:
+    """
+    目标（host:port）和上游代理的熔断器，以及不可达目标的负缓存。
+    check() 返回拒绝原因时调用方应立即失败，否则在请求结束后调用
+    record_success() 或 record_failure() 报告结果
+    """
+
+    def __init__(self, enabled: bool = True, failure_rate: float = 0.5, min_requests: int = 5,
+                 window: float = 30.0, open_seconds: float = 30.0, negative_ttl: float = 10.0,
+                 max_breakers: int = 10000):
+        self.enabled = enabled
+        self.settings = {
+            "failure_rate": failure_rate,
+            "min_requests": min_requests,
+            "window": window,
+            "open_seconds": open_seconds,
+        }
+        self.max_breakers = max_breakers
+        # 目标数量不受控，按最近使用顺序淘汰
+        self.destinations: "OrderedDict[str, CircuitBreaker]" = OrderedDict()
+        self.upstreams: Dict[str, CircuitBreaker] = {}
+        self.negative_cache = NegativeCache(negative_ttl, max_breakers)
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config) -> "CircuitBreakers":
+        settings = config.config.get("circuit_breaker") or {}
+        return cls(
+            enabled=settings.get("enabled", True),
+            failure_rate=settings.get("failure_rate", 0.5),
+            min_requests=settings.get("min_requests", 5),
+            window=settings.get("window", 30.0),
+            open_seconds=settings.get("open_seconds", 30.0),
+            negative_ttl=settings.get("negative_ttl", 10.0),
+        )
+
+    def _destination(self, key: str) -> CircuitBreaker:
+        breaker = self.destinations.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key, **self.settings)
+            self.destinations[key] = breaker
+            if len(self.destinations) > self.max_breakers:
+                self.destinations.popitem(last=False)
+        else:
+            self.destinations.move_to_end(key)
+        return breaker
+
+    def _upstream(self, key: str) -> CircuitBreaker:
+        breaker = self.upstreams.get(key)
+        if breaker is None:
+            breaker = self.upstreams[key] = CircuitBreaker(key, **self.settings)
+        return breaker
+
+    def check(self, destination: str, upstream: str) -> Optional[Dict]:
+        """返回 {"reason", "retry_after", "error"} 表示应拒绝请求，允许时返回None"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        upstream_breaker = None
+        if upstream == "direct":
+            entry = self.negative_cache.get(destination, now)
+            if entry is not None:
+                return self._reject("unreachable", entry[0] - now, entry[1])
+        else:
+            upstream_breaker = self._upstream(upstream)
+            if not upstream_breaker.permits(now):
+                return self._reject("upstream_open", upstream_breaker.retry_after(now),
+                                    upstream_breaker.last_error)
+        breaker = self._destination(destination)
+        if not breaker.permits(now):
+            return self._reject("destination_open", breaker.retry_after(now), breaker.last_error)
+        # 两者都放行时才占用半开状态的探测名额，否则被目标拒绝的请求会占住上游的探测
+        if upstream_breaker is not None:
+            upstream_breaker.allow(now)
+        breaker.allow(now)
+        return None
+
+    def _reject(self, reason: str, retry_after: float, error: Optional[str]) -> Dict:
+        self.rejected += 1
+        return {"reason": reason, "retry_after": max(1, round(retry_after)), "error": error}
+
+    def record_success(self, destination: str, upstream: str) -> None:
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        self._destination(destination).record_success(now)
+        if upstream != "direct":
+            self._upstream(upstream).record_success(now)
+
+    def record_failure(self, destination: str, upstream: str, error: BaseException,
+                       connect_failed: bool = False) -> None:
+        """
+        按错误类型把失败计入上游或目标。直连时连接阶段的失败（connect_failed为True
+        或aiohttp的连接错误）还会把目标加入负缓存
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        message = str(error) or error.__class__.__name__
+        if isinstance(error, (aiohttp.ClientProxyConnectionError, UpstreamUnavailable)):
+            # 连不上上游代理，与目标无关
+            self._upstream(upstream).record_failure(now, message)
+            return
+        if not isinstance(error, (aiohttp.ClientError, OSError, asyncio.TimeoutError)):
+            return
+        if upstream == "direct" and (connect_failed or isinstance(error, aiohttp.ClientConnectorError)):
+            self.negative_cache.add(destination, message, now)
+        self._destination(destination).record_failure(now, message)
+
+    def reset(self, key: Optional[str] = None) -> None:
+        """重置指定目标或上游的状态，key为None时全部重置"""
+        if key is None:
+            self.destinations.clear()
+            self.upstreams.clear()
+            self.negative_cache.clear()
+            return
+        self.destinations.pop(key, None)
+        self.upstreams.pop(key, None)
+        self.negative_cache.discard(key)
+
+    def snapshot(self, include_closed: bool = False) -> Dict:
+        now = time.monotonic()
+        return {
+            "enabled": self.enabled,
+            "settings": dict(self.settings, negative_ttl=self.negative_cache.ttl),
+            "rejected": self.rejected,
+            "upstreams": [b.to_dict(now) for b in self.upstreams.values()],
+            "destinations": [b.to_dict(now) for b in self.destinations.values()
+                             if include_closed or b.state != CLOSED],
+            "negative_cache": self.negative_cache.snapshot(now),
+        }
@@ -1,12 +1,15 @@
 import json
 import os
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 import yaml
 
 class ProxyConfig:
     def __init__(self, config_path: str = "config.yaml"):
         self.config_path = config_path
         self.config = self._load_default_config()
+        # 配置版本号，每次变更递增，用于ETag和增量推送
+        self.version = 0
+        self._listeners = []
         
     def _load_default_config(self) -> Dict:
         default_config = {
@@ -39,15 +42,39 @@ class ProxyConfig:
             else:
                 yaml.safe_dump(self.config, f, allow_unicode=True, default_flow_style=False)
     
+    def add_listener(self, callback: Callable[[str, Dict], None]) -> None:
+        """注册配置变更回调，回调参数为事件名和事件数据"""
+        self._listeners.append(callback)
+    
+    def remove_listener(self, callback: Callable[[str, Dict], None]) -> None:
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+    
+    def notify_changed(self, event: str = "config_changed", data: Optional[Dict] = None) -> None:
+        """递增版本号并通知所有监听者"""
+        self.version += 1
+        payload = dict(data or {}, version=self.version)
+        for callback in list(self._listeners):
+            callback(event, payload)
+    
     def add_rule(self, rule: Dict) -> None:
         """添加新规则"""
         self.config["rules"].append(rule)
+        self.notify_changed("rule_added", {
+            "id": len(self.config["rules"]) - 1,
+            "rule": rule,
+            "total": len(self.config["rules"])
+        })
     
     def remove_rule(self, rule_index: int) -> bool:
         """根据索引删除规则"""
         try:
             if 0 <= rule_index < len(self.config["rules"]):
                 self.config["rules"].pop(rule_index)
+                self.notify_changed("rule_removed", {
+                    "id": rule_index,
+                    "total": len(self.config["rules"])
+                })
                 return True
             return False
         except (IndexError, TypeError):
@@ -57,7 +84,10 @@ class ProxyConfig:
         """根据模式删除规则（保持向后兼容）"""
         initial_length = len(self.config["rules"])
         self.config["rules"] = [r for r in self.config["rules"] if r["pattern"] != pattern]
-        return len(self.config["rules"]) != initial_length
+        changed = len(self.config["rules"]) != initial_length
+        if changed:
+            self.notify_changed("rules_reset", {"total": len(self.config["rules"])})
+        return changed
     
     def get_rules(self) -> List[Dict]:
         return self.config["rules"]
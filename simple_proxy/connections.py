@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+
+class ConnectionRecord:
+    """单个活动连接的紧凑记录，使用__slots__避免每个对象携带字典"""
+    __slots__ = ("id", "kind", "client", "destination", "rule", "upstream",
+                 "started", "bytes_up", "bytes_down", "task")
+
+    def __init__(self, conn_id: int, kind: str, client: str, destination: str,
+                 rule: str, upstream: str, task: Optional[asyncio.Task]):
+        self.id = conn_id
+        self.kind = kind
+        self.client = client
+        self.destination = destination
+        self.rule = rule
+        self.upstream = upstream
+        self.started = time.time()
+        self.bytes_up = 0  # 客户端发往目标的字节数
+        self.bytes_down = 0  # 目标返回客户端的字节数
+        self.task = task
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "client": self.client,
+            "destination": self.destination,
+            "rule": self.rule,
+            "upstream": self.upstream,
+            "started": self.started,
+            "duration": round(time.time() - self.started, 3),
+            "bytes_up": self.bytes_up,
+            "bytes_down": self.bytes_down,
+        }
+
+
+class ConnectionRegistry:
+    """活动连接表，按目标建立索引，支持分页查看、单个断开和按目标清空"""
+
+    def __init__(self):
+        self._records: Dict[int, ConnectionRecord] = {}
+        self._by_destination: Dict[str, Dict[int, ConnectionRecord]] = {}
+        self._ids = itertools.count(1)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def open(self, kind: str, client: Optional[str], destination: str,
+             rule: str, upstream: str) -> ConnectionRecord:
+        """登记由当前任务处理的连接，断开连接时取消该任务"""
+        # 大量连接往往指向相同的目标、规则和上游，驻留字符串以共享内存
+        record = ConnectionRecord(
+            next(self._ids), kind, sys.intern(client or "-"), sys.intern(destination),
+            sys.intern(rule), sys.intern(upstream), asyncio.current_task())
+        self._records[record.id] = record
+        self._by_destination.setdefault(record.destination, {})[record.id] = record
+        return record
+
+    def close(self, record: ConnectionRecord) -> None:
+        self._records.pop(record.id, None)
+        by_id = self._by_destination.get(record.destination)
+        if by_id is not None:
+            by_id.pop(record.id, None)
+            if not by_id:
+                del self._by_destination[record.destination]
+        record.task = None
+
+    def get(self, conn_id: int) -> Optional[ConnectionRecord]:
+        return self._records.get(conn_id)
+
+    def kill(self, conn_id: int) -> bool:
+        """断开指定连接，连接不存在时返回False"""
+        record = self._records.get(conn_id)
+        if record is None:
+            return False
+        if record.task is not None and not record.task.done():
+            record.task.cancel()
+        return True
+
+    def drain(self, destination: str) -> int:
+        """断开所有指向指定目标的连接，返回断开的数量"""
+        records = list(self._by_destination.get(destination, {}).values())
+        for record in records:
+            self.kill(record.id)
+        return len(records)
+
+    def records(self) -> Iterator[ConnectionRecord]:
+        return iter(self._records.values())
+
+    def page(self, offset: int = 0, limit: int = 100, destination: Optional[str] = None,
+             client: Optional[str] = None) -> Dict:
+        """按建立顺序分页返回连接，可按目标或客户端过滤"""
+        if destination is not None:
+            source = self._by_destination.get(destination, {}).values()
+        else:
+            source = self._records.values()
+        if client is not None:
+            source = [r for r in source if r.client == client]
+
+        total = len(source)
+        items: List[Dict] = [r.to_dict() for r in itertools.islice(source, offset, offset + limit)]
+        return {"total": total, "offset": offset, "limit": limit, "items": items}
+
+    def top_destinations(self, limit: int = 10) -> List[Dict]:
+        """按活动连接数排序的目标"""
+        ranked = sorted(self._by_destination.items(), key=lambda item: len(item[1]), reverse=True)
+        return [{"destination": dest, "connections": len(by_id)} for dest, by_id in ranked[:limit]]
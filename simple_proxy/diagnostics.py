@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 调度延迟直方图的桶上界（毫秒），最后一个桶收集更大的值
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# 单次性能分析的最长时间（秒）
+MAX_PROFILE_SECONDS = 60
+
+
+class LoopLagMonitor:
+    """
+    测量事件循环的调度延迟。后台看门狗线程在循环被阻塞时
+    抓取事件循环线程的调用栈，定位阻塞的回调
+    """
+
+    def __init__(self, interval: float = 0.5, stall_threshold: float = 0.25, max_stalls: int = 20):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.histogram = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = deque(maxlen=max_stalls)
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, config) -> Optional["LoopLagMonitor"]:
+        settings = config.config.get("diagnostics") or {}
+        if not settings.get("loop_monitor", True):
+            return None
+        return cls(
+            interval=settings.get("interval", 0.5),
+            stall_threshold=settings.get("stall_threshold", 0.25)
+        )
+
+    async def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self._record(max(0.0, loop.time() - expected))
+            self._heartbeat = time.monotonic()
+
+    def _record(self, lag: float):
+        lag_ms = lag * 1000
+        for index, bound in enumerate(LAG_BUCKETS_MS):
+            if lag_ms <= bound:
+                break
+        else:
+            index = len(LAG_BUCKETS_MS)
+        self.histogram[index] += 1
+        self.samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        """看门狗线程：心跳超时说明事件循环正被某个回调阻塞"""
+        reported_heartbeat = None
+        while not self._stopped.wait(self.stall_threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.stall_threshold or heartbeat == reported_heartbeat:
+                continue
+            # 每次阻塞只记录一次调用栈
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls.append({
+                "time": time.time(),
+                "blocked_ms": round(blocked * 1000, 3),
+                "stack": stack
+            })
+            logger.warning(f"Event loop blocked for at least {blocked * 1000:.0f} ms:\n{stack}")
+
+    def snapshot(self) -> Dict:
+        buckets = [f"<={bound}ms" for bound in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}ms"]
+        return {
+            "interval": self.interval,
+            "stall_threshold": self.stall_threshold,
+            "samples": self.samples,
+            "mean_lag_ms": round(self.total_lag / self.samples * 1000, 3) if self.samples else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "histogram": dict(zip(buckets, self.histogram)),
+            "stalls": list(self.stalls)
+        }
+
+
+class Profiler:
+    """对运行中的进程做限时性能分析，同一时间只允许一次"""
+
+    def __init__(self):
+        self.busy = False
+
+    async def run_cprofile(self, seconds: float, sort: str = "cumulative", limit: int = 50) -> str:
+        """在事件循环线程上运行cProfile，返回pstats文本报告"""
+        # 只在需要时加载，不增加启动时间
+        import cProfile
+        import io
+        import pstats
+        self.busy = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                await asyncio.sleep(min(seconds, MAX_PROFILE_SECONDS))
+            finally:
+                profiler.disable()
+        finally:
+            self.busy = False
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    async def run_sampling(self, seconds: float, sample_interval: float = 0.005, limit: int = 50) -> Dict:
+        """在后台线程定期采样事件循环线程的调用栈，开销与被分析代码无关"""
+        self.busy = True
+        try:
+            thread_id = threading.get_ident()
+            return await asyncio.to_thread(
+                self._sample, thread_id, min(seconds, MAX_PROFILE_SECONDS), sample_interval, limit)
+        finally:
+            self.busy = False
+
+    @staticmethod
+    def _sample(thread_id: int, seconds: float, sample_interval: float, limit: int) -> Dict:
+        stacks = Counter()
+        functions = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                entries = [
+                    f"{f.f_code.co_filename}:{f.f_code.co_name}:{lineno}"
+                    for f, lineno in traceback.walk_stack(frame)
+                ]
+                entries.reverse()
+                stacks[";".join(entries)] += 1
+                functions[entries[-1]] += 1
+                samples += 1
+            time.sleep(sample_interval)
+        return {
+            "seconds": seconds,
+            "samples": samples,
+            # 栈顶函数的采样次数，近似各函数自身耗时占比
+            "top_functions": [{"function": name, "samples": count}
+                              for name, count in functions.most_common(limit)],
+            # 折叠栈格式，可直接用于火焰图工具
+            "stacks": [{"stack": stack, "samples": count}
+                       for stack, count in stacks.most_common(limit)]
+        }
+
+
+def memory_usage() -> Dict:
+    """当前进程的常驻内存（rss）和峰值（peak_rss），单位为字节，无法获取时为None"""
+    rss = None
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux上单位为KB，macOS上为字节
+        if sys.platform != "darwin":
+            peak *= 1024
+    except ImportError:
+        pass
+    return {"rss": rss, "peak_rss": peak}
+
+
+def _format_bytes(size: Optional[int]) -> str:
+    return "n/a" if size is None else f"{size / (1024 * 1024):.1f} MB"
+
+
+class StartupReport:
+    """记录启动耗时、事件循环实现和内存占用，便于比较重启速度"""
+
+    def __init__(self, started: float, loop: str):
+        """started: 进程开始加载时的 time.perf_counter()"""
+        self.started = started
+        self.loop = loop
+        self.startup_seconds = None
+        self.ready_at = None
+
+    def ready(self) -> str:
+        """服务全部启动后调用，返回一行报告"""
+        self.startup_seconds = time.perf_counter() - self.started
+        self.ready_at = time.time()
+        memory = memory_usage()
+        return (f"Started in {self.startup_seconds:.3f}s (loop: {self.loop}, "
+                f"RSS: {_format_bytes(memory['rss'])}, peak: {_format_bytes(memory['peak_rss'])})")
+
+    def snapshot(self) -> Dict:
+        return dict(
+            memory_usage(),
+            pid=os.getpid(),
+            loop=self.loop,
+            startup_seconds=None if self.startup_seconds is None else round(self.startup_seconds, 3),
+            uptime=None if self.ready_at is None else round(time.time() - self.ready_at, 3),
+        )
@@ -0,0 +1,164 @@
+"""
+监听套接字交接模块
+
+热重启时新进程通过Unix域套接字向旧进程请求监听套接字（SCM_RIGHTS传递文件描述符），
+用继承的套接字开始服务后通知旧进程，旧进程随即停止接受新连接并排空已有连接。
+交接期间两个进程共享同一个监听队列，不会出现连接被拒绝的情况。
+
+交接协议：
+1. 新进程连接交接套接字并发送 HANDOFF
+2. 旧进程回复一个JSON消息（套接字名称列表），并附带对应的文件描述符
+3. 新进程开始服务后发送 READY，旧进程开始优雅退出
+
+SSH远程转发占用的远端端口在旧进程排空、关闭转发之前无法重新绑定，
+新进程按消息中的旧进程PID等待其退出后再启动转发，排空期间远端的连接仍经旧进程的转发进入。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+HANDOFF_REQUEST = b"HANDOFF\n"
+READY_MESSAGE = b"READY\n"
+# 最多传递的监听套接字数量
+MAX_FDS = 16
+# 检查旧进程是否已退出的间隔（秒）
+EXIT_POLL_INTERVAL = 0.5
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except (ProcessLookupError, PermissionError):
+        # PermissionError：进程不属于当前用户，说明PID已被复用
+        return False
+    try:
+        # 已退出但尚未被父进程回收（僵尸）的进程同样视为已退出
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            return f.read().rsplit(b")", 1)[1].split()[0] != b"Z"
+    except (OSError, IndexError):
+        return True
+
+
+class HandoffServer:
+    """在旧进程中等待新进程来接管监听套接字"""
+
+    def __init__(self, path: str, get_sockets: Callable[[], Dict[str, socket.socket]],
+                 on_handoff: Callable[[], None]):
+        self.path = path
+        self.get_sockets = get_sockets
+        self.on_handoff = on_handoff
+        self._sock = None
+        self._task = None
+
+    async def start(self):
+        # 上一个进程留下的路径可以直接替换，它已经不再接受交接请求
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(1)
+        self._sock.setblocking(False)
+        self._task = asyncio.create_task(self._serve())
+        logger.info(f"Waiting for hot restart handoff on {self.path}")
+
+    async def stop(self):
+        """停止接受交接请求。路径此时可能已属于新进程，因此不删除"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self._sock)
+            try:
+                if await self._handle(loop, conn):
+                    # 交接完成，本进程不再处理后续交接请求
+                    self.on_handoff()
+                    return
+            except (OSError, ValueError) as e:
+                logger.error(f"Hot restart handoff failed: {e}")
+            finally:
+                conn.close()
+
+    async def _handle(self, loop, conn: socket.socket) -> bool:
+        conn.setblocking(False)
+        request = await loop.sock_recv(conn, len(HANDOFF_REQUEST))
+        if request != HANDOFF_REQUEST:
+            logger.warning("Ignoring unexpected handoff request")
+            return False
+
+        sockets = {name: sock for name, sock in self.get_sockets().items() if sock is not None}
+        names = list(sockets)
+        payload = json.dumps({"names": names, "pid": os.getpid()}).encode()
+        conn.setblocking(True)
+        socket.send_fds(conn, [payload], [sockets[name].fileno() for name in names])
+        conn.setblocking(False)
+        logger.info(f"Handed off listening sockets {names}, waiting for the new process")
+
+        ready = await loop.sock_recv(conn, len(READY_MESSAGE))
+        if ready != READY_MESSAGE:
+            # 新进程启动失败，本进程继续服务
+            logger.warning("New process did not become ready, keep serving")
+            return False
+        logger.info("New process is serving, starting graceful shutdown")
+        return True
+
+
+class HandoffClient:
+    """在新进程中从旧进程接管监听套接字"""
+
+    def __init__(self, path: str, timeout: float = 10.0):
+        self.path = path
+        self.timeout = timeout
+        # 交出套接字的旧进程PID
+        self.pid = None
+        self._conn = None
+
+    def receive(self) -> Dict[str, socket.socket]:
+        """取得旧进程的监听套接字，返回名称到套接字的映射"""
+        self._conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._conn.settimeout(self.timeout)
+        self._conn.connect(self.path)
+        self._conn.sendall(HANDOFF_REQUEST)
+        payload, fds, _, _ = socket.recv_fds(self._conn, 4096, MAX_FDS)
+        message = json.loads(payload.decode())
+        names = message["names"]
+        self.pid = message.get("pid")
+        if len(names) != len(fds):
+            raise ValueError("Handoff message does not match the received descriptors")
+        logger.info(f"Received listening sockets {names} from the running process")
+        return {name: socket.socket(fileno=fd) for name, fd in zip(names, fds)}
+
+    def ready(self) -> None:
+        """通知旧进程本进程已开始服务"""
+        if self._conn is not None:
+            self._conn.sendall(READY_MESSAGE)
+            self._conn.close()
+            self._conn = None
+
+    async def wait_for_previous(self) -> None:
+        """等待交出套接字的旧进程排空并退出"""
+        if not self.pid:
+            return
+        while _process_alive(self.pid):
+            await asyncio.sleep(EXIT_POLL_INTERVAL)
+
+    def abort(self) -> None:
+        """启动失败时断开，旧进程会继续服务"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
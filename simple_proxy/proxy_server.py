@@ -1,165 +1,664 @@
 import asyncio
 import aiohttp
 from aiohttp import web
+from multidict import CIMultiDict
 import logging
+import socket
 from typing import Optional, Dict
 from .rule_engine import RuleEngine
+from .connections import ConnectionRegistry
+from .relay import CHUNK_SIZE, detach_request_stream, relay
+from .tracing import RequestTracer, create_trace_config
+from .sockets import create_listen_socket
+from .circuit_breaker import CircuitBreakers, CircuitOpen
+from .shaping import TrafficShaper, pace
+from .upstream import (CONNECT_TIMEOUT, InvalidResponse, Socks5Connector, UpstreamUnavailable, connect_to_proxy,
+                       format_authority, is_socks5, open_connection, read_response_body, read_response_head)
+from .auto_route import AutoRouter, DIRECT, FORWARD, PROXY, TUNNEL
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# SSH转发等组件用于端到端探测的请求路径和标记头
+PROBE_PATH = '/__simple_proxy/probe'
+PROBE_HEADER = 'X-Simple-Proxy-Probe'
+# 优雅停止时等待在途连接结束的默认期限（秒）
+DEFAULT_SHUTDOWN_TIMEOUT = 30.0
+# 转发HTTP请求时两次收到上游数据之间允许的最长间隔（秒），不限制整个下载的时长
+READ_IDLE_TIMEOUT = 60.0
+# 排空期间检查剩余连接数的间隔（秒）
+DRAIN_POLL_INTERVAL = 0.1
+# 逐跳头部，只对单个连接有效，不转发
+HOP_BY_HOP_HEADERS = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'
+})
+# Upgrade请求转发给源站时额外去掉的头部，Upgrade和Connection由代理重新生成
+UPGRADE_DROP_HEADERS = HOP_BY_HOP_HEADERS | {'proxy-connection'}
+
+class ClientDisconnected(Exception):
+    """读取客户端请求体或向客户端写响应失败，与上游的健康状况无关"""
+
+
 class ProxyServer:
-    def __init__(self, config, host: str = "127.0.0.1", port: int = 8080):
+    def __init__(self, config, host: str = "127.0.0.1", port: int = 8080, resolver=None):
         self.config = config
         self.rule_engine = RuleEngine(config)
         self.host = host
         self.port = port
-        self.app = web.Application()
+        # 可选的自定义DNS解析器（aiohttp.abc.AbstractResolver），为None时使用aiohttp默认解析
+        self.resolver = resolver
+        self.runner = None
+        # 监听套接字，热重启时交给新进程
+        self.sock = None
+        self._listener = None
+        self.draining = False
+        self.shutdown_timeout = DEFAULT_SHUTDOWN_TIMEOUT
+        # 流量统计
+        self.stats = {"requests": 0, "connects": 0, "upgrades": 0, "socks": 0, "errors": 0, "rejected": 0, "active": 0}
+        # 故障目标和上游的熔断器，熔断期间的请求立即失败
+        self.breakers = CircuitBreakers.from_config(config)
+        # 按客户端、规则和上游限速
+        self.shaper = TrafficShaper.from_config(config)
+        # auto规则按域名学习直连还是经上游代理更快
+        self.auto_router = AutoRouter.from_config(config)
+        # 请求耗时追踪，默认关闭
+        self.tracer = RequestTracer.from_config(config)
+        self._trace_config = create_trace_config()
+        # 活动连接表
+        self.connections = ConnectionRegistry()
+        # 按上游共享的客户端会话，HTTP请求之间复用到源站和上游代理的连接。
+        # 每个键对应 (普通会话, 共用连接器的追踪会话)，只有被采样的请求才经过追踪回调
+        self._sessions: Dict = {}
+        self._sessions_resolver = None
+        self.app = web.Application(middlewares=[self._connect_middleware])
         self.app.router.add_route('*', '/{path:.*}', self.handle_request)
+    
+    @web.middleware
+    async def _connect_middleware(self, request: web.Request, handler):
+        """
+        CONNECT请求的目标是host:port而不是路径，不会匹配任何路由，在这里直接处理；
+        Upgrade请求完成握手后转为原始转发，也不经过普通的请求处理
+        """
+        if request.method == 'CONNECT':
+            return await self.handle_connect(request)
+        if self._is_upgrade(request):
+            return await self.handle_upgrade(request)
+        response = await handler(request)
+        if self.draining:
+            # 排空期间不再保持长连接，让客户端在新连接上改连新进程
+            response.force_close()
+        return response
         
     async def handle_request(self, request: web.Request) -> web.Response:
+        # 探测请求由代理自身应答，不做转发
+        if request.path == PROBE_PATH and PROBE_HEADER in request.headers:
+            return web.Response(status=204)
+        
+        self.stats["requests"] += 1
+        self.stats["active"] += 1
+        trace = self.tracer.start('http', str(request.url), request.remote)
+        status = None
+        record = None
+        response = None
         try:
             # 获取目标URL和客户端信息
-            target_host = request.headers.get('Host', '')
             client_ip = request.remote
             url = str(request.url)
             
-            # 支持CONNECT方法（用于HTTPS代理）
-            if request.method == 'CONNECT':
-                return await self.handle_connect(request)
-            
             # 根据URL和客户端IP确定代理设置
-            proxy_settings = self.rule_engine.get_proxy_for_request(url, client_ip)
+            rule = self.rule_engine.get_rule_for_request(url, client_ip)
+            proxy_settings = self.rule_engine.get_proxy_for_rule(rule)
+            auto = self.rule_engine.is_auto(rule) and proxy_settings is not None
+            if auto:
+                auto_kind = self._auto_kind(proxy_settings)
+                proxy_settings = await self._choose_auto_route(request.url.host, request.url.port, proxy_settings)
+            upstream = self._upstream_label(proxy_settings)
+            if trace is not None:
+                trace.mark('rule')
+                trace.upstream = upstream
+            destination = format_authority(request.url.host, request.url.port)
+            rejection = self.breakers.check(destination, upstream)
+            if rejection:
+                status = 503
+                return self._reject(destination, upstream, rejection)
+            rule_label = self.rule_engine.describe_rule(rule)
+            record = self.connections.open('http', client_ip, destination, rule_label, upstream)
+            limits = self.shaper.flow(client_ip, rule_label, upstream)
             
             logger.info(f"Request: {request.method} {url}, Client: {client_ip}, Proxy: {'direct' if not proxy_settings else proxy_settings.get('host')}")
             
-            # 准备请求头
-            headers = dict(request.headers)
+            # 准备请求头，移除跳跃式头部
+            headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+            
+            if limits.upload and request.can_read_body:
+                # 需要限速时边读边发，否则整体读取
+                data = self._paced_body(request, limits.upload, record)
+            else:
+                data = await self._client_io(request.read())
+                record.bytes_up += len(data)
+                if trace is not None:
+                    trace.mark('request_body')
             
-            # 移除跳跃式头部
-            hop_by_hop = {'Connection', 'Keep-Alive', 'Proxy-Authenticate',
-                         'Proxy-Authorization', 'TE', 'Trailers', 'Transfer-Encoding',
-                         'Upgrade'}
-            for header in hop_by_hop:
-                headers.pop(header, None)
+            # 使用HTTP上游代理时的代理地址，直连或SOCKS5上游（由会话的连接器处理）时为None
+            proxy_url = None
+            if proxy_settings and not is_socks5(proxy_settings):
+                proxy_url = f"http://{proxy_settings['host']}:{proxy_settings['port']}"
             
-            # 创建客户端会话并发送请求
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                if proxy_settings:
-                    # 使用代理
-                    proxy_url = f"http://{proxy_settings['host']}:{proxy_settings['port']}"
-                    async with session.request(
-                        request.method,
-                        url,
-                        headers=headers,
-                        data=await request.read(),
-                        proxy=proxy_url,
-                        ssl=False  # 允许不安全的SSL连接
-                    ) as response:
-                        body = await response.read()
-                        return web.Response(
-                            body=body,
-                            status=response.status,
-                            headers=response.headers
-                        )
-                else:
-                    # 直接连接
-                    async with session.request(
-                        request.method,
-                        url,
-                        headers=headers,
-                        data=await request.read(),
-                        ssl=False  # 允许不安全的SSL连接
-                    ) as response:
-                        body = await response.read()
-                        return web.Response(
-                            body=body,
-                            status=response.status,
-                            headers=response.headers
-                        )
+            # 使用共享的客户端会话发送请求，响应体原样（不解压）流式转发给客户端。
+            # 只限制连接和读取的空闲时间，大文件和慢速下载不会因总时长被中断
+            timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_IDLE_TIMEOUT)
+            session = self._client_session(proxy_settings, traced=trace is not None)
+            responded = False
+            try:
+                async with session.request(
+                    request.method,
+                    url,
+                    headers=headers,
+                    data=data,
+                    proxy=proxy_url,
+                    timeout=timeout,
+                    ssl=False,  # 允许不安全的SSL连接
+                    trace_request_ctx=trace
+                ) as upstream_response:
+                    # 收到响应头即说明目标和上游可用，之后传输中断不计入熔断
+                    responded = True
+                    self.breakers.record_success(destination, upstream)
+                    status = upstream_response.status
+                    response = web.StreamResponse(
+                        status=status,
+                        headers=CIMultiDict(
+                            (k, v) for k, v in upstream_response.headers.items()
+                            if k.lower() not in HOP_BY_HOP_HEADERS)
+                    )
+                    await self._client_io(response.prepare(request))
+                    async for chunk in upstream_response.content.iter_chunked(CHUNK_SIZE):
+                        if limits.download:
+                            await pace(limits.download, len(chunk))
+                        record.bytes_down += len(chunk)
+                        await self._client_io(response.write(chunk))
+                    await self._client_io(response.write_eof())
+            except ClientDisconnected:
+                # 客户端一侧的失败不计入熔断，也不算作上游的成功
+                raise
+            except Exception as e:
+                if not responded:
+                    self.breakers.record_failure(destination, upstream, e)
+                    if auto and isinstance(e, aiohttp.ClientConnectorError):
+                        # 选定的路径连接失败，计入测速结果以便切换
+                        self.auto_router.observe(request.url.host, PROXY if proxy_settings else DIRECT, None, auto_kind)
+                raise
+            if trace is not None:
+                trace.mark('transfer')
+            return response
                         
+        except ClientDisconnected as e:
+            logger.info(f"Client {request.remote} went away during {request.url}: {str(e) or e.__class__.__name__}")
+            if request.transport is not None:
+                request.transport.close()
+            return response if response is not None else web.Response(status=500)
         except Exception as e:
-            logger.error(f"Error handling request {url}: {e}")
-            return web.Response(status=500, text=str(e))
+            self.stats["errors"] += 1
+            status = 500
+            # 超时等异常的str()为空，记录异常类型
+            logger.error(f"Error handling request {request.url}: {str(e) or e.__class__.__name__}")
+            if response is not None and response.prepared:
+                # 响应头已经发出，只能断开连接让客户端知道响应不完整
+                if request.transport is not None:
+                    request.transport.close()
+                return response
+            return web.Response(status=500, text=str(e) or e.__class__.__name__)
+        finally:
+            self.stats["active"] -= 1
+            if record is not None:
+                self.connections.close(record)
+            if trace is not None:
+                self.tracer.finish(trace, status)
     
     async def handle_connect(self, request: web.Request) -> web.Response:
         """处理HTTPS CONNECT请求"""
+        self.stats["connects"] += 1
+        self.stats["active"] += 1
+        trace = self.tracer.start('connect', request.message.path, request.remote)
+        status = None
+        record = None
         try:
-            host_port = request.path_qs
+            # CONNECT的请求目标为authority形式（host:port）
+            host_port = request.message.path
             client_ip = request.remote
+            host, port = host_port.rsplit(':', 1)
+            host = host.strip('[]')
+            port = int(port)
             
-            # 构造URL用于规则匹配
-            url = f"https://{host_port}"
-            proxy_settings = self.rule_engine.get_proxy_for_request(url, client_ip)
-            
-            logger.info(f"CONNECT: {host_port}, Client: {client_ip}, Proxy: {'direct' if not proxy_settings else proxy_settings.get('host')}")
+            # 构造URL用于规则匹配，直连或经上游代理建立到目标服务器的连接
+            try:
+                record, limits, reader, writer = await self.open_tunnel(
+                    'connect', f"CONNECT: {host_port}", f"https://{host_port}", client_ip, host, port, trace)
+            except CircuitOpen as e:
+                status = 503
+                return self._reject(e.destination, e.upstream, e.rejection)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.stats["errors"] += 1
+                status = 502
+                logger.error(f"Failed to establish CONNECT tunnel to {host_port}: {e}")
+                return web.Response(status=502, text=f"Bad Gateway: {e}")
             
-            if proxy_settings:
-                # 通过上游代理建立CONNECT隧道
-                proxy_host = proxy_settings['host']
-                proxy_port = proxy_settings['port']
+            # 返回200 Connection Established
+            transport = request.transport
+            if transport:
+                transport.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
                 
-                # 这里需要实现CONNECT隧道转发逻辑
-                # 为了简化，暂时返回502
-                return web.Response(status=502, text="CONNECT through proxy not implemented yet")
+                # 开始数据转发
+                await self._tunnel_data(request, reader, writer, record, limits)
+                if trace is not None:
+                    trace.mark('tunnel')
             else:
-                # 直接建立CONNECT隧道
-                host, port = host_port.split(':')
-                port = int(port)
-                
-                try:
-                    # 建立到目标服务器的连接
-                    reader, writer = await asyncio.open_connection(host, port)
-                    
-                    # 返回200 Connection Established
-                    transport = request.transport
-                    if transport:
-                        transport.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
-                        
-                        # 开始数据转发
-                        await self._tunnel_data(transport, reader, writer)
-                    
-                    return web.Response(status=200)
-                except Exception as e:
-                    logger.error(f"Failed to establish CONNECT tunnel to {host}:{port}: {e}")
-                    return web.Response(status=502, text=f"Bad Gateway: {e}")
+                writer.close()
+            
+            status = 200
+            return web.Response(status=200)
                     
         except Exception as e:
+            self.stats["errors"] += 1
+            status = 500
             logger.error(f"Error handling CONNECT request: {e}")
             return web.Response(status=500, text=str(e))
+        finally:
+            self.stats["active"] -= 1
+            if record is not None:
+                self.connections.close(record)
+            if trace is not None:
+                self.tracer.finish(trace, status)
     
-    async def _tunnel_data(self, client_transport, target_reader, target_writer):
-        """在客户端和目标服务器之间转发数据"""
+    async def handle_upgrade(self, request: web.Request) -> web.Response:
+        """
+        处理WebSocket等HTTP Upgrade请求：直连或经SOCKS5隧道把握手请求发给源站，经HTTP上游代理时
+        以absolute形式把握手请求发给上游代理（许多代理只允许CONNECT到443）。
+        源站返回101后两侧切换为与CONNECT隧道相同的原始双向转发，不再为每条消息创建HTTP对象
+        """
+        self.stats["upgrades"] += 1
+        self.stats["active"] += 1
+        trace = self.tracer.start('upgrade', str(request.url), request.remote)
+        status = None
+        record = None
         try:
-            # 这是一个简化的隧道实现
-            # 实际生产环境中需要更完善的双向数据转发
-            async def forward_data():
-                while True:
-                    try:
-                        data = await target_reader.read(8192)
-                        if not data:
-                            break
-                        client_transport.write(data)
-                    except Exception:
-                        break
+            url = str(request.url)
+            try:
+                record, limits, proxy_settings, reader, writer = await self._open_route(
+                    'upgrade', f"Upgrade: {request.headers.get('Upgrade')} {url}", url,
+                    request.remote, request.url.host, request.url.port, trace, forward=True)
+            except CircuitOpen as e:
+                status = 503
+                return self._reject(e.destination, e.upstream, e.rejection)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.stats["errors"] += 1
+                status = 502
+                logger.error(f"Failed to connect to {format_authority(request.url.host, request.url.port)} for upgrade: {e}")
+                return web.Response(status=502, text=f"Bad Gateway: {e}")
+            destination, upstream = record.destination, record.upstream
+            
+            try:
+                absolute = proxy_settings is not None and not is_socks5(proxy_settings)
+                writer.write(self._upgrade_request_head(request, absolute))
+                status, headers, head = await read_response_head(reader)
+                while 100 <= status < 200 and status != 101:
+                    # 跳过100 Continue、103 Early Hints等中间响应
+                    status, headers, head = await read_response_head(reader)
+                if status != 101:
+                    # 源站没有同意升级，按普通响应返回并关闭连接
+                    body = await read_response_body(reader, status, headers, request.method)
+            except (OSError, asyncio.TimeoutError, InvalidResponse, ValueError) as e:
+                writer.close()
+                self.breakers.record_failure(destination, upstream, e)
+                self.stats["errors"] += 1
+                status = 502
+                logger.error(f"Upgrade handshake with {destination} failed: {e}")
+                return web.Response(status=502, text=f"Bad Gateway: {e}")
+            self.breakers.record_success(destination, upstream)
+            if trace is not None:
+                trace.mark('handshake')
+            
+            if status != 101:
+                writer.close()
+                record.bytes_down += len(body)
+                response = web.Response(
+                    status=status,
+                    body=body,
+                    headers=CIMultiDict(
+                        (k, v) for k, v in headers.items()
+                        if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != 'content-length')
+                )
+                response.force_close()
+                return response
             
-            await forward_data()
+            # 101响应头原样转发，之后的数据不再经过HTTP解析
+            transport = request.transport
+            if transport is None:
+                writer.close()
+                return web.Response(status=status)
+            transport.write(head)
+            record.bytes_down += len(head)
+            await self._tunnel_data(request, reader, writer, record, limits)
+            if trace is not None:
+                trace.mark('tunnel')
+            return web.Response(status=status)
+        
         except Exception as e:
-            logger.error(f"Error in tunnel data forwarding: {e}")
+            self.stats["errors"] += 1
+            status = 500
+            logger.error(f"Error handling upgrade request {request.url}: {e}")
+            return web.Response(status=500, text=str(e))
         finally:
+            self.stats["active"] -= 1
+            if record is not None:
+                self.connections.close(record)
+            if trace is not None:
+                self.tracer.finish(trace, status)
+    
+    async def open_tunnel(self, kind: str, description: str, url: str, client_ip: Optional[str],
+                          host: str, port: int, trace=None):
+        """
+        按规则为到host:port的原始隧道选路、检查熔断并建立连接，CONNECT、Upgrade和SOCKS5入口共用。
+        返回 (record, limits, reader, writer)，record已登记到连接表，由调用方关闭。
+        熔断时抛出CircuitOpen，连接失败时抛出OSError或TimeoutError
+        """
+        record, limits, _, reader, writer = await self._open_route(
+            kind, description, url, client_ip, host, port, trace)
+        return record, limits, reader, writer
+    
+    async def _open_route(self, kind: str, description: str, url: str, client_ip: Optional[str],
+                          host: str, port: int, trace=None, forward: bool = False):
+        """
+        open_tunnel()的实现，另外返回实际使用的代理设置：(record, limits, proxy_settings, reader, writer)。
+        forward为True时经HTTP上游代理只连到上游代理本身，由调用方以absolute形式发送请求
+        """
+        rule = self.rule_engine.get_rule_for_request(url, client_ip)
+        proxy_settings = self.rule_engine.get_proxy_for_rule(rule)
+        # auto规则：已有测速结果时直接选路，否则同时尝试两条路径
+        auto, route, proxy_settings = self._auto_route(rule, host, proxy_settings, forward)
+        race = auto and route is None
+        upstream = "auto" if race else self._upstream_label(proxy_settings)
+        destination = format_authority(host, port)
+        if trace is not None:
+            trace.mark('rule')
+            trace.upstream = upstream
+        if not race:
+            rejection = self.breakers.check(destination, upstream)
+            if rejection:
+                raise CircuitOpen(destination, upstream, rejection)
+        rule_label = self.rule_engine.describe_rule(rule)
+        record = self.connections.open(kind, client_ip, destination, rule_label, upstream)
+        
+        logger.info(f"{description}, Client: {client_ip}, Proxy: {'direct' if not proxy_settings else proxy_settings.get('host')}")
+        
+        try:
+            proxy_settings, reader, writer = await self._connect_target(
+                host, port, proxy_settings, auto, route, forward)
+        except BaseException:
+            self.connections.close(record)
+            raise
+        upstream = record.upstream = self._upstream_label(proxy_settings)
+        if trace is not None:
+            trace.upstream = upstream
+            trace.mark('connect')
+        return record, self.shaper.flow(client_ip, rule_label, upstream), proxy_settings, reader, writer
+    
+    @staticmethod
+    def _is_upgrade(request: web.Request) -> bool:
+        if 'Upgrade' not in request.headers:
+            return False
+        tokens = request.headers.get('Connection', '').lower().split(',')
+        return any(token.strip() == 'upgrade' for token in tokens)
+    
+    @staticmethod
+    def _upgrade_request_head(request: web.Request, absolute: bool = False) -> bytes:
+        """
+        把客户端的握手请求改写为发给源站的origin形式（absolute为True时为发给HTTP上游代理的absolute形式），
+        保留Upgrade，去掉代理相关的逐跳头部
+        """
+        target = request.url.with_fragment(None) if absolute else request.url.raw_path_qs or '/'
+        lines = [f"{request.method} {target} HTTP/1.1"]
+        for name, value in request.headers.items():
+            if name.lower() not in UPGRADE_DROP_HEADERS:
+                lines.append(f"{name}: {value}")
+        lines.append(f"Upgrade: {request.headers['Upgrade']}")
+        lines.append("Connection: Upgrade")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+    
+    def _auto_route(self, rule: Dict, host: str, proxy_settings: Optional[Dict], forward: bool = False):
+        """
+        返回 (auto, route, proxy_settings)。auto规则已有测速结果时按结果确定代理设置，
+        route为None表示需要同时尝试两条路径
+        """
+        if not (self.rule_engine.is_auto(rule) and proxy_settings is not None):
+            return False, None, proxy_settings
+        route = self.auto_router.lookup(host, self._auto_kind(proxy_settings) if forward else TUNNEL)
+        return True, route, None if route == DIRECT else proxy_settings
+    
+    async def _connect_target(self, host: str, port: int, proxy_settings: Optional[Dict],
+                              auto: bool = False, route: Optional[str] = None, forward: bool = False):
+        """
+        建立供隧道使用的连接，返回 (实际使用的代理设置, reader, writer)。
+        auto规则需要测速时同时尝试直连和上游代理，否则把建连耗时计入测速结果
+        """
+        kind = self._auto_kind(proxy_settings) if forward and proxy_settings else TUNNEL
+        if auto and route is None:
+            route, reader, writer = await self.auto_router.race(
+                host,
+                lambda: self._open_target(host, port),
+                lambda: self._open_target(host, port, proxy_settings, forward),
+                kind)
+            return (None if route == DIRECT else proxy_settings), reader, writer
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            reader, writer = await self._open_target(host, port, proxy_settings, forward)
+        except (OSError, asyncio.TimeoutError):
+            if auto:
+                self.auto_router.observe(host, route, None, kind)
+            raise
+        if auto:
+            self.auto_router.observe(host, route, loop.time() - started, kind)
+        return proxy_settings, reader, writer
+    
+    async def _open_target(self, host: str, port: int, proxy_settings: Optional[Dict] = None,
+                           forward: bool = False):
+        """
+        直连或经上游代理建立到目标的TCP连接，结果计入熔断器。
+        forward为True时经HTTP上游代理只连到上游代理本身，目标是否可达由之后的请求决定
+        """
+        destination = format_authority(host, port)
+        upstream = self._upstream_label(proxy_settings)
+        if forward and proxy_settings and not is_socks5(proxy_settings):
+            try:
+                return await connect_to_proxy(proxy_settings, self.resolver)
+            except UpstreamUnavailable as e:
+                self.breakers.record_failure(destination, upstream, e)
+                raise
+        try:
+            connection = await open_connection(host, port, proxy_settings, self.resolver)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.breakers.record_failure(destination, upstream, e, connect_failed=not proxy_settings)
+            raise
+        self.breakers.record_success(destination, upstream)
+        return connection
+    
+    @staticmethod
+    def _auto_kind(proxy_settings: Dict) -> str:
+        """
+        HTTP请求的测速类别：经SOCKS5上游时与CONNECT隧道一样连到目标，共用隧道的测速结果；
+        经HTTP上游代理转发时只能测到上游代理本身的建连耗时，单独记录
+        """
+        return TUNNEL if is_socks5(proxy_settings) else FORWARD
+    
+    async def _choose_auto_route(self, host: str, port: int, proxy_settings: Dict) -> Optional[Dict]:
+        """为auto规则的HTTP请求选路，返回要使用的代理设置，直连时返回None"""
+        kind = self._auto_kind(proxy_settings)
+        route = self.auto_router.lookup(host, kind)
+        if route is None:
+            # 明文HTTP经HTTP上游代理转发时不使用CONNECT（许多代理只允许CONNECT到443），
+            # 代理一侧按连到上游代理本身的耗时计
+            try:
+                route, _, writer = await self.auto_router.race(
+                    host,
+                    lambda: self._open_target(host, port),
+                    lambda: self._open_target(host, port, proxy_settings, forward=True),
+                    kind)
+                writer.close()
+            except (OSError, asyncio.TimeoutError):
+                # 两条路径都无法建立隧道时交给上游代理转发
+                route = PROXY
+        return None if route == DIRECT else proxy_settings
+    
+    def _client_session(self, proxy_settings: Optional[Dict], traced: bool = False) -> aiohttp.ClientSession:
+        """
+        返回复用连接的客户端会话：直连和HTTP上游代理共用一个，每个SOCKS5上游各用一个。
+        traced为True时返回挂有追踪回调的会话，它与普通会话共用连接池。
+        会话不保存Cookie，避免在不同客户端之间串用
+        """
+        if self._sessions_resolver is not self.resolver:
+            # 替换了解析器（如流量回放）后旧会话的连接不再适用
+            self._discard_sessions()
+            self._sessions_resolver = self.resolver
+        socks = is_socks5(proxy_settings)
+        key = "http"
+        if socks:
+            # 同一SOCKS5代理的不同认证信息各用一个会话
+            key = (self._upstream_label(proxy_settings), proxy_settings.get("username"),
+                   proxy_settings.get("password"))
+        sessions = self._sessions.get(key)
+        if sessions is None or sessions[0].closed:
+            if socks:
+                connector = Socks5Connector(proxy_settings, self.resolver, limit=0)
+            else:
+                connector = aiohttp.TCPConnector(resolver=self.resolver, limit=0)
+            # 未采样的请求不经过追踪回调，省去每个请求的回调开销
+            sessions = self._sessions[key] = (
+                aiohttp.ClientSession(connector=connector,
+                                      cookie_jar=aiohttp.DummyCookieJar(),
+                                      auto_decompress=False),
+                aiohttp.ClientSession(connector=connector,
+                                      connector_owner=False,
+                                      trace_configs=[self._trace_config],
+                                      cookie_jar=aiohttp.DummyCookieJar(),
+                                      auto_decompress=False),
+            )
+        return sessions[1] if traced else sessions[0]
+    
+    async def _close_sessions(self, sessions) -> None:
+        # 追踪会话不拥有连接器，先关闭它，再由普通会话关闭连接器
+        await sessions[1].close()
+        await sessions[0].close()
+    
+    def _discard_sessions(self) -> None:
+        for sessions in self._sessions.values():
+            asyncio.ensure_future(self._close_sessions(sessions))
+        self._sessions.clear()
+    
+    @staticmethod
+    async def _paced_body(request: web.Request, buckets, record):
+        """按限速逐块读取客户端请求体，作为上游请求的流式请求体"""
+        chunks = request.content.iter_chunked(CHUNK_SIZE)
+        while True:
             try:
-                target_writer.close()
-                await target_writer.wait_closed()
-            except Exception:
-                pass
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                raise ClientDisconnected(f"{e.__class__.__name__}: {e}") from e
+            await pace(buckets, len(chunk))
+            record.bytes_up += len(chunk)
+            yield chunk
+    
+    @staticmethod
+    async def _client_io(operation):
+        """等待一次对客户端的读写操作，失败转换为ClientDisconnected"""
+        try:
+            return await operation
+        except Exception as e:
+            raise ClientDisconnected(f"{e.__class__.__name__}: {e}") from e
+    
+    def _reject(self, destination: str, upstream: str, rejection: Dict) -> web.Response:
+        """熔断或负缓存命中时立即返回503，Retry-After提示客户端何时重试"""
+        self.stats["rejected"] += 1
+        logger.warning(f"Fast-failing request to {destination} via {upstream}: {rejection['reason']}")
+        return web.Response(
+            status=503,
+            text=f"Service Unavailable ({rejection['reason']}): {rejection['error']}",
+            headers={'Retry-After': str(rejection['retry_after'])}
+        )
+    
+    @staticmethod
+    def _upstream_label(proxy_settings: Optional[Dict]) -> str:
+        if not proxy_settings:
+            return "direct"
+        return f"{proxy_settings['host']}:{proxy_settings['port']}"
+    
+    def get_stats(self) -> Dict:
+        """获取流量统计"""
+        return dict(self.stats)
+    
+    async def _tunnel_data(self, request: web.Request, target_reader, target_writer, record=None,
+                           limits=None):
+        """在客户端和目标服务器之间双向转发数据"""
+        try:
+            client_reader, client_writer = detach_request_stream(request)
+            await relay(client_reader, client_writer, target_reader, target_writer, record, limits)
+        except Exception as e:
+            logger.error(f"Error in tunnel data forwarding: {e}")
             
-    async def start(self):
-        runner = web.AppRunner(self.app)
-        await runner.setup()
-        site = web.TCPSite(runner, self.host, self.port)
-        await site.start()
+    async def start(self, sock: Optional[socket.socket] = None):
+        """
+        sock: 热重启时从旧进程继承的监听套接字，为None时自行绑定 host:port
+        """
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        if sock is None:
+            sock = create_listen_socket(self.host, self.port)
+        self.sock = sock
+        loop = asyncio.get_running_loop()
+        self._listener = await loop.create_server(self.runner.server, sock=sock)
+        await self.auto_router.start()
+        # 端口为0或继承套接字时以实际监听地址为准
+        self.host, self.port = sock.getsockname()[:2]
         logger.info(f"Proxy server started on http://{self.host}:{self.port}")
+    
+    async def stop(self, timeout: Optional[float] = None):
+        """
+        优雅停止代理服务器：先停止接受新连接，等待在途请求和隧道在期限内结束，
+        超时后关闭剩余连接。timeout为None时使用 shutdown_timeout
+        """
+        if not self.runner:
+            return
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        self.draining = True
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        if len(self.connections):
+            logger.info(f"Draining {len(self.connections)} connections (timeout {timeout}s)")
+        while len(self.connections) and loop.time() < deadline:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        remaining = list(self.connections.records())
+        if remaining:
+            logger.warning(f"Drain deadline reached, closing {len(remaining)} connections")
+            for record in remaining:
+                self.connections.kill(record.id)
+        
+        # 关闭空闲的长连接并等待被取消的处理函数退出
+        await self.runner.server.shutdown(1.0)
+        await self.runner.cleanup()
+        await asyncio.gather(*(self._close_sessions(sessions) for sessions in self._sessions.values()))
+        self._sessions.clear()
+        await self.auto_router.stop()
+        self.runner = None
+        self.sock = None
+        self.draining = False
+        logger.info("Proxy server stopped")
         
     def run(self):
         loop = asyncio.get_event_loop()
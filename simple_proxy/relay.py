@@ -0,0 +1,101 @@
+import asyncio
+
+from aiohttp import streams
+
+from .shaping import pace
+
+# 每次读写的数据块大小
+CHUNK_SIZE = 65536
+
+
+class RequestStreamWriter:
+    """把aiohttp请求的底层连接包装成asyncio.StreamWriter风格的接口，用于隧道转发"""
+
+    def __init__(self, request):
+        self._transport = request.transport
+        self._writer = request.writer
+
+    def write(self, data: bytes) -> None:
+        self._transport.write(data)
+
+    async def drain(self) -> None:
+        await self._writer.drain()
+
+    def can_write_eof(self) -> bool:
+        return self._transport.can_write_eof()
+
+    def is_closing(self) -> bool:
+        return self._transport.is_closing()
+
+    def write_eof(self) -> None:
+        self._transport.write_eof()
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class _StreamFeeder:
+    """
+    作为aiohttp连接的负载解析器，把升级（CONNECT/Upgrade）之后收到的原始数据
+    直接交给StreamReader，用法与aiohttp自身的WebSocket实现相同
+    """
+
+    def __init__(self, reader: streams.StreamReader):
+        self._reader = reader
+
+    def feed_data(self, data: bytes):
+        self._reader.feed_data(data)
+        return False, b""
+
+    def feed_eof(self) -> None:
+        self._reader.feed_eof()
+
+
+def detach_request_stream(request):
+    """接管已升级的客户端连接，返回(reader, writer)，此后原始数据不再经过HTTP解析"""
+    reader = streams.StreamReader(request.protocol, CHUNK_SIZE, loop=asyncio.get_running_loop())
+    request.protocol.set_parser(_StreamFeeder(reader))
+    return reader, RequestStreamWriter(request)
+
+
+async def _pipe(reader, writer, record, counter: str, buckets=()):
+    while True:
+        data = await reader.read(CHUNK_SIZE)
+        if not data:
+            break
+        if buckets:
+            await pace(buckets, len(data))
+        if writer.is_closing():
+            # uvloop在已关闭的连接上写入会抛出RuntimeError而不是静默丢弃，统一按连接断开处理
+            raise ConnectionResetError("Connection lost")
+        writer.write(data)
+        if record is not None:
+            setattr(record, counter, getattr(record, counter) + len(data))
+        await writer.drain()
+    # 一侧读完后半关闭另一侧，允许反方向继续传输
+    if writer.can_write_eof() and not writer.is_closing():
+        writer.write_eof()
+
+
+async def relay(client_reader, client_writer, target_reader, target_writer, record=None,
+                limits=None) -> None:
+    """
+    在客户端和目标之间双向转发数据，直到两个方向都结束或任一方向出错。
+    record为ConnectionRecord时累加bytes_up和bytes_down，limits为FlowLimits时按其限速
+    """
+    upload = limits.upload if limits is not None else ()
+    download = limits.download if limits is not None else ()
+    upstream = asyncio.ensure_future(_pipe(client_reader, target_writer, record, "bytes_up", upload))
+    downstream = asyncio.ensure_future(_pipe(target_reader, client_writer, record, "bytes_down", download))
+    try:
+        await asyncio.gather(upstream, downstream)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        upstream.cancel()
+        downstream.cancel()
+        for writer in (target_writer, client_writer):
+            try:
+                writer.close()
+            except Exception:
+                pass
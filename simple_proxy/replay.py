@@ -0,0 +1,411 @@
+"""
+流量回放模块
+
+读取抓取的请求记录（JSONL，每行一个JSON对象），按原始或缩放后的时间间隔
+通过 ProxyServer 重新发出，由本地替身源站按记录的状态码和响应大小应答，
+最后按规则和上游统计延迟分布。整个过程不访问外部网络，便于对比改动前后的结果。
+替身源站为每个上游代理单独监听一个端口，请求实际经过的上游按到达的端口确定，
+auto规则选路的结果因此如实反映在报告中。
+https记录按客户端的实际行为先向代理发送CONNECT，但替身源站不支持TLS，隧道内发送的是明文HTTP请求，
+延迟包含建立隧道的耗时，不包含TLS握手。
+
+记录字段：
+- url: 请求地址（必填，支持 http://域名 和 https://域名 形式）
+- method: 请求方法，默认 GET
+- status: 源站应答状态码，默认 200
+- size: 源站应答的响应体大小（字节），默认 0
+- request_size: 请求体大小（字节），默认 0
+- ts: 抓取时的时间戳（秒），用于还原请求间隔
+- id: 记录标识，默认使用行号
+"""
+
+import asyncio
+import copy
+import ipaddress
+import json
+import logging
+import math
+import socket
+import time
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+import click
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+from .config import ProxyConfig
+from .proxy_server import ProxyServer
+from .relay import detach_request_stream, relay
+from .upstream import format_authority, read_response_body, read_response_head
+
+logger = logging.getLogger(__name__)
+
+REPLAY_ID_HEADER = 'X-Replay-Id'
+UPSTREAM_HOST_SUFFIX = '.upstream.replay'
+# 这些状态码的响应不能携带响应体
+NO_BODY_STATUSES = {204, 304}
+# 报告中对https记录回放方式的说明
+TUNNEL_NOTE = "https records are replayed as CONNECT plus plain HTTP inside the tunnel; TLS handshakes are not measured"
+
+
+def load_records(path: str) -> List[Dict]:
+    """从JSONL文件加载请求记录，并按时间戳稳定排序"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping malformed record at line {line_no}: {e}")
+                continue
+            records.append({
+                "id": str(data.get("id", line_no)),
+                "method": str(data.get("method", "GET")).upper(),
+                "url": data.get("url", ""),
+                "status": int(data.get("status", 200)),
+                "size": int(data.get("size", 0)),
+                "request_size": int(data.get("request_size", 0)),
+                "ts": float(data.get("ts", 0.0)),
+            })
+    # 稳定排序保证相同时间戳的记录每次回放顺序一致
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def isolate_config(config: ProxyConfig) -> ProxyConfig:
+    """
+    复制配置并把所有上游代理指向替身源站使用的主机名，
+    使经过上游代理的请求同样在本地完成
+    """
+    isolated = copy.copy(config)
+    isolated.config = copy.deepcopy(config.config)
+    isolated._listeners = []
+    # 回放从空白的自动选路结果开始，且不覆盖正式运行保存的结果
+    isolated.config.setdefault("auto_route", {})["cache_file"] = None
+    for name, settings in isolated.config.get("proxy_settings", {}).items():
+        if settings:
+            settings["host"] = f"{name}{UPSTREAM_HOST_SUFFIX}"
+            # 替身源站只能充当HTTP代理
+            settings["type"] = "http"
+    return isolated
+
+
+def _skip_reason(record: Dict) -> Optional[str]:
+    """返回记录无法离线回放的原因，可回放时返回None"""
+    parsed = urlparse(record["url"])
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "unsupported_url"
+    try:
+        # IP地址不经过解析器，会直接连到真实地址
+        ipaddress.ip_address(parsed.hostname)
+        return "ip_literal"
+    except ValueError:
+        return None
+
+
+def _upstream_label(proxy_settings: Optional[Dict]) -> str:
+    if not proxy_settings:
+        return "direct"
+    host = proxy_settings.get("host", "")
+    if host.endswith(UPSTREAM_HOST_SUFFIX):
+        return host[:-len(UPSTREAM_HOST_SUFFIX)]
+    return f"{host}:{proxy_settings.get('port')}"
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    index = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def _summarize(results: List[Dict]) -> Dict:
+    latencies = sorted(r["latency"] * 1000 for r in results if r["latency"] is not None)
+    summary = {
+        "count": len(results),
+        "errors": sum(1 for r in results if r.get("error")),
+        "mismatches": sum(1 for r in results if not r.get("error") and not r["ok"]),
+    }
+    if latencies:
+        summary.update({
+            "min_ms": round(latencies[0], 3),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "p50_ms": round(_percentile(latencies, 50), 3),
+            "p90_ms": round(_percentile(latencies, 90), 3),
+            "p99_ms": round(_percentile(latencies, 99), 3),
+            "max_ms": round(latencies[-1], 3),
+        })
+    return summary
+
+
+class ReplayResolver(AbstractResolver):
+    """把所有主机名解析到本地替身源站，上游代理的主机名解析到各自的端口"""
+
+    def __init__(self, port: int, host: str = "127.0.0.1", upstream_ports: Optional[Dict[str, int]] = None):
+        self.host = host
+        self.port = port
+        self.upstream_ports = upstream_ports or {}
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        name = host[:-len(UPSTREAM_HOST_SUFFIX)] if host.endswith(UPSTREAM_HOST_SUFFIX) else None
+        return [{
+            "hostname": host,
+            "host": self.host,
+            "port": self.upstream_ports.get(name, self.port),
+            "family": socket.AF_INET,
+            "proto": 0,
+            "flags": socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self) -> None:
+        pass
+
+
+class StandInOrigin:
+    """
+    本地替身源站：按记录中的状态码和响应大小应答，同时充当上游代理。
+    源站和每个上游代理各监听一个端口，routes记录每个请求到达的端口对应的路径（direct或上游名称）
+    """
+
+    def __init__(self, records: List[Dict], upstreams: Iterable[str] = (), host: str = "127.0.0.1",
+                 port: int = 0):
+        self.records = {r["id"]: r for r in records}
+        self.upstreams = list(upstreams)
+        self.host = host
+        self.port = port
+        # 上游名称 -> 监听端口
+        self.upstream_ports: Dict[str, int] = {}
+        # 回放记录ID -> 请求实际经过的路径
+        self.routes: Dict[str, str] = {}
+        self._labels: Dict[int, str] = {}
+        self.runner = None
+        self.app = web.Application(middlewares=[self._connect_middleware])
+        self.app.router.add_route('*', '/{path:.*}', self.handle_request)
+
+    @web.middleware
+    async def _connect_middleware(self, request: web.Request, handler):
+        """CONNECT请求连回收到它的端口，隧道内的请求同样按该上游统计"""
+        if request.method != 'CONNECT':
+            return await handler(request)
+        port = request.transport.get_extra_info('sockname')[1]
+        reader, writer = await asyncio.open_connection(self.host, port)
+        request.transport.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+        client_reader, client_writer = detach_request_stream(request)
+        await relay(client_reader, client_writer, reader, writer)
+        return web.Response(status=200)
+
+    async def handle_request(self, request: web.Request) -> web.Response:
+        await request.read()
+        record_id = request.headers.get(REPLAY_ID_HEADER, '')
+        record = self.records.get(record_id)
+        if record is None:
+            return web.Response(status=404, text="Unknown replay record")
+        self.routes[record_id] = self._labels.get(request.transport.get_extra_info('sockname')[1], "direct")
+        if record["status"] in NO_BODY_STATUSES or request.method == 'HEAD':
+            return web.Response(status=record["status"])
+        return web.Response(status=record["status"], body=bytes(record["size"]))
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        for name in self.upstreams:
+            site = web.TCPSite(self.runner, self.host, 0)
+            await site.start()
+            port = self.runner.addresses[-1][1]
+            self.upstream_ports[name] = port
+            self._labels[port] = name
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class TrafficReplayer:
+    def __init__(self, records: List[Dict], speed: float = 1.0, concurrency: int = 64,
+                 timeout: float = 30):
+        """
+        speed: 时间缩放倍数，2表示以两倍速回放，小于等于0表示不等待原始间隔
+        concurrency: 同时在途的最大请求数
+        """
+        self.records = records
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def run(self, proxy_server: ProxyServer) -> Dict:
+        """对已启动的代理服务器回放记录并返回统计报告"""
+        skipped = {}
+        replayable = []
+        for record in self.records:
+            reason = _skip_reason(record)
+            if reason:
+                skipped[reason] = skipped.get(reason, 0) + 1
+            else:
+                replayable.append(record)
+
+        upstreams = [name for name, settings in
+                     (proxy_server.config.config.get("proxy_settings") or {}).items() if settings]
+        origin = StandInOrigin(replayable, upstreams)
+        await origin.start()
+        previous_resolver = proxy_server.resolver
+        proxy_server.resolver = ReplayResolver(origin.port, upstream_ports=origin.upstream_ports)
+        started = time.perf_counter()
+        try:
+            results = await self._replay(proxy_server, origin, replayable)
+        finally:
+            proxy_server.resolver = previous_resolver
+            await origin.stop()
+        duration = time.perf_counter() - started
+
+        return self._build_report(results, skipped, duration)
+
+    async def _replay(self, proxy_server: ProxyServer, origin: StandInOrigin,
+                      records: List[Dict]) -> List[Dict]:
+        if not records:
+            return []
+        proxy_url = f"http://{proxy_server.host}:{proxy_server.port}"
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        base_ts = records[0]["ts"]
+        start = loop.time()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            tasks = []
+            for record in records:
+                if self.speed > 0:
+                    delay = start + (record["ts"] - base_ts) / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(
+                    self._issue(session, proxy_server, origin, proxy_url, record, semaphore)))
+            return await asyncio.gather(*tasks)
+
+    async def _issue(self, session: aiohttp.ClientSession, proxy_server: ProxyServer,
+                     origin: StandInOrigin, proxy_url: str, record: Dict,
+                     semaphore: asyncio.Semaphore) -> Dict:
+        # 代理看到的客户端地址是本机，按相同条件计算规则
+        rule_engine = proxy_server.rule_engine
+        rule = rule_engine.get_rule_for_request(record["url"], "127.0.0.1")
+        result = {
+            "rule": rule_engine.describe_rule(rule),
+            "latency": None,
+            "ok": False,
+            "tunnelled": urlparse(record["url"]).scheme == "https",
+        }
+        data = bytes(record["request_size"]) if record["request_size"] else None
+
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if result["tunnelled"]:
+                    status, body = await asyncio.wait_for(
+                        self._request_in_tunnel(proxy_server, record, data), self.timeout)
+                else:
+                    async with session.request(
+                        record["method"],
+                        record["url"],
+                        headers={REPLAY_ID_HEADER: record["id"]},
+                        data=data,
+                        proxy=proxy_url
+                    ) as response:
+                        status, body = response.status, await response.read()
+                result["latency"] = time.perf_counter() - started
+                result["ok"] = status == record["status"] and (
+                    record["method"] == 'HEAD' or record["status"] in NO_BODY_STATUSES
+                    or len(body) == record["size"])
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                result["error"] = str(e) or e.__class__.__name__
+        # 以替身源站实际收到请求的路径为准，请求没有到达时按规则推算
+        upstream = origin.routes.pop(record["id"], None)
+        if upstream is None:
+            upstream = _upstream_label(rule_engine.get_proxy_for_request(record["url"], "127.0.0.1"))
+        result["upstream"] = upstream
+        return result
+
+    @staticmethod
+    async def _request_in_tunnel(proxy_server: ProxyServer, record: Dict, data: Optional[bytes]):
+        """经代理的CONNECT隧道发送明文请求，返回 (状态码, 响应体)"""
+        parsed = urlparse(record["url"])
+        authority = format_authority(parsed.hostname, parsed.port or 443)
+        reader, writer = await asyncio.open_connection(proxy_server.host, proxy_server.port)
+        try:
+            writer.write(f"CONNECT {authority} HTTP/1.1\r\nHost: {authority}\r\n\r\n".encode())
+            status, _, head = await read_response_head(reader)
+            if status != 200:
+                # 代理拒绝建立隧道（熔断、连接失败等），按代理的应答计
+                return status, b""
+            path = parsed.path or "/"
+            if parsed.query:
+                path = f"{path}?{parsed.query}"
+            request_head = (f"{record['method']} {path} HTTP/1.1\r\n"
+                            f"Host: {parsed.netloc}\r\n"
+                            f"{REPLAY_ID_HEADER}: {record['id']}\r\n"
+                            f"Content-Length: {len(data or b'')}\r\n"
+                            f"Connection: close\r\n\r\n")
+            writer.write(request_head.encode() + (data or b""))
+            status, headers, _ = await read_response_head(reader)
+            body = await read_response_body(reader, status, headers, record["method"])
+            return status, body
+        finally:
+            writer.close()
+
+    def _build_report(self, results: List[Dict], skipped: Dict, duration: float) -> Dict:
+        by_rule = {}
+        by_upstream = {}
+        tunnelled = sum(1 for result in results if result["tunnelled"])
+        for result in results:
+            by_rule.setdefault(result["rule"], []).append(result)
+            by_upstream.setdefault(result["upstream"], []).append(result)
+
+        report = {
+            "total": len(self.records),
+            "replayed": len(results),
+            "skipped": skipped,
+            "duration_s": round(duration, 3),
+            "overall": _summarize(results),
+            "by_rule": {label: _summarize(items) for label, items in sorted(by_rule.items())},
+            "by_upstream": {label: _summarize(items) for label, items in sorted(by_upstream.items())},
+        }
+        if tunnelled:
+            report["tunnelled"] = tunnelled
+            report["note"] = TUNNEL_NOTE
+        return report
+
+
+@click.command()
+@click.argument('records_path')
+@click.option('--config', default='config.yaml', help='配置文件路径')
+@click.option('--speed', default=1.0, help='时间缩放倍数，0表示不按原始间隔等待')
+@click.option('--concurrency', default=64, help='最大并发请求数')
+@click.option('--output', default=None, help='报告输出文件（JSON），默认打印到标准输出')
+def main(records_path, config, speed, concurrency, output):
+    """离线回放抓取的请求记录并输出延迟报告"""
+    records = load_records(records_path)
+    config_obj = isolate_config(ProxyConfig(config))
+
+    async def run():
+        proxy_server = ProxyServer(config_obj, '127.0.0.1', 0)
+        await proxy_server.start()
+        try:
+            return await TrafficReplayer(records, speed, concurrency).run(proxy_server)
+        finally:
+            await proxy_server.stop()
+
+    report = json.dumps(asyncio.run(run()), indent=2, ensure_ascii=False)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,28 +6,50 @@ class RuleEngine:
     def __init__(self, config):
         self.config = config
         self._compile_rules()
+        # 规则通过Web界面变更后重新编译
+        if hasattr(config, "add_listener"):
+            config.add_listener(self._on_config_event)
+    
+    def _on_config_event(self, event: str, data: Dict):
+        # 增删单条规则时只编译或移除这一条，其他配置变更不影响已编译的规则
+        if event == "rule_added":
+            self.compiled_rules.append(self._compile_rule(data["rule"]))
+        elif event == "rule_removed":
+            self.compiled_rules.pop(data["id"])
+        elif event == "rules_reset":
+            self._compile_rules()
+            return
+        else:
+            return
+        if len(self.compiled_rules) != data.get("total"):
+            # 与配置中的规则对不上（如绕过事件直接修改了规则列表）时全部重新编译
+            self._compile_rules()
         
     def _compile_rules(self):
-        self.compiled_rules = []
-        for rule in self.config.get_rules():
-            try:
-                # 支持通配符模式转换为正则表达式
-                pattern_str = rule["pattern"]
-                if rule.get("type") == "domain":
-                    # 域名匹配，支持 *.example.com 格式
-                    pattern_str = pattern_str.replace("*", ".*").replace(".", r"\.")
-                    pattern_str = f"^{pattern_str}$"
-                pattern = re.compile(pattern_str)
-                self.compiled_rules.append((pattern, rule))
-            except re.error:
-                print(f"Invalid regex pattern: {rule['pattern']}")
+        # 与配置中的规则一一对应，通过规则的索引增删
+        self.compiled_rules = [self._compile_rule(rule) for rule in self.config.get_rules()]
+    
+    @staticmethod
+    def _compile_rule(rule: Dict):
+        """返回 (pattern, rule)，模式无效时pattern为None，该规则不参与匹配"""
+        try:
+            # 支持通配符模式转换为正则表达式
+            pattern_str = rule["pattern"]
+            if rule.get("type") == "domain":
+                # 域名匹配，支持 *.example.com 格式
+                pattern_str = pattern_str.replace("*", ".*").replace(".", r"\.")
+                pattern_str = f"^{pattern_str}$"
+            return re.compile(pattern_str), rule
+        except re.error:
+            print(f"Invalid regex pattern: {rule['pattern']}")
+            return None, rule
     
     def evaluate_domain(self, domain: str) -> Dict:
         """
         基于域名评估规则并返回匹配的动作
         """
         for pattern, rule in self.compiled_rules:
-            if rule.get("type") == "domain" and pattern.match(domain):
+            if pattern is not None and rule.get("type") == "domain" and pattern.match(domain):
                 return rule
                 
         # 如果没有规则匹配，返回默认模式
@@ -38,15 +60,15 @@ class RuleEngine:
         基于IP地址评估规则并返回匹配的动作
         """
         for pattern, rule in self.compiled_rules:
-            if rule.get("type") == "ip" and pattern.match(ip):
+            if pattern is not None and rule.get("type") == "ip" and pattern.match(ip):
                 return rule
                 
         # 如果没有规则匹配，返回默认模式
         return {"action": self.config.config["default_mode"]}
     
-    def get_proxy_for_request(self, url: str, client_ip: str = None) -> Optional[Dict]:
+    def get_rule_for_request(self, url: str, client_ip: str = None) -> Dict:
         """
-        根据URL和客户端IP获取代理配置
+        根据URL和客户端IP获取匹配的规则
         """
         parsed_url = urlparse(url)
         domain = parsed_url.hostname or parsed_url.netloc
@@ -55,24 +77,52 @@ class RuleEngine:
         if domain:
             rule = self.evaluate_domain(domain)
             if rule.get("action") != self.config.config["default_mode"]:
-                return self._get_proxy_from_rule(rule)
+                return rule
         
         # 如果域名匹配失败，尝试IP匹配
         if client_ip:
-            rule = self.evaluate_ip(client_ip)
-            return self._get_proxy_from_rule(rule)
+            return self.evaluate_ip(client_ip)
         
         # 使用默认规则
-        default_rule = {"action": self.config.config["default_mode"]}
-        return self._get_proxy_from_rule(default_rule)
+        return {"action": self.config.config["default_mode"]}
+    
+    def get_proxy_for_request(self, url: str, client_ip: str = None) -> Optional[Dict]:
+        """
+        根据URL和客户端IP获取代理配置
+        """
+        rule = self.get_rule_for_request(url, client_ip)
+        return self._get_proxy_from_rule(rule)
+    
+    def get_proxy_for_rule(self, rule: Dict) -> Optional[Dict]:
+        """
+        获取规则对应的代理配置，直连时返回None
+        """
+        return self._get_proxy_from_rule(rule)
+    
+    @staticmethod
+    def is_auto(rule: Dict) -> bool:
+        """
+        auto规则由代理服务器按测速结果在直连和上游代理之间选择，
+        get_proxy_for_rule 返回其候选上游
+        """
+        return rule.get("action") == "auto"
+    
+    @staticmethod
+    def describe_rule(rule: Dict) -> str:
+        """
+        返回规则的可读标识，用于日志和统计
+        """
+        if "pattern" in rule:
+            return rule["pattern"]
+        return f"default:{rule.get('action')}"
     
     def _get_proxy_from_rule(self, rule: Dict) -> Optional[Dict]:
         """
         从规则中获取代理配置
         """
-        if rule["action"] == "proxy" and "proxy" in rule:
+        if rule["action"] in ("proxy", "auto") and "proxy" in rule:
             return self.config.get_proxy_settings(rule["proxy"])
-        elif rule["action"] == "proxy":
+        elif rule["action"] in ("proxy", "auto"):
             return self.config.get_proxy_settings()
         return None
     
@@ -0,0 +1,180 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+
+
+class TokenBucket:
+    """
+    令牌桶限速，速率单位为字节/秒。
+
+    reserve() 立即扣除令牌，允许余额为负，返回需要等待的时间。后到的数据块看到更大的欠额，
+    等待时间也更长，因此共享同一个桶的连接按到达顺序轮流发送：每个连接同一时间最多只有
+    一个数据块在等待，空闲带宽在活跃连接之间平均分配，小数据块（交互流量）也不会排在大块后面太久
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, size: int, now: float) -> float:
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens = tokens - size
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        """空闲到令牌完全恢复时，丢弃该桶与保留它没有区别"""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+    def to_dict(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(min(self.burst, self.tokens + (now - self.updated) * self.rate)),
+        }
+
+
+async def pace(buckets: Sequence[TokenBucket], size: int) -> None:
+    """
+    按所有桶中最严格的一个限速发送size字节。
+    未超限时不创建定时器，只有真正需要等待时才sleep
+    """
+    now = time.monotonic()
+    delay = 0.0
+    for bucket in buckets:
+        delay = max(delay, bucket.reserve(size, now))
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class FlowLimits:
+    """单个连接上传和下载方向各自需要经过的令牌桶"""
+    __slots__ = ("upload", "download")
+
+    def __init__(self, upload: Tuple[TokenBucket, ...] = (), download: Tuple[TokenBucket, ...] = ()):
+        self.upload = upload
+        self.download = download
+
+
+UNLIMITED = FlowLimits()
+
+# 令牌桶数量上限，超出时按最近使用顺序淘汰
+MAX_BUCKETS = 10000
+# 每创建一个桶时检查的最久未用桶数量，令牌已恢复满的桶被回收
+EVICT_CHECKS = 2
+
+
+class TrafficShaper:
+    """
+    按客户端IP、规则和上游限速，同一对象的所有连接共享令牌桶。
+    上传和下载方向分别计量，限速值相同
+    """
+
+    def __init__(self, per_client: float = 0, clients: Optional[Dict] = None,
+                 rules: Optional[Dict] = None, upstreams: Optional[Dict] = None,
+                 burst_seconds: float = 1.0, max_buckets: int = MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        # (类型, 对象, 方向) -> 令牌桶。桶在连接之间保留，前后相继的请求共享同一余额（包括欠额）
+        self._buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self.configure(per_client, clients, rules, upstreams, burst_seconds)
+
+    @classmethod
+    def from_config(cls, config) -> "TrafficShaper":
+        shaper = cls(**cls._settings(config))
+        if hasattr(config, "add_listener"):
+            # 通过Web界面修改配置后重新加载限速设置
+            def reload(event: str, data: Dict):
+                if event in ("config_changed", "rules_reset"):
+                    shaper.configure(**cls._settings(config))
+            config.add_listener(reload)
+        return shaper
+
+    @staticmethod
+    def _settings(config) -> Dict:
+        settings = config.config.get("rate_limits") or {}
+        proxy_settings = config.config.get("proxy_settings") or {}
+        upstreams = {}
+        for name, rate in (settings.get("upstreams") or {}).items():
+            # 上游可以用代理名称或 host:port 指定，统一转换为连接表中的上游标识
+            proxy = proxy_settings.get(name)
+            key = f"{proxy['host']}:{proxy['port']}" if proxy else name
+            upstreams[key] = rate
+        return {
+            "per_client": settings.get("per_client", 0),
+            "clients": settings.get("clients"),
+            "rules": settings.get("rules"),
+            "upstreams": upstreams,
+            "burst_seconds": settings.get("burst_seconds", 1.0),
+        }
+
+    def configure(self, per_client: float = 0, clients: Optional[Dict] = None,
+                  rules: Optional[Dict] = None, upstreams: Optional[Dict] = None,
+                  burst_seconds: float = 1.0) -> None:
+        """更新限速设置，已建立的连接继续使用原有的令牌桶，限速值不变的桶保留余额"""
+        self.per_client = per_client or 0
+        self.clients = dict(clients or {})
+        self.rules = dict(rules or {})
+        self.upstreams = dict(upstreams or {})
+        self.burst_seconds = burst_seconds
+        self.enabled = bool(self.per_client or self.clients or self.rules or self.upstreams)
+
+    def _bucket(self, kind: str, key: str, direction: str, rate: float) -> TokenBucket:
+        bucket_key = (kind, key, direction)
+        bucket = self._buckets.get(bucket_key)
+        burst = rate * self.burst_seconds
+        if bucket is not None and bucket.rate == rate and bucket.burst == burst:
+            self._buckets.move_to_end(bucket_key)
+            return bucket
+        bucket = self._buckets[bucket_key] = TokenBucket(rate, burst)
+        self._buckets.move_to_end(bucket_key)
+        self._evict(time.monotonic())
+        return bucket
+
+    def _evict(self, now: float) -> None:
+        """回收令牌已恢复满的空闲桶；仍在计费的桶移到队尾，数量超出上限时才强制淘汰"""
+        for _ in range(min(EVICT_CHECKS, len(self._buckets) - 1)):
+            bucket_key, bucket = next(iter(self._buckets.items()))
+            if bucket.is_full(now):
+                del self._buckets[bucket_key]
+            else:
+                self._buckets.move_to_end(bucket_key)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+
+    def flow(self, client: Optional[str], rule: str, upstream: str) -> FlowLimits:
+        """返回一个连接需要经过的令牌桶，没有任何限速时返回UNLIMITED"""
+        if not self.enabled:
+            return UNLIMITED
+        limits = []
+        client_rate = self.clients.get(client, self.per_client)
+        if client_rate:
+            limits.append(("client", client, client_rate))
+        if self.rules.get(rule):
+            limits.append(("rule", rule, self.rules[rule]))
+        if self.upstreams.get(upstream):
+            limits.append(("upstream", upstream, self.upstreams[upstream]))
+        if not limits:
+            return UNLIMITED
+        return FlowLimits(
+            tuple(self._bucket(kind, key, "up", rate) for kind, key, rate in limits),
+            tuple(self._bucket(kind, key, "down", rate) for kind, key, rate in limits),
+        )
+
+    def snapshot(self) -> Dict:
+        active = {}
+        for (kind, key, direction), bucket in list(self._buckets.items()):
+            active.setdefault(f"{kind}:{key}", {})[direction] = bucket.to_dict()
+        return {
+            "enabled": self.enabled,
+            "per_client": self.per_client,
+            "clients": self.clients,
+            "rules": self.rules,
+            "upstreams": self.upstreams,
+            "burst_seconds": self.burst_seconds,
+            "active": active,
+        }
@@ -0,0 +1,18 @@
+"""
+监听套接字
+
+代理、Web界面和SOCKS5监听入口自行创建并持有监听套接字，热重启时才能交给新进程。
+"""
+
+import socket
+
+# 监听队列长度，与aiohttp的默认值一致
+LISTEN_BACKLOG = 128
+
+
+def create_listen_socket(host: str, port: int) -> socket.socket:
+    """创建TCP监听套接字。由调用方持有套接字，以便热重启时交给新进程"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=LISTEN_BACKLOG)
+    sock.setblocking(False)
+    return sock
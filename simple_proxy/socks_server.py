@@ -0,0 +1,159 @@
+"""
+SOCKS5监听入口
+
+SOCKS5客户端直接给出目标地址，代理不需要解析和改写HTTP头部。目标按与HTTP代理相同的规则、
+自动选路、熔断和限速处理，建立连接后使用与CONNECT隧道相同的原始转发，并登记在同一个连接表中。
+只支持无认证方式和CONNECT命令。
+"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+from typing import Optional
+
+from .circuit_breaker import CircuitOpen
+from .sockets import create_listen_socket
+from .relay import relay
+from .upstream import (SOCKS_ATYP_DOMAIN, SOCKS_ATYP_IPV4, SOCKS_ATYP_IPV6, SOCKS_CMD_CONNECT,
+                       SOCKS_NO_ACCEPTABLE, SOCKS_NO_AUTH, SOCKS_REPLY_ADDRESS_NOT_SUPPORTED,
+                       SOCKS_REPLY_COMMAND_NOT_SUPPORTED, SOCKS_REPLY_CONNECTION_REFUSED,
+                       SOCKS_REPLY_FAILURE, SOCKS_REPLY_HOST_UNREACHABLE, SOCKS_REPLY_MESSAGES,
+                       SOCKS_REPLY_SUCCEEDED, SOCKS_VERSION, TunnelRefused, encode_socks_address,
+                       format_authority)
+
+logger = logging.getLogger(__name__)
+
+# 客户端完成SOCKS5握手的期限（秒）
+HANDSHAKE_TIMEOUT = 10.0
+
+
+class SocksProtocolError(Exception):
+    """客户端发送的SOCKS5请求无效或不受支持"""
+
+
+def _reply(code: int) -> bytes:
+    # 绑定地址对CONNECT没有实际用途，按惯例返回0.0.0.0:0
+    return bytes([SOCKS_VERSION, code, 0]) + encode_socks_address("0.0.0.0", 0)
+
+
+def _reply_code(error: BaseException) -> int:
+    """把建连失败的异常转换为SOCKS5应答码"""
+    if isinstance(error, TunnelRefused) and error.status in SOCKS_REPLY_MESSAGES:
+        # 上游SOCKS5代理的应答码原样返回
+        return error.status
+    if isinstance(error, ConnectionRefusedError):
+        return SOCKS_REPLY_CONNECTION_REFUSED
+    if isinstance(error, (socket.gaierror, asyncio.TimeoutError)):
+        return SOCKS_REPLY_HOST_UNREACHABLE
+    return SOCKS_REPLY_FAILURE
+
+
+class Socks5Server:
+    def __init__(self, proxy_server, host: str = "127.0.0.1", port: int = 1080):
+        """proxy_server: 提供规则、熔断、限速和连接表的ProxyServer"""
+        self.proxy_server = proxy_server
+        self.host = host
+        self.port = port
+        # 监听套接字，热重启时交给新进程
+        self.sock = None
+        self._listener = None
+
+    async def start(self, sock: Optional[socket.socket] = None):
+        """sock: 热重启时从旧进程继承的监听套接字，为None时自行绑定 host:port"""
+        if sock is None:
+            sock = create_listen_socket(self.host, self.port)
+        self.sock = sock
+        self._listener = await asyncio.start_server(self._handle_client, sock=sock)
+        self.host, self.port = sock.getsockname()[:2]
+        logger.info(f"SOCKS5 listener started on {self.host}:{self.port}")
+
+    async def stop(self):
+        """停止接受新连接，已建立的隧道由代理服务器随其他连接一起排空"""
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        self.sock = None
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """完成方法协商并读取CONNECT请求，返回目标 (host, port)"""
+        version, count = await reader.readexactly(2)
+        if version != SOCKS_VERSION:
+            raise SocksProtocolError(f"Unsupported SOCKS version {version}")
+        methods = await reader.readexactly(count)
+        if SOCKS_NO_AUTH not in methods:
+            writer.write(bytes([SOCKS_VERSION, SOCKS_NO_ACCEPTABLE]))
+            raise SocksProtocolError("Client offers no supported authentication method")
+        writer.write(bytes([SOCKS_VERSION, SOCKS_NO_AUTH]))
+
+        version, command, _, atyp = await reader.readexactly(4)
+        if atyp == SOCKS_ATYP_IPV4:
+            host = str(ipaddress.IPv4Address(await reader.readexactly(4)))
+        elif atyp == SOCKS_ATYP_IPV6:
+            host = str(ipaddress.IPv6Address(await reader.readexactly(16)))
+        elif atyp == SOCKS_ATYP_DOMAIN:
+            length = (await reader.readexactly(1))[0]
+            try:
+                host = (await reader.readexactly(length)).decode("idna")
+            except UnicodeError:
+                writer.write(_reply(SOCKS_REPLY_ADDRESS_NOT_SUPPORTED))
+                raise SocksProtocolError("Invalid domain name")
+        else:
+            writer.write(_reply(SOCKS_REPLY_ADDRESS_NOT_SUPPORTED))
+            raise SocksProtocolError(f"Unsupported address type {atyp}")
+        port = int.from_bytes(await reader.readexactly(2), "big")
+        if command != SOCKS_CMD_CONNECT:
+            writer.write(_reply(SOCKS_REPLY_COMMAND_NOT_SUPPORTED))
+            raise SocksProtocolError(f"Unsupported SOCKS command {command}")
+        return host, port
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        proxy = self.proxy_server
+        client_ip = (writer.get_extra_info("peername") or ("-",))[0]
+        try:
+            host, port = await asyncio.wait_for(self._handshake(reader, writer), HANDSHAKE_TIMEOUT)
+        except (SocksProtocolError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+            logger.warning(f"SOCKS5 handshake with {client_ip} failed: {e or e.__class__.__name__}")
+            writer.close()
+            return
+
+        proxy.stats["socks"] += 1
+        proxy.stats["active"] += 1
+        authority = format_authority(host, port)
+        trace = proxy.tracer.start('socks', authority, client_ip)
+        status = None
+        record = None
+        try:
+            try:
+                record, limits, target_reader, target_writer = await proxy.open_tunnel(
+                    'socks', f"SOCKS5: {authority}", f"https://{authority}", client_ip, host, port, trace)
+            except CircuitOpen as e:
+                proxy.stats["rejected"] += 1
+                status = 503
+                logger.warning(f"Fast-failing SOCKS5 request to {e.destination} via {e.upstream}: {e.rejection['reason']}")
+                unreachable = e.rejection["reason"] == "unreachable"
+                writer.write(_reply(SOCKS_REPLY_HOST_UNREACHABLE if unreachable else SOCKS_REPLY_FAILURE))
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                proxy.stats["errors"] += 1
+                status = 502
+                logger.error(f"Failed to establish SOCKS5 tunnel to {authority}: {e}")
+                writer.write(_reply(_reply_code(e)))
+                return
+
+            writer.write(_reply(SOCKS_REPLY_SUCCEEDED))
+            await relay(reader, writer, target_reader, target_writer, record, limits)
+            if trace is not None:
+                trace.mark('tunnel')
+            status = 200
+        except Exception as e:
+            proxy.stats["errors"] += 1
+            status = 500
+            logger.error(f"Error handling SOCKS5 connection to {authority}: {e}")
+        finally:
+            proxy.stats["active"] -= 1
+            writer.close()
+            if record is not None:
+                proxy.connections.close(record)
+            if trace is not None:
+                proxy.tracer.finish(trace, status)
@@ -1,30 +1,84 @@
 import asyncio
 import subprocess
 import logging
+import random
 from typing import List, Dict, Optional
 import os
 import signal
 
+from .proxy_server import PROBE_PATH, PROBE_HEADER
+
 logger = logging.getLogger(__name__)
 
+# 端到端探测请求：经隧道发给本地服务，任何HTTP响应都视为隧道存活
+PROBE_REQUEST = (
+    f"GET {PROBE_PATH} HTTP/1.1\r\n"
+    f"Host: localhost\r\n"
+    f"{PROBE_HEADER}: 1\r\n"
+    f"Connection: close\r\n\r\n"
+).encode()
+
 class SSHForwarder:
-    def __init__(self, config):
+    def __init__(self, config, backoff_base: float = 1.0, backoff_max: float = 60.0):
         self.config = config
-        self.forwarding_processes = {}  # 存储SSH进程
-        
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.desired = {}  # 期望运行的转发：名称 -> 配置
+        self.forwarding_processes = {}  # 实际运行的SSH进程
+        self.supervisors = {}  # 名称 -> 监督任务
+        self.health = {}  # 名称 -> 重启次数和探测结果
+        self.multiplexer = self._create_multiplexer()
+
+    def _create_multiplexer(self):
+        """ssh_backend为asyncssh时使用进程内复用连接，否则每个转发启动一个ssh进程"""
+        if self.config.config.get("ssh_backend", "subprocess") != "asyncssh":
+            return None
+        try:
+            from .ssh_mux import SSHMultiplexer
+        except ImportError:
+            logger.warning("未安装asyncssh，SSH转发回退到ssh子进程方式")
+            return None
+        return SSHMultiplexer(self.backoff_base, self.backoff_max)
+
     def get_ssh_configs(self) -> List[Dict]:
         """获取SSH转发配置"""
         return self.config.config.get("ssh_forwarding", [])
-    
+
+    @staticmethod
+    def _forward_name(ssh_config: Dict) -> str:
+        return ssh_config.get("name", f"{ssh_config['local_port']}->{ssh_config['ssh_host']}")
+
     async def start_all_forwarding(self):
         """启动所有SSH端口转发"""
         ssh_configs = self.get_ssh_configs()
         for config in ssh_configs:
             if config.get("enabled", True):
                 await self.start_forwarding(config)
-    
+
     async def start_forwarding(self, ssh_config: Dict):
-        """启动单个SSH端口转发"""
+        """启动单个SSH端口转发，并交由监督任务保持运行"""
+        name = self._forward_name(ssh_config)
+        self.desired[name] = ssh_config
+        self.health.setdefault(name, {
+            "restarts": 0,
+            "probe_rtt_ms": None,
+            "probe_ok": None,
+            "probe_failures": 0,
+            "last_exit": None
+        })
+
+        supervisor = self.supervisors.get(name)
+        if supervisor is None or supervisor.done():
+            # 首次启动在当前调用中完成，便于调用方立即看到结果
+            launched = await self._launch(name, ssh_config)
+            self.supervisors[name] = asyncio.create_task(self._supervise(name, launched))
+
+    async def _launch(self, name: str, ssh_config: Dict) -> bool:
+        """按所选后端启动转发，成功返回True"""
+        if self.multiplexer:
+            await self.multiplexer.add_forward(ssh_config)
+            return True
+
         try:
             local_port = ssh_config["local_port"]
             remote_host = ssh_config["remote_host"]
@@ -32,8 +86,7 @@ class SSHForwarder:
             ssh_host = ssh_config["ssh_host"]
             ssh_port = ssh_config.get("ssh_port", 22)
             ssh_user = ssh_config["ssh_user"]
-            name = ssh_config.get("name", f"{local_port}->{ssh_host}")
-            
+
             # 构建SSH命令
             ssh_cmd = [
                 "ssh",
@@ -42,71 +95,176 @@ class SSHForwarder:
                 "-o", "ServerAliveInterval=60",  # 保持连接
                 "-o", "ServerAliveCountMax=3",
                 "-o", "StrictHostKeyChecking=no",
+                "-o", "ExitOnForwardFailure=yes",  # 远程端口绑定失败时退出，交给监督任务重试
                 "-p", str(ssh_port),
                 f"{ssh_user}@{ssh_host}"
             ]
-            
+
             logger.info(f"启动SSH转发: {name} - {' '.join(ssh_cmd)}")
-            
+
             # 启动SSH进程
             process = await asyncio.create_subprocess_exec(
                 *ssh_cmd,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
-            
+
             self.forwarding_processes[name] = {
                 "process": process,
                 "config": ssh_config,
                 "pid": process.pid
             }
-            
-            # 异步监控进程状态
-            asyncio.create_task(self._monitor_process(name, process))
-            
+
             logger.info(f"SSH转发已启动: {name} (PID: {process.pid})")
-            
+            return True
+
         except Exception as e:
-            logger.error(f"启动SSH转发失败: {e}")
-    
-    async def _monitor_process(self, name: str, process: asyncio.subprocess.Process):
-        """监控SSH进程状态"""
+            logger.error(f"启动SSH转发失败: {name} - {e}")
+            return False
+
+    async def _supervise(self, name: str, launched: bool):
+        """保持期望状态：转发退出或探测失败时按指数退避重启"""
+        attempt = 0
+        loop = asyncio.get_running_loop()
+        while name in self.desired:
+            ssh_config = self.desired[name]
+            started_at = loop.time()
+            if launched:
+                reason = await self._watch(name, ssh_config)
+                self.health[name]["last_exit"] = reason
+                await self._shutdown(name)
+
+            if name not in self.desired:
+                break
+            if not ssh_config.get("auto_restart", True):
+                logger.warning(f"SSH转发已停止且未开启自动重启: {name}")
+                self.desired.pop(name, None)
+                break
+
+            # 稳定运行过一段时间后重新从最小退避开始
+            if loop.time() - started_at >= self.backoff_max:
+                attempt = 0
+            cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+            delay = cap / 2 + random.uniform(0, cap / 2)
+            attempt += 1
+            logger.info(f"{delay:.1f}秒后自动重启SSH转发: {name}")
+            await asyncio.sleep(delay)
+
+            if name not in self.desired:
+                break
+            self.health[name]["restarts"] += 1
+            self.health[name]["probe_failures"] = 0
+            launched = await self._launch(name, self.desired[name])
+
+    async def _watch(self, name: str, ssh_config: Dict) -> str:
+        """等待转发失效，返回失效原因"""
+        waiters = [asyncio.create_task(self._probe_loop(name, ssh_config))]
+        proc_info = self.forwarding_processes.get(name)
+        if proc_info:
+            waiters.append(asyncio.create_task(self._wait_process(name, proc_info["process"])))
+
         try:
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                error_msg = stderr.decode() if stderr else "Unknown error"
-                logger.error(f"SSH转发进程异常退出: {name} - {error_msg}")
-                
-                # 从进程列表中移除
-                if name in self.forwarding_processes:
-                    del self.forwarding_processes[name]
-                    
-                # 如果配置为自动重启，则重新启动
-                config = None
-                for proc_info in self.forwarding_processes.values():
-                    if proc_info.get("config", {}).get("name") == name:
-                        config = proc_info["config"]
-                        break
-                
-                if config and config.get("auto_restart", True):
-                    logger.info(f"自动重启SSH转发: {name}")
-                    await asyncio.sleep(5)  # 等待5秒后重启
-                    await self.start_forwarding(config)
-            
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            return next(iter(done)).result()
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def _wait_process(self, name: str, process: asyncio.subprocess.Process) -> str:
+        """等待SSH进程退出"""
+        stdout, stderr = await process.communicate()
+        error_msg = stderr.decode(errors="replace").strip() if stderr else ""
+        logger.error(f"SSH转发进程退出: {name} (返回码 {process.returncode}) {error_msg}")
+        return f"exited:{process.returncode}"
+
+    async def _probe_loop(self, name: str, ssh_config: Dict) -> str:
+        """
+        定期端到端探测，连续失败达到阈值时返回。探测需在转发中配置probe_interval开启，
+        且只适用于本地端口是本代理（或其他HTTP服务）的转发
+        """
+        interval = ssh_config.get("probe_interval", 0)
+        max_failures = ssh_config.get("probe_failures", 3)
+        health = self.health[name]
+        if not interval:
+            # 未开启探测时只依赖进程退出
+            await asyncio.Event().wait()
+
+        while True:
+            await asyncio.sleep(interval)
+            rtt = await self._probe(name, ssh_config)
+            health["probe_ok"] = rtt is not None
+            if rtt is not None:
+                health["probe_rtt_ms"] = round(rtt, 3)
+                health["probe_failures"] = 0
+                continue
+            health["probe_failures"] += 1
+            logger.warning(f"SSH转发探测失败: {name} ({health['probe_failures']}/{max_failures})")
+            if health["probe_failures"] >= max_failures:
+                return "probe_failed"
+
+    async def _probe(self, name: str, ssh_config: Dict) -> Optional[float]:
+        """
+        经隧道远端向本地服务发送一次请求，返回往返时间（毫秒），失败返回None。
+        子进程方式下每次探测都要新建ssh连接，耗时包含SSH握手。
+        """
+        timeout = ssh_config.get("probe_timeout", 10)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        process = None
+        writer = None
+        try:
+            async def exchange():
+                nonlocal process, writer
+                if self.multiplexer:
+                    reader, writer = await self.multiplexer.open_remote_connection(name)
+                else:
+                    process = await asyncio.create_subprocess_exec(
+                        "ssh",
+                        "-W", f"{ssh_config.get('remote_bind', 'localhost')}:{ssh_config['remote_port']}",
+                        "-o", "BatchMode=yes",
+                        "-o", "StrictHostKeyChecking=no",
+                        "-o", f"ConnectTimeout={int(timeout)}",
+                        "-p", str(ssh_config.get("ssh_port", 22)),
+                        f"{ssh_config['ssh_user']}@{ssh_config['ssh_host']}",
+                        stdin=asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.DEVNULL
+                    )
+                    reader, writer = process.stdout, process.stdin
+                writer.write(PROBE_REQUEST)
+                await writer.drain()
+                return await reader.readline()
+
+            status_line = await asyncio.wait_for(exchange(), timeout)
         except Exception as e:
-            logger.error(f"监控SSH进程时出错: {name} - {e}")
-    
-    async def stop_forwarding(self, name: str):
-        """停止指定的SSH端口转发"""
+            logger.debug(f"SSH转发探测出错: {name} - {e}")
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+
+        if not status_line.startswith(b"HTTP/"):
+            return None
+        return (loop.time() - started) * 1000
+
+    async def _shutdown(self, name: str):
+        """停止正在运行的转发实例，不改变期望状态"""
+        if self.multiplexer and self.multiplexer.has_forward(name):
+            await self.multiplexer.remove_forward(name)
+
         if name in self.forwarding_processes:
-            proc_info = self.forwarding_processes[name]
+            proc_info = self.forwarding_processes.pop(name)
             process = proc_info["process"]
-            
+            if process.returncode is not None:
+                return
+
             try:
                 # 发送终止信号
                 process.terminate()
-                
+
                 # 等待进程结束
                 try:
                     await asyncio.wait_for(process.wait(), timeout=5.0)
@@ -114,44 +272,80 @@ class SSHForwarder:
                     # 强制杀死进程
                     process.kill()
                     await process.wait()
-                
+
                 logger.info(f"SSH转发已停止: {name}")
-                
+
             except Exception as e:
                 logger.error(f"停止SSH转发时出错: {name} - {e}")
-            
-            del self.forwarding_processes[name]
-    
+
+    async def stop_forwarding(self, name: str):
+        """停止指定的SSH端口转发"""
+        self.desired.pop(name, None)
+        supervisor = self.supervisors.pop(name, None)
+        if supervisor is not None and supervisor is not asyncio.current_task():
+            supervisor.cancel()
+            try:
+                await supervisor
+            except asyncio.CancelledError:
+                pass
+        await self._shutdown(name)
+
     async def stop_all_forwarding(self):
         """停止所有SSH端口转发"""
-        names = list(self.forwarding_processes.keys())
+        names = set(self.desired) | set(self.forwarding_processes)
         for name in names:
             await self.stop_forwarding(name)
-    
+
+        if self.multiplexer:
+            await self.multiplexer.close()
+
     def get_status(self) -> Dict:
         """获取所有SSH转发的状态"""
         status = {}
         for name, proc_info in self.forwarding_processes.items():
             process = proc_info["process"]
             config = proc_info["config"]
-            
+
             status[name] = {
                 "pid": proc_info["pid"],
                 "running": process.returncode is None,
                 "local_port": config["local_port"],
                 "remote_port": config["remote_port"],
                 "ssh_host": config["ssh_host"],
-                "ssh_user": config["ssh_user"]
+                "ssh_user": config["ssh_user"],
+                "backend": "subprocess"
             }
-        
+
+        if self.multiplexer:
+            status.update(self.multiplexer.get_status())
+
+        # 期望运行但当前未运行的转发（例如正在退避等待重启）
+        for name, config in self.desired.items():
+            status.setdefault(name, {
+                "pid": None,
+                "running": False,
+                "local_port": config["local_port"],
+                "remote_port": config["remote_port"],
+                "ssh_host": config["ssh_host"],
+                "ssh_user": config["ssh_user"],
+                "backend": "asyncssh" if self.multiplexer else "subprocess"
+            })
+
+        for name, entry in status.items():
+            entry["desired"] = name in self.desired
+            entry.update(self.health.get(name, {}))
+
         return status
-    
+
     async def restart_forwarding(self, name: str):
         """重启指定的SSH端口转发"""
-        if name in self.forwarding_processes:
+        config = self.desired.get(name)
+        if config is None and name in self.forwarding_processes:
             config = self.forwarding_processes[name]["config"]
-            await self.stop_forwarding(name)
-            await asyncio.sleep(1)
-            await self.start_forwarding(config)
-        else:
-            logger.warning(f"SSH转发不存在: {name}")
\ No newline at end of file
+        if config is None:
+            logger.warning(f"SSH转发不存在: {name}")
+            return
+
+        await self.stop_forwarding(name)
+        await asyncio.sleep(1)
+        await self.start_forwarding(config)
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import random
+from typing import Dict, Optional, Tuple
+
+import asyncssh
+
+logger = logging.getLogger(__name__)
+
+# 每次读写的数据块大小
+CHUNK_SIZE = 65536
+
+
+def connection_key(ssh_config: Dict) -> Tuple[str, int, str]:
+    """同一SSH服务器、端口和用户的转发共享一条连接"""
+    return (ssh_config["ssh_host"], ssh_config.get("ssh_port", 22), ssh_config["ssh_user"])
+
+
+def forward_name(ssh_config: Dict) -> str:
+    return ssh_config.get("name", f"{ssh_config['local_port']}->{ssh_config['ssh_host']}")
+
+
+class _MuxConnection:
+    """一条asyncssh连接及其上的所有远程端口转发"""
+
+    def __init__(self, key: Tuple[str, int, str], backoff_base: float, backoff_max: float):
+        self.key = key
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.forwards: Dict[str, Dict] = {}  # 名称 -> 转发配置
+        self.listeners = {}  # 名称 -> SSHListener
+        self.counters: Dict[str, Dict] = {}
+        self.conn = None
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect_options(self) -> Dict:
+        # 连接参数取自第一个转发配置，同一连接上的转发应使用相同的认证信息
+        ssh_config = next(iter(self.forwards.values()))
+        host, port, user = self.key
+        options = {
+            "port": port,
+            "username": user,
+            # 与 ssh -o StrictHostKeyChecking=no 保持一致
+            "known_hosts": ssh_config.get("known_hosts"),
+            "keepalive_interval": ssh_config.get("keepalive_interval", 60),
+            "keepalive_count_max": ssh_config.get("keepalive_count_max", 3),
+        }
+        if ssh_config.get("ssh_key"):
+            options["client_keys"] = [ssh_config["ssh_key"]]
+        if ssh_config.get("ssh_password"):
+            options["password"] = ssh_config["ssh_password"]
+        return options
+
+    def ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        """保持连接，断开后按带抖动的指数退避重连"""
+        host = self.key[0]
+        attempt = 0
+        loop = asyncio.get_running_loop()
+        while self.forwards:
+            connected_at = None
+            try:
+                self.conn = await asyncssh.connect(host, **self._connect_options())
+                connected_at = loop.time()
+                self.last_error = None
+                logger.info(f"SSH复用连接已建立: {self.key[2]}@{host}:{self.key[1]}")
+                for name in list(self.forwards):
+                    await self._open_listener(name)
+                await self.conn.wait_closed()
+                logger.warning(f"SSH复用连接已断开: {self.key[2]}@{host}:{self.key[1]}")
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncssh.Error) as e:
+                self.last_error = str(e)
+                logger.error(f"SSH复用连接失败: {self.key[2]}@{host}:{self.key[1]} - {e}")
+            finally:
+                self.conn = None
+                self.listeners.clear()
+
+            if not self.forwards:
+                break
+            # 连接稳定运行过一段时间后重新从最小退避开始
+            if connected_at is not None and loop.time() - connected_at >= self.backoff_max:
+                attempt = 0
+            cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+            delay = cap / 2 + random.uniform(0, cap / 2)
+            attempt += 1
+            self.reconnects += 1
+            logger.info(f"{delay:.1f}秒后重连SSH: {self.key[2]}@{host}:{self.key[1]}")
+            await asyncio.sleep(delay)
+
+    async def _open_listener(self, name: str):
+        ssh_config = self.forwards[name]
+        try:
+            listener = await self.conn.start_server(
+                lambda orig_host, orig_port: lambda reader, writer: self._handle_channel(name, reader, writer),
+                ssh_config.get("remote_bind", "localhost"),
+                ssh_config["remote_port"]
+            )
+            self.listeners[name] = listener
+            logger.info(f"SSH转发已启动: {name} (远程端口 {ssh_config['remote_port']})")
+        except (OSError, asyncssh.Error) as e:
+            self.counters[name]["last_error"] = str(e)
+            logger.error(f"SSH远程端口转发请求失败: {name} - {e}")
+
+    async def _handle_channel(self, name: str, reader, writer):
+        """把远端转发过来的通道接到本地端口"""
+        ssh_config = self.forwards.get(name)
+        counters = self.counters.get(name)
+        if ssh_config is None or counters is None:
+            writer.close()
+            return
+        counters["connections"] += 1
+        counters["active"] += 1
+        try:
+            local_reader, local_writer = await asyncio.open_connection(
+                ssh_config["remote_host"], ssh_config["local_port"])
+        except OSError as e:
+            logger.error(f"SSH转发连接本地端口失败: {name} - {e}")
+            counters["active"] -= 1
+            writer.close()
+            return
+        try:
+            await asyncio.gather(
+                self._pipe(reader, local_writer, counters, "bytes_in"),
+                self._pipe(local_reader, writer, counters, "bytes_out")
+            )
+        finally:
+            counters["active"] -= 1
+            local_writer.close()
+            writer.close()
+
+    @staticmethod
+    async def _pipe(reader, writer, counters: Dict, counter_name: str):
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                counters[counter_name] += len(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (OSError, asyncssh.Error):
+            pass
+
+    async def add(self, name: str, ssh_config: Dict):
+        self.forwards[name] = ssh_config
+        self.counters.setdefault(name, {
+            "bytes_in": 0, "bytes_out": 0, "connections": 0, "active": 0, "last_error": None})
+        if self.conn is not None and name not in self.listeners:
+            await self._open_listener(name)
+        self.ensure_running()
+
+    async def remove(self, name: str):
+        self.forwards.pop(name, None)
+        self.counters.pop(name, None)
+        listener = self.listeners.pop(name, None)
+        if listener is not None:
+            listener.close()
+        if not self.forwards:
+            await self.close()
+
+    async def close(self):
+        self.forwards.clear()
+        if self.conn is not None:
+            self.conn.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class SSHMultiplexer:
+    """进程内SSH转发：同一SSH服务器的所有远程转发复用一条连接"""
+
+    def __init__(self, backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.connections: Dict[Tuple[str, int, str], _MuxConnection] = {}
+
+    def _find(self, name: str) -> Optional[_MuxConnection]:
+        for mux_conn in self.connections.values():
+            if name in mux_conn.forwards:
+                return mux_conn
+        return None
+
+    def has_forward(self, name: str) -> bool:
+        return self._find(name) is not None
+
+    def get_forward_config(self, name: str) -> Optional[Dict]:
+        mux_conn = self._find(name)
+        return mux_conn.forwards[name] if mux_conn else None
+
+    def is_running(self, name: str) -> bool:
+        mux_conn = self._find(name)
+        return mux_conn is not None and mux_conn.conn is not None and name in mux_conn.listeners
+
+    async def open_remote_connection(self, name: str):
+        """经由同一SSH连接打开到远程转发端口的连接，用于端到端探测"""
+        mux_conn = self._find(name)
+        if mux_conn is None or mux_conn.conn is None:
+            raise ConnectionError(f"SSH connection for {name} is not established")
+        config = mux_conn.forwards[name]
+        return await mux_conn.conn.open_connection(
+            config.get("remote_bind", "localhost"), config["remote_port"])
+
+    async def add_forward(self, ssh_config: Dict):
+        """添加远程转发，必要时建立到SSH服务器的连接"""
+        name = forward_name(ssh_config)
+        key = connection_key(ssh_config)
+        existing = self._find(name)
+        if existing is not None and existing.key != key:
+            await self.remove_forward(name)
+        mux_conn = self.connections.get(key)
+        if mux_conn is None:
+            mux_conn = _MuxConnection(key, self.backoff_base, self.backoff_max)
+            self.connections[key] = mux_conn
+        await mux_conn.add(name, ssh_config)
+
+    async def remove_forward(self, name: str):
+        mux_conn = self._find(name)
+        if mux_conn is None:
+            return
+        await mux_conn.remove(name)
+        if not mux_conn.forwards:
+            self.connections.pop(mux_conn.key, None)
+        logger.info(f"SSH转发已停止: {name}")
+
+    async def close(self):
+        for mux_conn in list(self.connections.values()):
+            await mux_conn.close()
+        self.connections.clear()
+
+    def get_status(self) -> Dict:
+        status = {}
+        for mux_conn in self.connections.values():
+            for name, config in mux_conn.forwards.items():
+                counters = mux_conn.counters[name]
+                status[name] = {
+                    "pid": None,
+                    "backend": "asyncssh",
+                    "running": self.is_running(name),
+                    "local_port": config["local_port"],
+                    "remote_port": config["remote_port"],
+                    "ssh_host": config["ssh_host"],
+                    "ssh_user": config["ssh_user"],
+                    "reconnects": mux_conn.reconnects,
+                    "last_error": counters["last_error"] or mux_conn.last_error,
+                    "bytes_in": counters["bytes_in"],
+                    "bytes_out": counters["bytes_out"],
+                    "connections": counters["connections"],
+                    "active_connections": counters["active"],
+                }
+        return status
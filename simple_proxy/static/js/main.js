@@ -1,66 +1,184 @@
+const PAGE_SIZE = 100;
+
+const state = {
+    offset: 0,
+    total: 0,
+    filter: '',
+    rulesEtag: null,
+    configEtag: null
+};
+
+function renderRule(rule) {
+    const ruleElement = document.createElement('div');
+    ruleElement.className = 'rule-item';
+    ruleElement.dataset.id = rule.id;
+
+    const label = document.createElement('span');
+    label.textContent = `[${rule.type || '-'}] ${rule.pattern} → ${rule.action}${rule.proxy ? ` (${rule.proxy})` : ''}`;
+
+    const button = document.createElement('button');
+    button.className = 'delete-rule';
+    button.textContent = 'Delete';
+    button.onclick = () => deleteRule(Number(ruleElement.dataset.id));
+
+    ruleElement.appendChild(label);
+    ruleElement.appendChild(button);
+    return ruleElement;
+}
+
+function updatePager() {
+    const page = Math.floor(state.offset / PAGE_SIZE) + 1;
+    const pages = Math.max(1, Math.ceil(state.total / PAGE_SIZE));
+    document.getElementById('pageInfo').textContent = `${page} / ${pages}`;
+    document.getElementById('ruleCount').textContent = `${state.total} rules`;
+    document.getElementById('prevPage').disabled = state.offset === 0;
+    document.getElementById('nextPage').disabled = state.offset + PAGE_SIZE >= state.total;
+}
+
 async function loadRules() {
-    const response = await fetch('/api/rules');
-    const rules = await response.json();
-    const rulesList = document.getElementById('rulesList');
-    rulesList.innerHTML = '';
-    
-    rules.forEach(rule => {
-        const ruleElement = document.createElement('div');
-        ruleElement.className = 'rule-item';
-        ruleElement.innerHTML = `
-            <span>${rule.pattern} → ${rule.action}${rule.proxy ? ` (${rule.proxy})` : ''}</span>
-            <button class="delete-rule" onclick="deleteRule('${rule.pattern}')">Delete</button>
-        `;
-        rulesList.appendChild(ruleElement);
-    });
+    const params = new URLSearchParams({ offset: state.offset, limit: PAGE_SIZE });
+    if (state.filter) {
+        params.set('q', state.filter);
+    }
+    const headers = state.rulesEtag ? { 'If-None-Match': state.rulesEtag } : {};
+    const response = await fetch(`/api/rules?${params}`, { headers });
+    if (response.status === 304) {
+        return;
+    }
+    state.rulesEtag = response.headers.get('ETag');
+    const page = await response.json();
+    state.total = page.total;
+
+    const fragment = document.createDocumentFragment();
+    page.items.forEach(rule => fragment.appendChild(renderRule(rule)));
+    document.getElementById('rulesList').replaceChildren(fragment);
+    updatePager();
+}
+
+function reloadRules() {
+    state.rulesEtag = null;
+    return loadRules();
 }
 
 async function loadConfig() {
-    const response = await fetch('/api/config');
+    const headers = state.configEtag ? { 'If-None-Match': state.configEtag } : {};
+    const response = await fetch('/api/config?exclude_rules=1', { headers });
+    if (response.status === 304) {
+        return;
+    }
+    state.configEtag = response.headers.get('ETag');
     const config = await response.json();
     document.getElementById('currentConfig').textContent = JSON.stringify(config, null, 2);
 }
 
+function changePage(delta) {
+    state.offset = Math.max(0, state.offset + delta * PAGE_SIZE);
+    reloadRules();
+}
+
 async function addRule() {
     const pattern = document.getElementById('pattern').value;
+    const type = document.getElementById('type').value;
     const action = document.getElementById('action').value;
     const proxy = document.getElementById('proxy').value;
-    
+
     if (!pattern) {
         alert('Pattern is required');
         return;
     }
-    
+
     const rule = {
         pattern,
+        type,
         action,
         ...(proxy && { proxy })
     };
-    
-    await fetch('/api/rules', {
+
+    const response = await fetch('/api/rules', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
         body: JSON.stringify(rule)
     });
-    
+    if (!response.ok) {
+        const result = await response.json();
+        alert(result.error);
+        return;
+    }
+
+    // 列表由服务端推送的 rule_added 事件更新
     document.getElementById('pattern').value = '';
     document.getElementById('proxy').value = '';
-    await loadRules();
-    await loadConfig();
 }
 
-async function deleteRule(pattern) {
-    await fetch(`/api/rules/${encodeURIComponent(pattern)}`, {
+async function deleteRule(id) {
+    await fetch(`/api/rules/${id}`, {
         method: 'DELETE'
     });
-    await loadRules();
-    await loadConfig();
 }
 
+function onRuleAdded(data) {
+    if (state.filter) {
+        reloadRules();
+        return;
+    }
+    state.total = data.total;
+    if (data.id >= state.offset && data.id < state.offset + PAGE_SIZE) {
+        document.getElementById('rulesList').appendChild(renderRule({ ...data.rule, id: data.id }));
+    }
+    updatePager();
+}
+
+function onRuleRemoved(data) {
+    if (state.filter) {
+        reloadRules();
+        return;
+    }
+    state.total = data.total;
+    if (state.offset > 0 && state.offset >= state.total) {
+        // 当前页的规则已全部删除，回到上一页
+        state.offset -= PAGE_SIZE;
+    }
+    if (data.id < state.offset + PAGE_SIZE) {
+        // 删除位置在当前页或之前，之后的规则前移（包括下一页的第一条），重新加载当前页
+        reloadRules();
+        return;
+    }
+    updatePager();
+}
+
+function onStats(stats) {
+    document.getElementById('trafficStats').textContent =
+        `Requests: ${stats.requests ?? 0}  CONNECT: ${stats.connects ?? 0}  Upgrade: ${stats.upgrades ?? 0}  ` +
+        `Active: ${stats.active ?? 0}  Errors: ${stats.errors ?? 0}`;
+}
+
+function subscribeEvents() {
+    const events = new EventSource('/api/events');
+    events.addEventListener('rule_added', e => onRuleAdded(JSON.parse(e.data)));
+    events.addEventListener('rule_removed', e => onRuleRemoved(JSON.parse(e.data)));
+    events.addEventListener('rules_reset', () => { reloadRules(); loadConfig(); });
+    events.addEventListener('config_changed', () => loadConfig());
+    events.addEventListener('resync', () => { reloadRules(); loadConfig(); });
+    events.addEventListener('stats', e => onStats(JSON.parse(e.data)));
+    // 断线重连后重新同步，条件请求在没有变化时只返回304
+    events.addEventListener('hello', () => { loadRules(); loadConfig(); });
+}
+
+let filterTimer = null;
+
 // Load initial data
 window.addEventListener('load', () => {
-    loadRules();
+    document.getElementById('ruleFilter').addEventListener('input', e => {
+        clearTimeout(filterTimer);
+        filterTimer = setTimeout(() => {
+            state.filter = e.target.value.trim();
+            state.offset = 0;
+            reloadRules();
+        }, 300);
+    });
+    reloadRules();
     loadConfig();
-});
\ No newline at end of file
+    subscribeEvents();
+});
@@ -0,0 +1,125 @@
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import aiohttp
+
+
+class Trace:
+    """
+    单个请求的耗时记录。mark(name) 结束名为name的阶段，
+    该阶段耗时为距上一次标记（或请求开始）的时间
+    """
+    __slots__ = ("kind", "target", "client", "upstream", "started", "wall_time",
+                 "marks", "duration", "status")
+
+    def __init__(self, kind: str, target: str, client: Optional[str]):
+        self.kind = kind
+        self.target = target
+        self.client = client
+        self.upstream = "direct"
+        self.started = time.perf_counter()
+        self.wall_time = time.time()
+        self.marks = []
+        self.duration = 0.0
+        self.status = None
+
+    def mark(self, name: str) -> None:
+        self.marks.append((name, time.perf_counter()))
+
+    def to_dict(self) -> Dict:
+        spans = []
+        previous = self.started
+        for name, timestamp in self.marks:
+            spans.append({"name": name, "ms": round((timestamp - previous) * 1000, 3)})
+            previous = timestamp
+        return {
+            "kind": self.kind,
+            "target": self.target,
+            "client": self.client,
+            "upstream": self.upstream,
+            "status": self.status,
+            "time": self.wall_time,
+            "total_ms": round(self.duration * 1000, 3),
+            "spans": spans,
+        }
+
+
+class RequestTracer:
+    """按采样率记录请求耗时，保留最近和最慢的若干条"""
+
+    def __init__(self, enabled: bool = False, sample_rate: float = 1.0, capacity: int = 50):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.recent = deque(maxlen=capacity)
+        self._slowest = []  # 以耗时为键的小顶堆
+        self._sequence = itertools.count()
+
+    @classmethod
+    def from_config(cls, config) -> "RequestTracer":
+        settings = config.config.get("tracing") or {}
+        return cls(
+            enabled=settings.get("enabled", False),
+            sample_rate=settings.get("sample_rate", 1.0),
+            capacity=settings.get("capacity", 50)
+        )
+
+    def configure(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None) -> None:
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+
+    def start(self, kind: str, target: str, client: Optional[str]) -> Optional[Trace]:
+        """未开启或未被采样时返回None，调用方据此跳过所有标记"""
+        if not self.enabled:
+            return None
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        return Trace(kind, target, client)
+
+    def finish(self, trace: Trace, status: Optional[int] = None) -> None:
+        trace.duration = time.perf_counter() - trace.started
+        trace.status = status
+        self.recent.append(trace)
+        entry = (trace.duration, next(self._sequence), trace)
+        if len(self._slowest) < self.capacity:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def clear(self) -> None:
+        self.recent.clear()
+        self._slowest.clear()
+
+    def snapshot(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "capacity": self.capacity,
+            "slowest": [t.to_dict() for _, _, t in sorted(self._slowest, reverse=True)],
+            "recent": [t.to_dict() for t in reversed(self.recent)],
+        }
+
+
+def _marker(name: str):
+    async def on_event(session, trace_config_ctx, params):
+        trace = trace_config_ctx.trace_request_ctx
+        if trace is not None:
+            trace.mark(name)
+    return on_event
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """把aiohttp客户端的DNS、建连和等待响应阶段记录到 trace_request_ctx 中的 Trace"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(_marker("setup"))
+    trace_config.on_dns_resolvehost_end.append(_marker("dns"))
+    trace_config.on_connection_create_end.append(_marker("connect"))
+    trace_config.on_connection_reuseconn.append(_marker("connect"))
+    trace_config.on_request_end.append(_marker("response_wait"))
+    return trace_config
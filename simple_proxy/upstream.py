@@ -0,0 +1,313 @@
+import asyncio
+import ipaddress
+import socket
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from multidict import CIMultiDict
+
+# 与目标或上游代理建立TCP连接的超时（秒）
+CONNECT_TIMEOUT = 10.0
+# 上游代理CONNECT响应头的最大长度
+MAX_RESPONSE_HEAD = 65536
+# 原始HTTP响应体的读取超时（秒）
+BODY_TIMEOUT = 30.0
+
+# SOCKS5协议常量（RFC 1928/1929）
+SOCKS_VERSION = 5
+SOCKS_NO_AUTH = 0x00
+SOCKS_USER_PASS = 0x02
+SOCKS_NO_ACCEPTABLE = 0xFF
+SOCKS_CMD_CONNECT = 0x01
+SOCKS_ATYP_IPV4 = 0x01
+SOCKS_ATYP_DOMAIN = 0x03
+SOCKS_ATYP_IPV6 = 0x04
+SOCKS_REPLY_SUCCEEDED = 0x00
+SOCKS_REPLY_FAILURE = 0x01
+SOCKS_REPLY_HOST_UNREACHABLE = 0x04
+SOCKS_REPLY_CONNECTION_REFUSED = 0x05
+SOCKS_REPLY_TTL_EXPIRED = 0x06
+SOCKS_REPLY_COMMAND_NOT_SUPPORTED = 0x07
+SOCKS_REPLY_ADDRESS_NOT_SUPPORTED = 0x08
+SOCKS_REPLY_MESSAGES = {
+    0x01: "general failure",
+    0x02: "connection not allowed by ruleset",
+    0x03: "network unreachable",
+    0x04: "host unreachable",
+    0x05: "connection refused",
+    0x06: "TTL expired",
+    0x07: "command not supported",
+    0x08: "address type not supported",
+}
+
+
+class UpstreamUnavailable(OSError):
+    """无法连接上游代理本身"""
+
+
+class TunnelRefused(ConnectionError):
+    """上游代理拒绝为目标建立隧道，status为HTTP状态码或SOCKS5应答码"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class InvalidResponse(ConnectionError):
+    """源站或上游代理返回的响应无法解析"""
+
+
+def format_authority(host: str, port: int) -> str:
+    return f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+
+
+async def read_response_head(reader: asyncio.StreamReader, timeout: float = CONNECT_TIMEOUT):
+    """读取原始HTTP响应头，返回 (状态码, 头部, 原始字节)"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        raise InvalidResponse("Connection closed before a complete response head") from e
+    if len(head) > MAX_RESPONSE_HEAD:
+        raise InvalidResponse("Response head too large")
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise InvalidResponse(f"Invalid status line: {lines[0]}")
+    headers = CIMultiDict()
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers.add(name.strip(), value.strip())
+    return int(parts[1]), headers, head
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    chunks = []
+    while True:
+        size_line = await reader.readline()
+        if not size_line:
+            raise InvalidResponse("Connection closed inside a chunked body")
+        size = int(size_line.split(b";", 1)[0].strip(), 16)
+        if size == 0:
+            # 跳过trailer
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+def has_response_body(status: int, method: str = "GET") -> bool:
+    """1xx、204、304以及HEAD请求的响应没有响应体（RFC 9112 6.3）"""
+    return method != "HEAD" and status >= 200 and status not in (204, 304)
+
+
+async def read_response_body(reader: asyncio.StreamReader, status: int, headers, method: str = "GET",
+                             timeout: float = BODY_TIMEOUT) -> bytes:
+    """按Transfer-Encoding或Content-Length读取完整的响应体，两者都没有时读到连接关闭"""
+    if not has_response_body(status, method):
+        return b""
+    if "chunked" in headers.get("Transfer-Encoding", "").lower():
+        body = _read_chunked(reader)
+    elif "Content-Length" in headers:
+        body = reader.readexactly(int(headers["Content-Length"]))
+    else:
+        body = reader.read()
+    try:
+        return await asyncio.wait_for(body, timeout)
+    except (asyncio.IncompleteReadError, ValueError) as e:
+        raise InvalidResponse(f"Incomplete response body: {e}") from e
+
+
+async def _resolve(resolver, host: str, port: int) -> Tuple[str, int]:
+    """使用自定义解析器（aiohttp.abc.AbstractResolver）解析地址，未指定时交给系统解析"""
+    if resolver is None:
+        return host, port
+    info = (await resolver.resolve(host, port, socket.AF_INET))[0]
+    return info["host"], info["port"]
+
+
+async def connect_to_proxy(proxy_settings: Dict, resolver=None, timeout: float = CONNECT_TIMEOUT):
+    """建立到上游代理本身的TCP连接，返回(reader, writer)，失败时抛出UpstreamUnavailable"""
+    proxy_host, proxy_port = proxy_settings["host"], proxy_settings["port"]
+    try:
+        address = await _resolve(resolver, proxy_host, proxy_port)
+        return await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        raise UpstreamUnavailable(
+            f"Cannot connect to upstream proxy {proxy_host}:{proxy_port}: {e or e.__class__.__name__}") from e
+
+
+async def open_tunnel(proxy_settings: Dict, host: str, port: int, resolver=None,
+                      timeout: float = CONNECT_TIMEOUT):
+    """通过HTTP上游代理的CONNECT方法建立到host:port的隧道，返回(reader, writer)"""
+    proxy_host, proxy_port = proxy_settings["host"], proxy_settings["port"]
+    reader, writer = await connect_to_proxy(proxy_settings, resolver, timeout)
+    try:
+        authority = format_authority(host, port)
+        writer.write(f"CONNECT {authority} HTTP/1.1\r\nHost: {authority}\r\n\r\n".encode())
+        try:
+            status, _, head = await read_response_head(reader, timeout)
+        except InvalidResponse as e:
+            raise TunnelRefused(f"Invalid CONNECT response from {proxy_host}:{proxy_port}: {e}") from e
+        status_line = head.split(b"\r\n", 1)[0].decode("latin-1")
+        if status != 200:
+            raise TunnelRefused(
+                f"Upstream proxy {proxy_host}:{proxy_port} refused CONNECT {authority}: {status_line}", status)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+def encode_socks_address(host: str, port: int) -> bytes:
+    """编码为SOCKS5的 ATYP + 地址 + 端口，域名原样发送，由对端解析"""
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        name = host.encode("idna")
+        return bytes([SOCKS_ATYP_DOMAIN, len(name)]) + name + port.to_bytes(2, "big")
+    atyp = SOCKS_ATYP_IPV4 if ip.version == 4 else SOCKS_ATYP_IPV6
+    return bytes([atyp]) + ip.packed + port.to_bytes(2, "big")
+
+
+async def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise TunnelRefused("SOCKS5 proxy closed the connection during handshake")
+        data += chunk
+    return data
+
+
+async def _connect_socket(host: str, port: int, resolver=None) -> socket.socket:
+    """建立非阻塞的TCP套接字连接，依次尝试解析得到的地址"""
+    loop = asyncio.get_running_loop()
+    host, port = await _resolve(resolver, host, port)
+    error = None
+    for family, type_, proto, _, address in await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+            return sock
+        except BaseException as e:
+            sock.close()
+            if not isinstance(e, OSError):
+                raise
+            error = e
+    raise error or OSError(f"No address for {host}")
+
+
+async def _socks5_negotiate(sock: socket.socket, proxy_settings: Dict, host: str, port: int) -> None:
+    loop = asyncio.get_running_loop()
+    proxy = f"{proxy_settings['host']}:{proxy_settings['port']}"
+    username = proxy_settings.get("username")
+    methods = bytes([SOCKS_NO_AUTH, SOCKS_USER_PASS]) if username else bytes([SOCKS_NO_AUTH])
+    await loop.sock_sendall(sock, bytes([SOCKS_VERSION, len(methods)]) + methods)
+    version, method = await _recv_exactly(sock, 2)
+    if version != SOCKS_VERSION:
+        raise TunnelRefused(f"Upstream proxy {proxy} is not a SOCKS5 proxy")
+    if method == SOCKS_USER_PASS and username:
+        user = username.encode()
+        password = (proxy_settings.get("password") or "").encode()
+        await loop.sock_sendall(sock, bytes([1, len(user)]) + user + bytes([len(password)]) + password)
+        _, status = await _recv_exactly(sock, 2)
+        if status != 0:
+            raise TunnelRefused(f"SOCKS5 authentication with {proxy} failed")
+    elif method != SOCKS_NO_AUTH:
+        raise TunnelRefused(f"SOCKS5 proxy {proxy} accepts none of our authentication methods")
+
+    await loop.sock_sendall(
+        sock, bytes([SOCKS_VERSION, SOCKS_CMD_CONNECT, 0]) + encode_socks_address(host, port))
+    _, reply, _, atyp = await _recv_exactly(sock, 4)
+    if reply != SOCKS_REPLY_SUCCEEDED:
+        raise TunnelRefused(
+            f"SOCKS5 proxy {proxy} refused CONNECT {format_authority(host, port)}: "
+            f"{SOCKS_REPLY_MESSAGES.get(reply, reply)}", reply)
+    # 跳过代理绑定的地址和端口
+    if atyp == SOCKS_ATYP_IPV4:
+        size = 4
+    elif atyp == SOCKS_ATYP_IPV6:
+        size = 16
+    elif atyp == SOCKS_ATYP_DOMAIN:
+        size = (await _recv_exactly(sock, 1))[0]
+    else:
+        raise TunnelRefused(f"Invalid SOCKS5 reply from {proxy}")
+    await _recv_exactly(sock, size + 2)
+
+
+async def socks5_connect(proxy_settings: Dict, host: str, port: int, resolver=None,
+                         timeout: float = CONNECT_TIMEOUT) -> socket.socket:
+    """
+    经SOCKS5上游代理建立到host:port的连接，返回已完成握手的非阻塞套接字。
+    目标域名由上游代理解析（相当于socks5h），resolver只用于解析代理自身的地址
+    """
+    proxy_host, proxy_port = proxy_settings["host"], proxy_settings["port"]
+    try:
+        sock = await asyncio.wait_for(_connect_socket(proxy_host, proxy_port, resolver), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        raise UpstreamUnavailable(
+            f"Cannot connect to upstream proxy {proxy_host}:{proxy_port}: {e or e.__class__.__name__}") from e
+    try:
+        await asyncio.wait_for(_socks5_negotiate(sock, proxy_settings, host, port), timeout)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def is_socks5(proxy_settings: Optional[Dict]) -> bool:
+    return bool(proxy_settings) and proxy_settings.get("type") == "socks5"
+
+
+async def open_connection(host: str, port: int, proxy_settings: Optional[Dict] = None,
+                          resolver=None, timeout: float = CONNECT_TIMEOUT):
+    """直连或经上游代理（HTTP CONNECT或SOCKS5）建立到host:port的TCP连接，返回(reader, writer)"""
+    if is_socks5(proxy_settings):
+        sock = await socks5_connect(proxy_settings, host, port, resolver, timeout)
+        try:
+            return await asyncio.open_connection(sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+    if proxy_settings:
+        return await open_tunnel(proxy_settings, host, port, resolver, timeout)
+    address = await _resolve(resolver, host, port)
+    return await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+
+
+class Socks5Connector(aiohttp.TCPConnector):
+    """经SOCKS5上游代理建立连接的aiohttp连接器，连接池与普通TCPConnector相同"""
+
+    def __init__(self, proxy_settings: Dict, proxy_resolver=None, **kwargs):
+        super().__init__(**kwargs)
+        self.proxy_settings = proxy_settings
+        self._proxy_resolver = proxy_resolver
+
+    async def _resolve_host(self, host, port, traces=None):
+        # 目标域名交给SOCKS5代理解析，本地不做DNS查询
+        return [{"hostname": host, "host": host, "port": port,
+                 "family": socket.AF_UNSPEC, "proto": 0, "flags": 0}]
+
+    async def _wrap_create_connection(self, protocol_factory, host, port, *, req, timeout,
+                                      client_error=aiohttp.ClientConnectorError, ssl=None,
+                                      server_hostname=None, **kwargs):
+        try:
+            sock = await socks5_connect(self.proxy_settings, host, port, self._proxy_resolver,
+                                        timeout.sock_connect or CONNECT_TIMEOUT)
+        except OSError as e:
+            # aiohttp的错误信息取自strerror，单参数构造的异常没有设置
+            if e.strerror is None:
+                e.strerror = str(e) or e.__class__.__name__
+            if isinstance(e, UpstreamUnavailable):
+                raise aiohttp.ClientProxyConnectionError(req.connection_key, e) from e
+            raise client_error(req.connection_key, e) from e
+        try:
+            return await self._loop.create_connection(
+                protocol_factory, sock=sock, ssl=ssl, server_hostname=server_hostname)
+        except BaseException:
+            sock.close()
+            raise
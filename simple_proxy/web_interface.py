@@ -1,13 +1,40 @@
 from aiohttp import web
+import asyncio
 import os
 import json
+import socket
+from typing import Optional
+
+from .diagnostics import Profiler, memory_usage
+from .sockets import create_listen_socket
+
+# 规则分页的默认和最大每页条数
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# 推送流量统计的间隔（秒）
+STATS_PUSH_INTERVAL = 2.0
+# 每个事件订阅者最多积压的事件数，超过后要求客户端重新同步
+EVENT_QUEUE_SIZE = 1000
 
 class WebInterface:
-    def __init__(self, config, host: str = "127.0.0.1", port: int = 8081, ssh_forwarder=None):
+    def __init__(self, config, host: str = "127.0.0.1", port: int = 8081, ssh_forwarder=None,
+                 proxy_server=None, loop_monitor=None, startup_report=None):
         self.config = config
         self.host = host
         self.port = port
         self.ssh_forwarder = ssh_forwarder
+        self.proxy_server = proxy_server
+        self.loop_monitor = loop_monitor
+        self.startup_report = startup_report
+        self.runner = None
+        # 监听套接字，热重启时交给新进程
+        self.sock = None
+        self._listener = None
+        self.profiler = Profiler()
+        # 配置版本号在重启后从0开始，ETag带上每个进程不同的随机值，避免命中重启前缓存的响应
+        self.boot_id = os.urandom(4).hex()
+        self.event_queues = set()
+        self.config.add_listener(self._on_config_event)
         self.app = web.Application()
         self.setup_routes()
         
@@ -21,10 +48,37 @@ class WebInterface:
         self.app.router.add_post('/api/rules', self.handle_add_rule)
         self.app.router.add_delete('/api/rules/{rule_id}', self.handle_delete_rule)
         
+        # 规则变更和流量统计推送（SSE）
+        self.app.router.add_get('/api/events', self.handle_events)
+        
         # 配置管理API
         self.app.router.add_get('/api/config', self.handle_get_config)
         self.app.router.add_post('/api/config', self.handle_update_config)
         
+        # 调试API
+        self.app.router.add_get('/api/debug/loop', self.handle_debug_loop)
+        self.app.router.add_post('/api/debug/profile', self.handle_debug_profile)
+        self.app.router.add_get('/api/debug/process', self.handle_debug_process)
+        if self.proxy_server:
+            self.app.router.add_get('/api/debug/slow', self.handle_debug_slow)
+            self.app.router.add_post('/api/debug/tracing', self.handle_debug_tracing)
+            
+            # 活动连接管理API
+            self.app.router.add_get('/api/connections', self.handle_get_connections)
+            self.app.router.add_delete('/api/connections/{conn_id}', self.handle_kill_connection)
+            self.app.router.add_post('/api/connections/drain', self.handle_drain_connections)
+            
+            # 熔断器状态API
+            self.app.router.add_get('/api/breakers', self.handle_get_breakers)
+            self.app.router.add_post('/api/breakers/reset', self.handle_reset_breakers)
+            
+            # 限速状态API
+            self.app.router.add_get('/api/shaping', self.handle_get_shaping)
+            
+            # 自动选路测速结果API
+            self.app.router.add_get('/api/autoroute', self.handle_get_autoroute)
+            self.app.router.add_delete('/api/autoroute', self.handle_forget_autoroute)
+        
         # SSH转发管理API
         if self.ssh_forwarder:
             self.app.router.add_get('/api/ssh/status', self.handle_ssh_status)
@@ -35,8 +89,53 @@ class WebInterface:
     async def handle_index(self, request):
         return web.FileResponse(os.path.join(os.path.dirname(__file__), 'static', 'index.html'))
         
+    def _not_modified(self, request, etag: str) -> bool:
+        return etag in request.headers.get('If-None-Match', '')
+    
     async def handle_get_rules(self, request):
-        return web.json_response(self.config.get_rules())
+        """
+        获取规则列表。不带查询参数时返回完整列表；
+        带 offset/limit/q/type/action 参数时返回过滤后的一页规则
+        """
+        etag = f'"rules-{self.boot_id}-{self.config.version}"'
+        if self._not_modified(request, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+        
+        query = request.query
+        rules = self.config.get_rules()
+        if not any(key in query for key in ('offset', 'limit', 'q', 'type', 'action')):
+            return web.json_response(rules, headers={'ETag': etag})
+        
+        try:
+            offset = max(0, int(query.get('offset', 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(query.get('limit', DEFAULT_PAGE_SIZE))))
+        except ValueError:
+            return web.json_response({'error': 'offset and limit must be integers'}, status=400)
+        
+        keyword = query.get('q', '')
+        rule_type = query.get('type')
+        action = query.get('action')
+        
+        total = 0
+        items = []
+        for index, rule in enumerate(rules):
+            if keyword and keyword not in rule.get('pattern', ''):
+                continue
+            if rule_type and rule.get('type') != rule_type:
+                continue
+            if action and rule.get('action') != action:
+                continue
+            if offset <= total < offset + limit:
+                items.append(dict(rule, id=index))
+            total += 1
+        
+        return web.json_response({
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'version': self.config.version,
+            'items': items
+        }, headers={'ETag': etag})
         
     async def handle_add_rule(self, request):
         """添加新规则"""
@@ -54,11 +153,11 @@ class WebInterface:
                 return web.json_response({'error': 'Rule type must be "domain" or "ip"'}, status=400)
             
             # 验证动作
-            if data['action'] not in ['direct', 'proxy']:
-                return web.json_response({'error': 'Action must be "direct" or "proxy"'}, status=400)
+            if data['action'] not in ['direct', 'proxy', 'auto']:
+                return web.json_response({'error': 'Action must be "direct", "proxy" or "auto"'}, status=400)
             
-            # 如果是代理动作，需要指定代理设置
-            if data['action'] == 'proxy' and 'proxy' not in data:
+            # 如果是代理或自动动作，需要指定（候选）代理设置
+            if data['action'] in ('proxy', 'auto') and 'proxy' not in data:
                 data['proxy'] = 'default_proxy'
             
             # 添加规则
@@ -88,8 +187,18 @@ class WebInterface:
             return web.json_response({'error': str(e)}, status=500)
         
     async def handle_get_config(self, request):
-        """获取完整配置"""
-        return web.json_response(self.config.config)
+        """获取完整配置，exclude_rules=1 时不返回规则列表，只返回规则数量"""
+        exclude_rules = request.query.get('exclude_rules') == '1'
+        etag = f'"config-{self.boot_id}-{self.config.version}{"-norules" if exclude_rules else ""}"'
+        if self._not_modified(request, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+        
+        if exclude_rules:
+            data = {key: value for key, value in self.config.config.items() if key != 'rules'}
+            data['rules_count'] = len(self.config.get_rules())
+        else:
+            data = self.config.config
+        return web.json_response(data, headers={'ETag': etag})
         
     async def handle_update_config(self, request):
         """更新配置"""
@@ -108,12 +217,179 @@ class WebInterface:
             
             # 保存配置
             self.config.save()
+            self.config.notify_changed('rules_reset' if 'rules' in data else 'config_changed')
             
             return web.json_response({'success': True, 'message': '配置更新成功'})
             
         except Exception as e:
             return web.json_response({'error': str(e)}, status=500)
     
+    def _on_config_event(self, event: str, data: dict):
+        """把配置变更推送给所有事件订阅者"""
+        self._publish(event, data)
+    
+    def _publish(self, event: str, data: dict):
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+        for queue in list(self.event_queues):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 客户端消费过慢，丢弃积压并要求其重新拉取
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(f"event: resync\ndata: {{\"version\": {self.config.version}}}\n\n".encode())
+    
+    async def handle_events(self, request):
+        """SSE事件流：推送规则增量变更和流量统计"""
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache'
+        })
+        await response.prepare(request)
+        
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.event_queues.add(queue)
+        try:
+            await response.write(f"event: hello\ndata: {{\"version\": {self.config.version}}}\n\n".encode())
+            loop = asyncio.get_running_loop()
+            next_stats = loop.time()
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), max(0, next_stats - loop.time()))
+                except asyncio.TimeoutError:
+                    # 定期推送流量统计，同时作为心跳
+                    stats = self.proxy_server.get_stats() if self.proxy_server else {}
+                    message = f"event: stats\ndata: {json.dumps(stats)}\n\n".encode()
+                    next_stats = loop.time() + STATS_PUSH_INTERVAL
+                await response.write(message)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.event_queues.discard(queue)
+        return response
+    
+    # 调试相关API
+    async def handle_debug_slow(self, request):
+        """获取最慢和最近的请求耗时记录"""
+        return web.json_response(self.proxy_server.tracer.snapshot())
+    
+    async def handle_debug_tracing(self, request):
+        """开关请求耗时追踪或调整采样率"""
+        try:
+            data = await request.json()
+            tracer = self.proxy_server.tracer
+            tracer.configure(data.get('enabled'), data.get('sample_rate'))
+            if data.get('clear'):
+                tracer.clear()
+            return web.json_response({'success': True, 'enabled': tracer.enabled,
+                                      'sample_rate': tracer.sample_rate})
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+    
+    async def handle_debug_loop(self, request):
+        """获取事件循环调度延迟直方图和最近的阻塞调用栈"""
+        if not self.loop_monitor:
+            return web.json_response({'error': 'Loop monitor not enabled'}, status=404)
+        return web.json_response(self.loop_monitor.snapshot())
+    
+    async def handle_debug_process(self, request):
+        """获取事件循环实现、启动耗时和内存占用"""
+        if self.startup_report is not None:
+            return web.json_response(self.startup_report.snapshot())
+        return web.json_response(dict(memory_usage(), pid=os.getpid()))
+    
+    async def handle_debug_profile(self, request):
+        """
+        对运行中的进程做限时性能分析。
+        参数：seconds（默认5）、mode（cprofile或sample）、limit、sort（仅cprofile）
+        """
+        if self.profiler.busy:
+            return web.json_response({'error': 'Another profile is already running'}, status=409)
+        try:
+            seconds = float(request.query.get('seconds', 5))
+            limit = int(request.query.get('limit', 50))
+        except ValueError:
+            return web.json_response({'error': 'seconds and limit must be numbers'}, status=400)
+        
+        mode = request.query.get('mode', 'cprofile')
+        if mode == 'cprofile':
+            report = await self.profiler.run_cprofile(seconds, request.query.get('sort', 'cumulative'), limit)
+            return web.Response(text=report)
+        if mode == 'sample':
+            return web.json_response(await self.profiler.run_sampling(seconds, limit=limit))
+        return web.json_response({'error': 'mode must be "cprofile" or "sample"'}, status=400)
+    
+    # 活动连接相关API
+    async def handle_get_connections(self, request):
+        """分页获取活动连接，可按destination或client过滤"""
+        try:
+            offset = max(0, int(request.query.get('offset', 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(request.query.get('limit', DEFAULT_PAGE_SIZE))))
+        except ValueError:
+            return web.json_response({'error': 'offset and limit must be integers'}, status=400)
+        
+        connections = self.proxy_server.connections
+        page = connections.page(offset, limit, request.query.get('destination'), request.query.get('client'))
+        page['top_destinations'] = connections.top_destinations()
+        return web.json_response(page)
+    
+    async def handle_kill_connection(self, request):
+        """断开指定连接"""
+        try:
+            conn_id = int(request.match_info['conn_id'])
+        except ValueError:
+            return web.json_response({'error': '无效的连接ID'}, status=400)
+        
+        if self.proxy_server.connections.kill(conn_id):
+            return web.json_response({'success': True, 'message': '连接已断开'})
+        return web.json_response({'error': '连接不存在'}, status=404)
+    
+    async def handle_drain_connections(self, request):
+        """断开指向指定目标（host:port）的所有连接"""
+        try:
+            data = await request.json()
+            destination = data.get('destination')
+            if not destination:
+                return web.json_response({'error': 'Missing required field: destination'}, status=400)
+            
+            killed = self.proxy_server.connections.drain(destination)
+            return web.json_response({'success': True, 'killed': killed})
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+    
+    # 熔断器相关API
+    async def handle_get_breakers(self, request):
+        """获取上游和目标的熔断状态及负缓存，all=1时包含处于关闭状态的目标"""
+        include_closed = request.query.get('all') in ('1', 'true')
+        return web.json_response(self.proxy_server.breakers.snapshot(include_closed))
+    
+    async def handle_reset_breakers(self, request):
+        """重置指定目标或上游（key）的熔断状态，不指定key时全部重置"""
+        try:
+            data = await request.json() if request.can_read_body else {}
+            self.proxy_server.breakers.reset(data.get('key'))
+            return web.json_response({'success': True})
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+    
+    async def handle_get_shaping(self, request):
+        """获取限速设置和活跃令牌桶的余量"""
+        return web.json_response(self.proxy_server.shaper.snapshot())
+    
+    async def handle_get_autoroute(self, request):
+        """分页获取auto规则按域名学习到的路径和建连耗时"""
+        try:
+            offset = max(0, int(request.query.get('offset', 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(request.query.get('limit', DEFAULT_PAGE_SIZE))))
+        except ValueError:
+            return web.json_response({'error': 'offset and limit must be integers'}, status=400)
+        return web.json_response(self.proxy_server.auto_router.page(offset, limit))
+    
+    async def handle_forget_autoroute(self, request):
+        """清除指定域名（domain参数）的测速结果，不指定时全部清除"""
+        self.proxy_server.auto_router.forget(request.query.get('domain'))
+        return web.json_response({'success': True})
+    
     # SSH转发相关API
     async def handle_ssh_status(self, request):
         """获取SSH转发状态"""
@@ -169,12 +445,29 @@ class WebInterface:
         except Exception as e:
             return web.json_response({'error': str(e)}, status=500)
         
-    async def start(self):
-        runner = web.AppRunner(self.app)
-        await runner.setup()
-        site = web.TCPSite(runner, self.host, self.port)
-        await site.start()
+    async def start(self, sock: Optional[socket.socket] = None):
+        """sock: 热重启时从旧进程继承的监听套接字，为None时自行绑定 host:port"""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        if sock is None:
+            sock = create_listen_socket(self.host, self.port)
+        self.sock = sock
+        loop = asyncio.get_running_loop()
+        self._listener = await loop.create_server(self.runner.server, sock=sock)
+        self.host, self.port = sock.getsockname()[:2]
         print(f"Web interface started on http://{self.host}:{self.port}")
+    
+    async def stop(self, timeout: float = 1.0):
+        """停止接受新连接，事件流等长连接在timeout后被关闭"""
+        if not self.runner:
+            return
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        await self.runner.server.shutdown(timeout)
+        await self.runner.cleanup()
+        self.runner = None
+        self.sock = None
         
     def run(self):
         web.run_app(self.app, host=self.host, port=self.port)
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""自动选路的测速去重、样本衰减和分类别记录的测试"""
+
+import asyncio
+
+import pytest
+
+from simple_proxy import auto_route
+from simple_proxy.auto_route import DIRECT, FAILURE_PENALTY_MS, FORWARD, PROXY, TUNNEL, AutoRouter
+
+
+class FakeClock:
+    """替换auto_route模块中的time.time()"""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(auto_route, "time", clock)
+    return clock
+
+
+class FakeWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _opener(delay, calls, error=None):
+    async def open_connection():
+        calls.append(delay)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return None, FakeWriter()
+    return open_connection
+
+
+def test_faster_route_wins_within_direct_bias(clock):
+    router = AutoRouter(direct_bias=1.2)
+    router.observe("example.test", DIRECT, 0.110)
+    router.observe("example.test", PROXY, 0.100)
+    assert router.lookup("example.test") == DIRECT
+    router.observe("slow.test", DIRECT, 0.200)
+    router.observe("slow.test", PROXY, 0.100)
+    assert router.lookup("slow.test") == PROXY
+
+
+def test_failed_direct_route_falls_back_to_proxy(clock):
+    router = AutoRouter()
+    router.observe("example.test", DIRECT, None)
+    router.observe("example.test", PROXY, 0.5)
+    assert router.lookup("example.test") == PROXY
+
+
+def test_old_samples_lose_weight(clock):
+    router = AutoRouter(half_life=100.0)
+    router.observe("example.test", DIRECT, 0.100)
+    router.observe("example.test", DIRECT, 0.200)
+    recent = router.page()["items"][0]["direct_ms"]
+    # 没有间隔时按EWMA_ALPHA混合
+    assert recent == pytest.approx(100 + auto_route.EWMA_ALPHA * 100)
+
+    clock.now += 1000.0
+    router.observe("example.test", DIRECT, 0.300)
+    # 十个半衰期之后旧值的权重只剩 (1 - EWMA_ALPHA) / 1024
+    old_weight = (1 - auto_route.EWMA_ALPHA) * 0.5 ** 10
+    assert router.page()["items"][0]["direct_ms"] == pytest.approx(300 + old_weight * (recent - 300), abs=0.01)
+
+
+def test_stale_samples_trigger_a_new_race(clock):
+    router = AutoRouter(half_life=100.0)
+    router.observe("example.test", DIRECT, 0.1)
+    router.observe("example.test", PROXY, 0.2)
+    clock.now += 150.0
+    router.observe("example.test", PROXY, 0.2)
+    assert router.lookup("example.test") == DIRECT
+    # 直连样本超过两个半衰期没有更新，需要重新测速但保留记录
+    clock.now += 100.0
+    assert router.lookup("example.test") is None
+    assert router.page()["total"] == 1
+    # 两条路径都过期后删除记录，page()本身不删除
+    clock.now += 200.0
+    assert router.page()["total"] == 1
+    assert router.lookup("example.test") is None
+    assert router.page()["total"] == 0
+
+
+def test_forward_and_tunnel_measurements_are_kept_apart(clock):
+    router = AutoRouter()
+    router.observe("example.test", DIRECT, 0.050, TUNNEL)
+    router.observe("example.test", PROXY, 0.200, TUNNEL)
+    # 经HTTP上游代理转发时只测到上游代理本身，不影响隧道的结果
+    router.observe("example.test", DIRECT, 0.050, FORWARD)
+    router.observe("example.test", PROXY, 0.001, FORWARD)
+    assert router.lookup("example.test", TUNNEL) == DIRECT
+    assert router.lookup("example.test", FORWARD) == PROXY
+    assert sorted(item["kind"] for item in router.page()["items"]) == [FORWARD, TUNNEL]
+    router.forget("example.test")
+    assert router.page()["total"] == 0
+
+
+def test_capacity_evicts_least_recently_used(clock):
+    router = AutoRouter(capacity=2)
+    for domain in ("a.test", "b.test", "c.test"):
+        router.observe(domain, DIRECT, 0.1)
+    assert [item["domain"] for item in router.page()["items"]] == ["b.test", "c.test"]
+
+
+def test_concurrent_races_for_a_domain_are_deduplicated():
+    async def run():
+        router = AutoRouter()
+        direct_calls, proxy_calls = [], []
+        open_direct = _opener(0.01, direct_calls)
+        open_proxy = _opener(0.05, proxy_calls)
+        results = await asyncio.gather(*[router.race("example.test", open_direct, open_proxy) for _ in range(5)])
+        assert [result[0] for result in results] == [DIRECT] * 5
+        assert router.races == 1
+        # 测速的请求尝试两条路径，等待者只按胜出路径各建一条连接
+        assert len(direct_calls) == 5 and len(proxy_calls) == 1
+        await asyncio.sleep(0.1)
+        entry = router.page()["items"][0]
+        assert entry["direct_ms"] < entry["proxy_ms"] < FAILURE_PENALTY_MS
+
+    asyncio.run(run())
+
+
+def test_loser_connection_is_closed_after_it_is_measured():
+    async def run():
+        router = AutoRouter()
+        writers = []
+
+        async def open_proxy():
+            await asyncio.sleep(0.05)
+            writers.append(FakeWriter())
+            return None, writers[-1]
+
+        route, _, _ = await router.race("example.test", _opener(0.01, []), open_proxy)
+        assert route == DIRECT
+        await asyncio.sleep(0.1)
+        assert writers[0].closed
+        assert router.page()["items"][0]["proxy_ms"] is not None
+
+    asyncio.run(run())
+
+
+def test_waiters_take_over_when_the_racing_request_is_cancelled():
+    async def run():
+        router = AutoRouter()
+        open_slow = _opener(0.2, [])
+        leader = asyncio.create_task(router.race("example.test", open_slow, open_slow))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(router.race("example.test", open_slow, open_slow))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        route, _, _ = await asyncio.wait_for(waiter, 5)
+        assert route in (DIRECT, PROXY)
+        assert router.races == 2
+
+    asyncio.run(run())
+
+
+def test_waiters_use_the_proxy_when_both_routes_fail():
+    async def run():
+        router = AutoRouter()
+        refused = ConnectionRefusedError("refused")
+        leader = asyncio.create_task(router.race(
+            "example.test", _opener(0.01, [], refused), _opener(0.01, [], refused)))
+        await asyncio.sleep(0)
+        proxy_calls = []
+        waiter = router.race("example.test", _opener(0.01, []), _opener(0.01, proxy_calls))
+        results = await asyncio.gather(leader, waiter, return_exceptions=True)
+        assert isinstance(results[0], ConnectionRefusedError)
+        assert results[1][0] == PROXY and proxy_calls
+
+    asyncio.run(run())
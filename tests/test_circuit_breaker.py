@@ -0,0 +1,128 @@
+"""熔断器状态转换、半开状态的探测名额和负缓存过期的测试"""
+
+import aiohttp
+
+from simple_proxy import circuit_breaker
+from simple_proxy.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, NegativeCache
+from simple_proxy.upstream import UpstreamUnavailable
+
+
+class FakeClock:
+    """替换circuit_breaker模块中的time.monotonic()"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+def _tripped(open_seconds=30.0):
+    breaker = CircuitBreaker("example.test:80", min_requests=2, open_seconds=open_seconds)
+    breaker.record_failure(0.0, "refused")
+    breaker.record_failure(0.0, "refused")
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_breaker_opens_at_failure_rate():
+    breaker = CircuitBreaker("example.test:80", failure_rate=0.5, min_requests=4)
+    breaker.record_success(0.0)
+    breaker.record_success(0.0)
+    breaker.record_failure(0.0, "refused")
+    assert breaker.state == CLOSED
+    breaker.record_failure(0.0, "refused")
+    assert breaker.state == OPEN
+    assert breaker.trips == 1
+    assert not breaker.allow(1.0)
+
+
+def test_failures_outside_the_window_are_forgotten():
+    breaker = CircuitBreaker("example.test:80", min_requests=2, window=10.0)
+    breaker.record_failure(0.0, "refused")
+    breaker.record_failure(20.0, "refused")
+    assert breaker.state == CLOSED
+
+
+def test_half_open_admits_a_single_probe():
+    breaker = _tripped()
+    assert breaker.allow(30.0)
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow(30.0)
+    assert not breaker.permits(31.0)
+    breaker.record_success(31.0)
+    assert breaker.state == CLOSED
+    assert breaker.allow(31.0)
+
+
+def test_failed_probe_reopens():
+    breaker = _tripped()
+    assert breaker.allow(30.0)
+    breaker.record_failure(31.0, "refused")
+    assert breaker.state == OPEN
+    assert breaker.trips == 2
+    assert not breaker.allow(60.0)
+    assert breaker.allow(61.0)
+
+
+def test_abandoned_probe_is_replaced_after_open_seconds():
+    breaker = _tripped()
+    assert breaker.allow(30.0)
+    # 探测请求被取消，没有报告结果
+    assert not breaker.allow(59.0)
+    assert breaker.allow(60.0)
+
+
+def test_permits_does_not_claim_the_probe():
+    breaker = _tripped()
+    assert breaker.permits(30.0)
+    assert breaker.permits(30.0)
+    assert breaker.allow(30.0)
+
+
+def test_request_rejected_by_destination_does_not_take_the_upstream_probe(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    breakers = CircuitBreakers(min_requests=1, open_seconds=30.0)
+    breakers.record_failure("any.test:80", "10.0.0.1:3128", UpstreamUnavailable("refused"))
+    assert breakers.check("other.test:80", "10.0.0.1:3128")["reason"] == "upstream_open"
+    clock.now += 20.0
+    breakers.record_failure("down.test:80", "10.0.0.1:3128", aiohttp.ServerDisconnectedError())
+
+    clock.now += 10.0
+    # 上游进入半开状态，但目标仍在熔断，请求被目标拒绝，上游的探测名额保持空闲
+    assert breakers.check("down.test:80", "10.0.0.1:3128")["reason"] == "destination_open"
+    assert breakers.check("other.test:80", "10.0.0.1:3128") is None
+    assert breakers.check("another.test:80", "10.0.0.1:3128")["reason"] == "upstream_open"
+
+
+def test_upstream_failure_is_not_blamed_on_the_destination():
+    breakers = CircuitBreakers(min_requests=1)
+    breakers.record_failure("example.test:80", "10.0.0.1:3128", UpstreamUnavailable("refused"))
+    snapshot = breakers.snapshot(include_closed=True)
+    assert snapshot["upstreams"][0]["state"] == OPEN
+    assert snapshot["destinations"] == []
+
+
+def test_negative_cache_expires_after_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    breakers = CircuitBreakers(min_requests=100, negative_ttl=10.0)
+    breakers.record_failure("example.test:80", "direct", ConnectionRefusedError("refused"), connect_failed=True)
+    rejection = breakers.check("example.test:80", "direct")
+    assert rejection["reason"] == "unreachable"
+    assert rejection["retry_after"] == 10
+
+    clock.now += 9.9
+    assert breakers.check("example.test:80", "direct")["reason"] == "unreachable"
+    clock.now += 0.1
+    assert breakers.check("example.test:80", "direct") is None
+
+
+def test_negative_cache_drops_oldest_entries():
+    cache = NegativeCache(ttl=10.0, max_entries=2)
+    for index, key in enumerate(("a:1", "b:1", "c:1")):
+        cache.add(key, "refused", float(index))
+    assert cache.get("a:1", 3.0) is None
+    assert cache.get("b:1", 3.0) == (11.0, "refused")
+    assert [entry["key"] for entry in cache.snapshot(3.0)] == ["b:1", "c:1"]
@@ -0,0 +1,98 @@
+"""普通HTTP请求转发的超时和熔断计数测试：慢速下载不受总时长限制，响应头之后的中断不计入熔断"""
+
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from simple_proxy import proxy_server
+from simple_proxy.config import ProxyConfig
+from simple_proxy.proxy_server import ProxyServer
+
+CHUNKS = 5
+CHUNK_INTERVAL = 0.2
+
+
+async def _slow(request):
+    """每隔CHUNK_INTERVAL发送一块，总时长超过空闲超时"""
+    response = web.StreamResponse()
+    await response.prepare(request)
+    for _ in range(CHUNKS):
+        await asyncio.sleep(CHUNK_INTERVAL)
+        await response.write(b"x" * 1024)
+    await response.write_eof()
+    return response
+
+
+async def _stall(request):
+    """发出响应头和部分响应体后停止发送"""
+    response = web.StreamResponse(headers={"Content-Length": "2048"})
+    await response.prepare(request)
+    await response.write(b"x" * 1024)
+    await asyncio.sleep(5)
+    return response
+
+
+class Environment:
+    def __init__(self, config_path):
+        self.config_path = config_path
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/slow", _slow)
+        app.router.add_get("/stall", _stall)
+        self.origin = web.AppRunner(app)
+        await self.origin.setup()
+        await web.TCPSite(self.origin, "127.0.0.1", 0).start()
+        self.origin_port = self.origin.addresses[0][1]
+
+        config = ProxyConfig(str(self.config_path))
+        config.config.update({"default_mode": "direct", "auto_route": {"cache_file": None}, "rules": []})
+        self.proxy = ProxyServer(config, "127.0.0.1", 0)
+        await self.proxy.start()
+        self.proxy_url = f"http://127.0.0.1:{self.proxy.port}"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.proxy.stop(1)
+        await self.origin.cleanup()
+
+
+def _destination_failures(proxy):
+    return sum(b["failures"] for b in proxy.breakers.snapshot(include_closed=True)["destinations"])
+
+
+def test_slow_download_is_not_cut_off_by_total_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(proxy_server, "READ_IDLE_TIMEOUT", CHUNK_INTERVAL * 3)
+
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{env.origin_port}/slow", proxy=env.proxy_url) as resp:
+                    assert resp.status == 200
+                    assert len(await resp.read()) == CHUNKS * 1024
+            assert _destination_failures(env.proxy) == 0
+
+    asyncio.run(run())
+
+
+def test_stalled_body_is_cut_off_without_tripping_the_breaker(tmp_path, monkeypatch):
+    monkeypatch.setattr(proxy_server, "READ_IDLE_TIMEOUT", 0.3)
+
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{env.origin_port}/stall", proxy=env.proxy_url) as resp:
+                    assert resp.status == 200
+                    try:
+                        await asyncio.wait_for(resp.read(), 3)
+                    except aiohttp.ClientPayloadError:
+                        pass
+                    else:
+                        raise AssertionError("truncated body was reported as complete")
+            # 源站已经应答，响应体中途超时不算作目标故障
+            assert _destination_failures(env.proxy) == 0
+            breaker = env.proxy.breakers.snapshot(include_closed=True)["destinations"][0]
+            assert breaker["successes"] == 1
+
+    asyncio.run(run())
@@ -0,0 +1,43 @@
+"""流量回放测试：http和https记录都由替身源站应答，https记录经CONNECT隧道回放"""
+
+import asyncio
+
+from simple_proxy.config import ProxyConfig
+from simple_proxy.proxy_server import ProxyServer
+from simple_proxy.replay import TUNNEL_NOTE, TrafficReplayer, isolate_config
+
+RECORDS = [
+    {"id": "1", "method": "GET", "url": "http://plain.test/a", "status": 200, "size": 50,
+     "request_size": 0, "ts": 0.0},
+    {"id": "2", "method": "GET", "url": "https://secure.test/b?x=1", "status": 200, "size": 1234,
+     "request_size": 0, "ts": 0.0},
+    {"id": "3", "method": "POST", "url": "https://proxied.test:8443/c", "status": 204, "size": 0,
+     "request_size": 100, "ts": 0.0},
+    {"id": "4", "method": "GET", "url": "ftp://other.test/", "status": 200, "size": 0,
+     "request_size": 0, "ts": 0.0},
+]
+
+
+def test_http_and_https_records_are_replayed(tmp_path):
+    async def run():
+        config = ProxyConfig(str(tmp_path / "config.yaml"))
+        config.config.update({
+            "default_mode": "direct",
+            "proxy_settings": {"default_proxy": {"host": "10.0.0.1", "port": 3128, "type": "http"}},
+            "rules": [{"pattern": "proxied.test", "type": "domain", "action": "proxy"}],
+        })
+        proxy = ProxyServer(isolate_config(config), "127.0.0.1", 0)
+        await proxy.start()
+        try:
+            return await TrafficReplayer(RECORDS, speed=0).run(proxy)
+        finally:
+            await proxy.stop(1)
+
+    report = asyncio.run(run())
+    assert report["replayed"] == 3
+    assert report["skipped"] == {"unsupported_url": 1}
+    assert report["overall"]["errors"] == 0 and report["overall"]["mismatches"] == 0
+    assert report["by_upstream"]["direct"]["count"] == 2
+    assert report["by_upstream"]["default_proxy"]["count"] == 1
+    assert report["tunnelled"] == 2
+    assert report["note"] == TUNNEL_NOTE
@@ -0,0 +1,65 @@
+"""规则引擎按配置事件增量更新已编译规则的测试"""
+
+import pytest
+
+from simple_proxy.config import ProxyConfig
+from simple_proxy.rule_engine import RuleEngine
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = ProxyConfig(str(tmp_path / "config.yaml"))
+    config.config.update({
+        "default_mode": "direct",
+        "rules": [
+            {"pattern": "www.a.test", "type": "domain", "action": "proxy"},
+            {"pattern": "www.b.test", "type": "domain", "action": "proxy"},
+        ],
+    })
+    return config
+
+
+def _action(engine, host):
+    return engine.get_rule_for_request(f"http://{host}/")["action"]
+
+
+def test_added_rule_is_compiled_without_recompiling_the_rest(config):
+    engine = RuleEngine(config)
+    before = list(engine.compiled_rules)
+    config.add_rule({"pattern": "www.c.test", "type": "domain", "action": "proxy"})
+    assert all(new is old for new, old in zip(engine.compiled_rules, before))
+    assert _action(engine, "www.c.test") == "proxy"
+
+
+def test_removed_rule_is_dropped_by_index(config):
+    engine = RuleEngine(config)
+    kept = engine.compiled_rules[1]
+    assert config.remove_rule(0)
+    assert len(engine.compiled_rules) == 1 and engine.compiled_rules[0] is kept
+    assert _action(engine, "www.a.test") == "direct"
+    assert _action(engine, "www.b.test") == "proxy"
+
+
+def test_invalid_pattern_keeps_indexes_aligned(config):
+    engine = RuleEngine(config)
+    config.add_rule({"pattern": "(", "type": "ip", "action": "proxy"})
+    config.add_rule({"pattern": "www.d.test", "type": "domain", "action": "proxy"})
+    assert config.remove_rule(2)
+    assert [rule["pattern"] for _, rule in engine.compiled_rules] == ["www.a.test", "www.b.test", "www.d.test"]
+    assert _action(engine, "www.d.test") == "proxy"
+
+
+def test_other_config_changes_do_not_recompile(config):
+    engine = RuleEngine(config)
+    compiled = engine.compiled_rules
+    config.config["default_mode"] = "proxy"
+    config.notify_changed()
+    assert engine.compiled_rules is compiled
+
+
+def test_rules_reset_recompiles(config):
+    engine = RuleEngine(config)
+    config.config["rules"] = [{"pattern": "www.e.test", "type": "domain", "action": "proxy"}]
+    config.notify_changed("rules_reset", {"total": 1})
+    assert _action(engine, "www.e.test") == "proxy"
+    assert _action(engine, "www.a.test") == "direct"
@@ -0,0 +1,97 @@
+"""令牌桶欠额、限速在连接之间的延续和空闲令牌桶回收的测试"""
+
+import pytest
+
+from simple_proxy import shaping
+from simple_proxy.shaping import UNLIMITED, TokenBucket, TrafficShaper
+
+
+class FakeClock:
+    """替换shaping模块中的time.monotonic()"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(shaping, "time", clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_accumulates_debt(clock):
+    bucket = TokenBucket(rate=1000, burst=1000)
+    assert bucket.reserve(1000, clock.now) == 0.0
+    # 余额可以为负，后到的数据块等待更久
+    assert bucket.reserve(500, clock.now) == pytest.approx(0.5)
+    assert bucket.reserve(500, clock.now) == pytest.approx(1.0)
+    assert bucket.tokens == -1000
+
+
+def test_bucket_refills_at_rate_up_to_burst(clock):
+    bucket = TokenBucket(rate=1000, burst=1000)
+    bucket.reserve(1500, clock.now)
+    assert not bucket.is_full(clock.now + 1.0)
+    assert bucket.is_full(clock.now + 1.5)
+    # 空闲再久余额也不超过burst
+    assert bucket.reserve(1000, clock.now + 100) == 0.0
+    assert bucket.reserve(1, clock.now + 100) > 0
+
+
+def test_back_to_back_connections_share_the_debt(clock):
+    shaper = TrafficShaper(per_client=1000)
+    first = shaper.flow("10.0.0.1", "rule", "direct")
+    first.download[0].reserve(3000, clock.now)
+    # 前一个连接结束后立即发起的请求继承欠额，而不是得到新的突发额度
+    second = shaper.flow("10.0.0.1", "rule", "direct")
+    assert second.download[0] is first.download[0]
+    assert second.download[0].reserve(100, clock.now) == pytest.approx(2.1)
+    # 另一个客户端不受影响
+    assert shaper.flow("10.0.0.2", "rule", "direct").download[0].reserve(100, clock.now) == 0.0
+
+
+def test_changed_rate_replaces_the_bucket(clock):
+    shaper = TrafficShaper(per_client=1000)
+    before = shaper.flow("10.0.0.1", "rule", "direct").download[0]
+    shaper.configure(per_client=2000)
+    after = shaper.flow("10.0.0.1", "rule", "direct").download[0]
+    assert after is not before
+    assert after.rate == 2000
+
+
+def test_unlimited_flow_creates_no_buckets():
+    shaper = TrafficShaper(rules={"other": 1000})
+    assert shaper.flow("10.0.0.1", "rule", "direct") is UNLIMITED
+    assert shaper.snapshot()["active"] == {}
+
+
+def test_idle_full_buckets_are_recycled(clock):
+    shaper = TrafficShaper(per_client=1000)
+    shaper.flow("10.0.0.1", "rule", "direct")
+    clock.now += 10
+    for index in range(2, 6):
+        shaper.flow(f"10.0.0.{index}", "rule", "direct")
+    assert "client:10.0.0.1" not in shaper.snapshot()["active"]
+
+
+def test_buckets_in_debt_outlive_full_ones(clock):
+    shaper = TrafficShaper(per_client=1000, max_buckets=4)
+    shaper.flow("10.0.0.1", "rule", "direct").download[0].reserve(10000, clock.now)
+    for index in range(2, 6):
+        shaper.flow(f"10.0.0.{index}", "rule", "direct")
+    # 余额为负的桶被保留，否则新连接会绕过欠额；令牌已满的桶先被回收
+    assert shaper.snapshot()["active"]["client:10.0.0.1"]["down"]["tokens"] == -9000
+    assert len(shaper._buckets) <= 4
+
+
+def test_bucket_count_is_capped_when_all_are_in_debt(clock):
+    shaper = TrafficShaper(per_client=1000, max_buckets=4)
+    for index in range(1, 6):
+        limits = shaper.flow(f"10.0.0.{index}", "rule", "direct")
+        for bucket in limits.upload + limits.download:
+            bucket.reserve(10000, clock.now)
+        assert len(shaper._buckets) <= 4
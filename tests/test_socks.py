@@ -0,0 +1,270 @@
+"""SOCKS5上游代理串联、拒绝应答处理和SOCKS5监听入口的测试，全部使用进程内的本地服务"""
+
+import asyncio
+import ipaddress
+
+import aiohttp
+from aiohttp import web
+
+from simple_proxy.config import ProxyConfig
+from simple_proxy.proxy_server import ProxyServer
+from simple_proxy.socks_server import Socks5Server
+from simple_proxy.upstream import (SOCKS_REPLY_COMMAND_NOT_SUPPORTED, SOCKS_REPLY_CONNECTION_REFUSED,
+                                   SOCKS_REPLY_SUCCEEDED)
+
+# 替身SOCKS5代理把该后缀的域名解析到本机，代理服务器本地无法解析它们
+TEST_SUFFIX = ".test"
+
+
+class StandInSocks5:
+    """最小的SOCKS5代理：支持无认证和用户名/密码认证，记录收到的CONNECT目标"""
+
+    def __init__(self, credentials=None):
+        self.credentials = credentials
+        self.targets = []
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            _, count = await reader.readexactly(2)
+            await reader.readexactly(count)
+            if self.credentials:
+                writer.write(b"\x05\x02")
+                await reader.readexactly(1)
+                username = await reader.readexactly((await reader.readexactly(1))[0])
+                password = await reader.readexactly((await reader.readexactly(1))[0])
+                accepted = (username.decode(), password.decode()) == self.credentials
+                writer.write(b"\x01" + (b"\x00" if accepted else b"\x01"))
+                if not accepted:
+                    return
+            else:
+                writer.write(b"\x05\x00")
+            _, _, _, atyp = await reader.readexactly(4)
+            if atyp == 1:
+                host = str(ipaddress.IPv4Address(await reader.readexactly(4)))
+            elif atyp == 3:
+                host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+            else:
+                host = str(ipaddress.IPv6Address(await reader.readexactly(16)))
+            port = int.from_bytes(await reader.readexactly(2), "big")
+            self.targets.append((host, port))
+            if host.endswith(TEST_SUFFIX):
+                host = "127.0.0.1"
+            try:
+                target_reader, target_writer = await asyncio.open_connection(host, port)
+            except OSError:
+                writer.write(bytes([5, SOCKS_REPLY_CONNECTION_REFUSED, 0, 1]) + bytes(6))
+                return
+            writer.write(bytes([5, SOCKS_REPLY_SUCCEEDED, 0, 1]) + bytes(6))
+            await asyncio.gather(_pipe(reader, target_writer), _pipe(target_reader, writer))
+            target_writer.close()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _pipe(reader, writer):
+    try:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+        writer.write_eof()
+    except OSError:
+        pass
+
+
+async def _echo(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def _hello(request):
+    return web.Response(text="hello")
+
+
+class Environment:
+    """源站、回显服务、两个替身SOCKS5代理，以及以它们为上游的代理服务器和SOCKS5监听入口"""
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/", _hello)
+        self.origin = web.AppRunner(app)
+        await self.origin.setup()
+        site = web.TCPSite(self.origin, "127.0.0.1", 0)
+        await site.start()
+        self.origin_port = self.origin.addresses[0][1]
+        self.echo = await asyncio.start_server(_echo, "127.0.0.1", 0)
+        self.echo_port = self.echo.sockets[0].getsockname()[1]
+
+        self.socks = StandInSocks5()
+        await self.socks.start()
+        self.authed_socks = StandInSocks5(credentials=("user", "secret"))
+        await self.authed_socks.start()
+
+        config = ProxyConfig(str(self.config_path))
+        config.config.update({
+            "default_mode": "direct",
+            "auto_route": {"cache_file": None},
+            "proxy_settings": {
+                "default_proxy": {"host": "127.0.0.1", "port": self.socks.port, "type": "socks5"},
+                "authed": {"host": "127.0.0.1", "port": self.authed_socks.port, "type": "socks5",
+                           "username": "user", "password": "secret"},
+                "wrong_password": {"host": "127.0.0.1", "port": self.authed_socks.port, "type": "socks5",
+                                   "username": "user", "password": "guess"},
+            },
+            "rules": [
+                {"pattern": "authed.test", "type": "domain", "action": "proxy", "proxy": "authed"},
+                {"pattern": "denied.test", "type": "domain", "action": "proxy", "proxy": "wrong_password"},
+                {"pattern": "origin.test", "type": "domain", "action": "proxy"},
+            ],
+        })
+        self.proxy = ProxyServer(config, "127.0.0.1", 0)
+        await self.proxy.start()
+        self.listener = Socks5Server(self.proxy, "127.0.0.1", 0)
+        await self.listener.start()
+        self.proxy_url = f"http://127.0.0.1:{self.proxy.port}"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.listener.stop()
+        await self.proxy.stop(1)
+        await self.origin.cleanup()
+        self.echo.close()
+        self.socks.close()
+        self.authed_socks.close()
+
+
+async def _socks_connect(port, host, target_port, command=1):
+    """作为SOCKS5客户端连接监听入口，返回 (应答码, reader, writer)"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"\x05\x01\x00")
+    assert await reader.readexactly(2) == b"\x05\x00"
+    name = host.encode()
+    writer.write(bytes([5, command, 0, 3, len(name)]) + name + target_port.to_bytes(2, "big"))
+    reply = await reader.readexactly(10)
+    return reply[1], reader, writer
+
+
+def test_http_request_is_chained_through_socks_upstream(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            async with aiohttp.ClientSession() as session:
+                for _ in range(2):
+                    async with session.get(f"http://origin.test:{env.origin_port}/", proxy=env.proxy_url) as resp:
+                        assert resp.status == 200
+                        assert await resp.text() == "hello"
+            # 域名交给上游解析，第二个请求复用同一条经SOCKS5建立的连接
+            assert env.socks.targets == [("origin.test", env.origin_port)]
+
+    asyncio.run(run())
+
+
+def test_connect_tunnel_is_chained_through_socks_upstream(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            reader, writer = await asyncio.open_connection("127.0.0.1", env.proxy.port)
+            writer.write(f"CONNECT origin.test:{env.echo_port} HTTP/1.1\r\n\r\n".encode())
+            assert b" 200 " in await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"ping")
+            assert await asyncio.wait_for(reader.readexactly(4), 5) == b"ping"
+            writer.close()
+            assert env.socks.targets == [("origin.test", env.echo_port)]
+
+    asyncio.run(run())
+
+
+def test_socks_upstream_authentication(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://authed.test:{env.origin_port}/", proxy=env.proxy_url) as resp:
+                    assert resp.status == 200
+                async with session.get(f"http://denied.test:{env.origin_port}/", proxy=env.proxy_url) as resp:
+                    assert resp.status == 500
+                    assert "authentication" in (await resp.text()).lower()
+            assert env.authed_socks.targets == [("authed.test", env.origin_port)]
+
+    asyncio.run(run())
+
+
+def test_refusal_from_socks_upstream_is_reported_without_blaming_the_upstream(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            async with aiohttp.ClientSession() as session:
+                async with session.get("http://origin.test:1/", proxy=env.proxy_url) as resp:
+                    assert resp.status == 500
+                    assert "connection refused" in (await resp.text())
+            # CONNECT隧道把上游的拒绝转换为502
+            reader, writer = await asyncio.open_connection("127.0.0.1", env.proxy.port)
+            writer.write(b"CONNECT origin.test:1 HTTP/1.1\r\n\r\n")
+            assert b" 502 " in await reader.readuntil(b"\r\n\r\n")
+            writer.close()
+            # SOCKS5监听入口原样返回上游的应答码
+            code, _, writer = await _socks_connect(env.listener.port, "origin.test", 1)
+            assert code == SOCKS_REPLY_CONNECTION_REFUSED
+            writer.close()
+            # 上游代理正常应答了拒绝，不计为上游故障
+            upstreams = {b["key"]: b for b in env.proxy.breakers.snapshot()["upstreams"]}
+            assert upstreams[f"127.0.0.1:{env.socks.port}"]["failures"] == 0
+
+    asyncio.run(run())
+
+
+def test_unreachable_socks_upstream(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            env.socks.close()
+            await env.socks.server.wait_closed()
+            reader, writer = await asyncio.open_connection("127.0.0.1", env.proxy.port)
+            writer.write(f"CONNECT origin.test:{env.echo_port} HTTP/1.1\r\n\r\n".encode())
+            assert b" 502 " in await reader.readuntil(b"\r\n\r\n")
+            writer.close()
+            upstreams = {b["key"]: b for b in env.proxy.breakers.snapshot()["upstreams"]}
+            assert upstreams[f"127.0.0.1:{env.socks.port}"]["failures"] == 1
+
+    asyncio.run(run())
+
+
+def test_socks_listener_direct_and_chained(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            code, reader, writer = await _socks_connect(env.listener.port, "localhost", env.echo_port)
+            assert code == SOCKS_REPLY_SUCCEEDED
+            writer.write(b"direct")
+            assert await asyncio.wait_for(reader.readexactly(6), 5) == b"direct"
+            writer.close()
+
+            code, reader, writer = await _socks_connect(env.listener.port, "origin.test", env.echo_port)
+            assert code == SOCKS_REPLY_SUCCEEDED
+            writer.write(b"chained")
+            assert await asyncio.wait_for(reader.readexactly(7), 5) == b"chained"
+            writer.close()
+            assert env.socks.targets == [("origin.test", env.echo_port)]
+
+    asyncio.run(run())
+
+
+def test_socks_listener_rejects_unsupported_command(tmp_path):
+    async def run():
+        async with Environment(tmp_path / "config.yaml") as env:
+            # BIND
+            code, reader, writer = await _socks_connect(env.listener.port, "localhost", env.echo_port, command=2)
+            assert code == SOCKS_REPLY_COMMAND_NOT_SUPPORTED
+            assert await asyncio.wait_for(reader.read(), 5) == b""
+            writer.close()
+
+    asyncio.run(run())
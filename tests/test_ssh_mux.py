@@ -0,0 +1,245 @@
+"""asyncssh复用后端的远程转发、断线重连和端到端探测测试，SSH服务器在进程内运行"""
+
+import asyncio
+import socket
+import types
+
+import pytest
+
+asyncssh = pytest.importorskip("asyncssh")
+
+from simple_proxy.ssh_forwarder import SSHForwarder  # noqa: E402
+from simple_proxy.ssh_mux import SSHMultiplexer  # noqa: E402
+
+
+class _ForwardingServer(asyncssh.SSHServer):
+    """不要求认证、允许所有端口转发的SSH服务器（与sshd默认的AllowTcpForwarding yes相同）"""
+
+    def __init__(self, sshd):
+        self.sshd = sshd
+
+    def connection_made(self, conn):
+        self.sshd.connections.append(conn)
+
+    def begin_auth(self, username):
+        return False
+
+    def server_requested(self, listen_host, listen_port):
+        return True
+
+    def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
+        return True
+
+
+class LocalSSHServer:
+    def __init__(self):
+        self.connections = []
+        self.server = None
+        self.port = None
+
+    async def start(self, port=0):
+        self.server = await asyncssh.create_server(
+            lambda: _ForwardingServer(self), "127.0.0.1", port,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")])
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def drop_connections(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections.clear()
+
+    async def stop(self):
+        self.drop_connections()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def _http_service(reader, writer):
+    """本地服务：对任何请求应答204，与代理服务器对探测请求的应答相同"""
+    await reader.readuntil(b"\r\n\r\n")
+    writer.write(b"HTTP/1.1 204 No Content\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    writer.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _forward_config(sshd, local_port, **extra):
+    config = {
+        "name": "test",
+        "ssh_host": "127.0.0.1",
+        "ssh_port": sshd.port,
+        "ssh_user": "tester",
+        "local_port": local_port,
+        "remote_host": "127.0.0.1",
+        "remote_port": _free_port(),
+    }
+    config.update(extra)
+    return config
+
+
+async def _wait_until(predicate, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached in time")
+        await asyncio.sleep(0.02)
+
+
+async def _request_through_remote_port(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    line = await asyncio.wait_for(reader.readline(), 5)
+    writer.close()
+    return line
+
+
+def test_forward_reaches_local_service():
+    async def run():
+        sshd = LocalSSHServer()
+        await sshd.start()
+        service = await asyncio.start_server(_http_service, "127.0.0.1", 0)
+        config = _forward_config(sshd, service.sockets[0].getsockname()[1])
+        mux = SSHMultiplexer(backoff_base=0.05, backoff_max=0.2)
+        try:
+            await mux.add_forward(config)
+            await _wait_until(lambda: mux.is_running("test"))
+            assert await _request_through_remote_port(config["remote_port"]) == b"HTTP/1.1 204 No Content\r\n"
+            await _wait_until(lambda: mux.get_status()["test"]["active_connections"] == 0)
+            status = mux.get_status()["test"]
+            assert status["connections"] == 1
+            assert status["bytes_in"] > 0 and status["bytes_out"] > 0
+        finally:
+            await mux.close()
+            service.close()
+            await sshd.stop()
+
+    asyncio.run(run())
+
+
+def test_forwards_to_the_same_server_share_one_connection():
+    async def run():
+        sshd = LocalSSHServer()
+        await sshd.start()
+        service = await asyncio.start_server(_http_service, "127.0.0.1", 0)
+        local_port = service.sockets[0].getsockname()[1]
+        first = _forward_config(sshd, local_port, name="first")
+        second = _forward_config(sshd, local_port, name="second")
+        mux = SSHMultiplexer(backoff_base=0.05, backoff_max=0.2)
+        try:
+            await mux.add_forward(first)
+            await mux.add_forward(second)
+            await _wait_until(lambda: mux.is_running("first") and mux.is_running("second"))
+            assert len(sshd.connections) == 1
+            for config in (first, second):
+                assert (await _request_through_remote_port(config["remote_port"])).startswith(b"HTTP/1.1 204")
+        finally:
+            await mux.close()
+            service.close()
+            await sshd.stop()
+
+    asyncio.run(run())
+
+
+def test_reconnects_and_restores_forwards_after_disconnect():
+    async def run():
+        sshd = LocalSSHServer()
+        await sshd.start()
+        service = await asyncio.start_server(_http_service, "127.0.0.1", 0)
+        config = _forward_config(sshd, service.sockets[0].getsockname()[1])
+        mux = SSHMultiplexer(backoff_base=0.05, backoff_max=0.2)
+        try:
+            await mux.add_forward(config)
+            await _wait_until(lambda: mux.is_running("test"))
+
+            sshd.drop_connections()
+            await _wait_until(lambda: not mux.is_running("test"))
+            await _wait_until(lambda: mux.is_running("test"))
+            assert mux.get_status()["test"]["reconnects"] == 1
+            assert (await _request_through_remote_port(config["remote_port"])).startswith(b"HTTP/1.1 204")
+        finally:
+            await mux.close()
+            service.close()
+            await sshd.stop()
+
+    asyncio.run(run())
+
+
+def test_retries_with_backoff_until_the_server_is_back():
+    async def run():
+        sshd = LocalSSHServer()
+        await sshd.start()
+        port = sshd.port
+        await sshd.stop()
+        service = await asyncio.start_server(_http_service, "127.0.0.1", 0)
+        config = _forward_config(sshd, service.sockets[0].getsockname()[1])
+        mux = SSHMultiplexer(backoff_base=0.05, backoff_max=0.2)
+        try:
+            await mux.add_forward(config)
+            await _wait_until(lambda: mux.get_status()["test"]["reconnects"] >= 2)
+            assert not mux.is_running("test")
+            assert mux.get_status()["test"]["last_error"]
+
+            await sshd.start(port)
+            await _wait_until(lambda: mux.is_running("test"))
+            assert mux.get_status()["test"]["last_error"] is None
+        finally:
+            await mux.close()
+            service.close()
+            await sshd.stop()
+
+    asyncio.run(run())
+
+
+def _forwarder(ssh_config):
+    config = types.SimpleNamespace(config={"ssh_backend": "asyncssh", "ssh_forwarding": [ssh_config]})
+    return SSHForwarder(config, backoff_base=0.05, backoff_max=0.2)
+
+
+def test_probe_measures_round_trip_through_the_tunnel():
+    async def run():
+        sshd = LocalSSHServer()
+        await sshd.start()
+        service = await asyncio.start_server(_http_service, "127.0.0.1", 0)
+        config = _forward_config(sshd, service.sockets[0].getsockname()[1], probe_interval=0)
+        forwarder = _forwarder(config)
+        try:
+            await forwarder.start_all_forwarding()
+            await _wait_until(lambda: forwarder.multiplexer.is_running("test"))
+            rtt = await forwarder._probe("test", config)
+            assert rtt is not None and rtt > 0
+
+            # 本地服务停止后隧道仍在，但端到端探测失败
+            service.close()
+            await service.wait_closed()
+            assert await forwarder._probe("test", config) is None
+        finally:
+            await forwarder.stop_all_forwarding()
+            await sshd.stop()
+
+    asyncio.run(run())
+
+
+def test_failed_probes_restart_the_forward():
+    async def run():
+        sshd = LocalSSHServer()
+        await sshd.start()
+        # 本地端口上没有服务，每次探测都失败
+        config = _forward_config(sshd, _free_port(), probe_interval=0.05, probe_failures=2, probe_timeout=1)
+        forwarder = _forwarder(config)
+        try:
+            await forwarder.start_all_forwarding()
+            await _wait_until(lambda: forwarder.health["test"]["restarts"] >= 1)
+            assert forwarder.health["test"]["last_exit"] == "probe_failed"
+            assert forwarder.health["test"]["probe_ok"] is False
+            await _wait_until(lambda: forwarder.multiplexer.is_running("test"))
+        finally:
+            await forwarder.stop_all_forwarding()
+            await sshd.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+"""WebSocket（HTTP Upgrade）握手转发测试：直连，以及经HTTP上游代理时以absolute形式转发而不使用CONNECT"""
+
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from simple_proxy.config import ProxyConfig
+from simple_proxy.proxy_server import ProxyServer
+
+
+async def _ws_echo(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    async for msg in ws:
+        await ws.send_str("echo:" + msg.data)
+    return ws
+
+
+class Environment:
+    """WebSocket源站、作为HTTP上游代理的代理服务器，以及以它为上游的代理服务器"""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+
+    def _config(self, name, **settings):
+        config = ProxyConfig(str(self.tmp_path / name))
+        config.config.update({"default_mode": "direct", "auto_route": {"cache_file": None}, "rules": []})
+        config.config.update(settings)
+        return config
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/ws", _ws_echo)
+        self.origin = web.AppRunner(app)
+        await self.origin.setup()
+        await web.TCPSite(self.origin, "127.0.0.1", 0).start()
+        self.origin_port = self.origin.addresses[0][1]
+
+        self.parent = ProxyServer(self._config("parent.yaml"), "127.0.0.1", 0)
+        await self.parent.start()
+        self.proxy = ProxyServer(self._config("config.yaml", default_mode="proxy", proxy_settings={
+            "default_proxy": {"host": "127.0.0.1", "port": self.parent.port, "type": "http"},
+        }), "127.0.0.1", 0)
+        await self.proxy.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.proxy.stop(1)
+        await self.parent.stop(1)
+        await self.origin.cleanup()
+
+
+async def _echo_through(proxy_port, origin_port):
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(f"ws://127.0.0.1:{origin_port}/ws",
+                                      proxy=f"http://127.0.0.1:{proxy_port}") as ws:
+            await ws.send_str("hello")
+            return (await asyncio.wait_for(ws.receive(), 5)).data
+
+
+def test_upgrade_direct(tmp_path):
+    async def run():
+        async with Environment(tmp_path) as env:
+            assert await _echo_through(env.parent.port, env.origin_port) == "echo:hello"
+            assert env.parent.stats["upgrades"] == 1
+
+    asyncio.run(run())
+
+
+def test_upgrade_through_http_upstream_does_not_use_connect(tmp_path):
+    async def run():
+        async with Environment(tmp_path) as env:
+            assert await _echo_through(env.proxy.port, env.origin_port) == "echo:hello"
+            # 上游代理收到的是absolute形式的握手请求，而不是CONNECT
+            assert env.parent.stats["connects"] == 0
+            assert env.parent.stats["upgrades"] == 1
+
+    asyncio.run(run())